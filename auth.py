@@ -1,29 +1,98 @@
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from typing import Optional
 from jose import JWTError, jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
-import pickle
-import redis
+from sqlalchemy.ext.asyncio import AsyncSession
+from redis.exceptions import RedisError
 from config import settings
 from my_db import get_db
+from cache import user_cache, LRUCache
+from sessions import refresh_tokens, revocation_list
+from metrics import metrics
+from models import User
 import users as repository_users
 
 
+logger = logging.getLogger(__name__)
+
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _make_hash_executor() -> Executor:
+    """
+    The _make_hash_executor function creates the pool bcrypt runs in, outside of the event loop.
+    bcrypt releases the GIL, so threads are the default; a process pool can be chosen in the settings.
+
+    :return: A thread or process pool with password_hash_workers workers.
+    :rtype: Executor
+    """
+    if settings.password_hash_executor == "process":
+        return ProcessPoolExecutor(max_workers=settings.password_hash_workers)
+    return ThreadPoolExecutor(max_workers=settings.password_hash_workers, thread_name_prefix="bcrypt")
+
+
 class Auth:
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    pwd_context = pwd_context
     SECRET_KEY = settings.secret_key
     ALGORITHM = settings.algorithm
     oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
-    r = redis.Redis(host=settings.redis_host, port=settings.redis_port, db=0)
 
-    def verify_password(self, plain_password, hashed_password) -> bool:
+    # the claims of recently verified tokens, by the sha256 of the token, see decode_token
+    token_cache = LRUCache(settings.token_cache_size)
+
+    hash_executor = _make_hash_executor()
+    hash_semaphore = asyncio.Semaphore(settings.password_hash_workers)
+    hash_queue_depth = 0
+
+    async def _run_hashing(self, func, *args):
+        """
+        The _run_hashing function runs a bcrypt call in the hash executor, at most password_hash_workers at a time.
+        Callers above the cap wait in a queue; once password_hash_max_queue callers are waiting
+        new ones are turned away with 503 instead of piling up.
+
+        :param self: Represent the instance of the class.
+        :param func: The blocking function to run.
+        :param args: The arguments of the function.
+        :return: The result of the function.
+        """
+        if self.hash_semaphore.locked() and self.hash_queue_depth >= settings.password_hash_max_queue:
+            metrics.inc("password_hash_rejected_total")
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many authentication requests, try again later")
+        self.hash_queue_depth += 1
+        try:
+            await self.hash_semaphore.acquire()
+        finally:
+            self.hash_queue_depth -= 1
+        try:
+            metrics.inc("password_hash_total")
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.hash_executor, func, *args)
+        finally:
+            self.hash_semaphore.release()
+
+    async def verify_password(self, plain_password, hashed_password) -> bool:
         """
         The verify_password function takes a plain-text password and hashed
         password as arguments. It then uses the pwd_context object to verify that the
-        plain-text password matches the hashed one.
+        plain-text password matches the hashed one. The check runs in the hash executor.
 
         :param self: Represent the instance of the class.
         :param plain_password: Pass the password that is entered by the user.
@@ -33,12 +102,12 @@ class Auth:
         :return: True or false depending on whether the password is correct.
         :rtype: bool
         """
-        return self.pwd_context.verify(plain_password, hashed_password)
+        return await self._run_hashing(_verify_password, plain_password, hashed_password)
 
-    def get_password_hash(self, password: str) -> str:
+    async def get_password_hash(self, password: str) -> str:
         """
         The get_password_hash function takes a password as input and returns the hash of that password.
-        The hash is generated using the pwd_context object, which is an instance of Flask-Bcrypt's Bcrypt class.
+        The hash is generated using the pwd_context object in the hash executor.
 
         :param self: Represent the instance of the class.
         :param password: Pass the password that will be hashed.
@@ -46,7 +115,33 @@ class Auth:
         :return: A hash of the password.
         :rtype: str   
         """
-        return self.pwd_context.hash(password)
+        return await self._run_hashing(_hash_password, password)
+
+    def decode_token(self, token: str) -> dict:
+        """
+        The decode_token function verifies the signature and the expiry of a token and returns its claims.
+        The claims of valid tokens are cached until the token expires, so a client presenting the same token
+        on consecutive requests costs one dictionary lookup instead of a signature check.
+        The cache is keyed by the sha256 of the token, the token itself is not kept. The returned dictionary
+        is shared between the callers and must not be modified.
+
+        :param self: Represent the instance of the class.
+        :param token: The encoded token.
+        :type token: str
+        :return: The claims of the token.
+        :rtype: dict
+        :raises JWTError: If the token is invalid or expired.
+        """
+        key = hashlib.sha256(token.encode()).digest()
+        payload = self.token_cache.get(key)
+        if payload is not None:
+            metrics.inc("token_cache_hit_total")
+            return payload
+        metrics.inc("token_cache_miss_total")
+        payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+        if isinstance(payload.get("exp"), (int, float)):
+            self.token_cache.set(key, payload, payload["exp"])
+        return payload
 
     # define a function to generate a new access token
 
@@ -56,7 +151,9 @@ class Auth:
             Args:
                 data (dict): A dictionary containing the claims to be encoded in the JWT.
                 expires_delta (Optional[float]): An optional parameter specifying how long, in seconds,
-                the access token should last before expiring. If not specified, it defaults to 15 minutes.
+                the access token should last before expiring. If not specified, it defaults to access_token_ttl.
+        Every token gets a random jti claim, so it can be revoked on its own, see revoke_access_token,
+        and its issue time in nanoseconds as iat_ns, the iat claim is rounded to the second.
 
         :param self: Represent the instance of the class.
         :param data: Pass the data that will be encoded in the jwt.
@@ -70,9 +167,9 @@ class Auth:
         if expires_delta:
             expire = datetime.utcnow() + timedelta(seconds=expires_delta)
         else:
-            expire = datetime.utcnow() + timedelta(minutes=15)
-        to_encode.update(
-            {"iat": datetime.utcnow(), "exp": expire, "scope": "access_token"})
+            expire = datetime.utcnow() + timedelta(seconds=settings.access_token_ttl)
+        to_encode.update({"iat": datetime.utcnow(), "iat_ns": time.time_ns(), "exp": expire, "scope": "access_token",
+                          "jti": uuid.uuid4().hex})
         encoded_access_token = jwt.encode(
             to_encode, self.SECRET_KEY, algorithm=self.ALGORITHM)
         return encoded_access_token
@@ -84,7 +181,8 @@ class Auth:
         The create_refresh_token function creates a refresh token for the user.
             Args:
                 data (dict): A dictionary containing the user's id and username.
-                expires_delta (Optional[float]): The number of seconds until the token expires, defaults to None.
+                expires_delta (Optional[float]): The number of seconds until the token expires,
+                defaults to refresh_token_ttl.
 
 
         :param self: Represent the instance of the class.
@@ -99,48 +197,241 @@ class Auth:
         if expires_delta:
             expire = datetime.utcnow() + timedelta(seconds=expires_delta)
         else:
-            expire = datetime.utcnow() + timedelta(days=7)
+            expire = datetime.utcnow() + timedelta(seconds=settings.refresh_token_ttl)
         to_encode.update(
             {"iat": datetime.utcnow(), "exp": expire, "scope": "refresh_token"})
         encoded_refresh_token = jwt.encode(
             to_encode, self.SECRET_KEY, algorithm=self.ALGORITHM)
         return encoded_refresh_token
 
-    async def decode_refresh_token(self, refresh_token: str) -> str:
+    async def decode_refresh_token(self, refresh_token: str) -> dict:
         """
         The decode_refresh_token function is used to decode the refresh token.
-        It takes in a refresh_token as an argument and returns the email of the user who owns that token.
-        If there is no such user, it raises an HTTPException with status code 401 (Unauthorized) and detail 'Could not validate credentials'.
+        It takes in a refresh_token as an argument and returns its claims.
+        If the token is invalid or is not a refresh token, it raises an HTTPException with status code 401 (Unauthorized).
 
         :param self: Represent the instance of a class.
         :param refresh_token: Pass in the refresh token that is sent with the request.
         :type refresh_token: str
-        :return: The email of the user.
-        :rtype: str
+        :return: The claims of the token, sub is the email of the user.
+        :rtype: dict
         """
         try:
-            payload = jwt.decode(
-                refresh_token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+            payload = self.decode_token(refresh_token)
             if payload['scope'] == 'refresh_token':
-                email = payload['sub']
-                return email
+                return payload
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid scope for token')
         except JWTError:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                 detail='Could not validate credentials')
 
-    async def get_current_user(self, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    @staticmethod
+    def user_claims(user: User) -> dict:
+        """
+        The user_claims function returns the claims that identify the user in access and refresh tokens.
+        The subject is the user_id, which never changes; the email is informative only.
+
+        :param user: The user.
+        :type user: User
+        :return: The sub and email claims.
+        :rtype: dict
+        """
+        return {"sub": str(user.user_id), "email": user.email}
+
+    @staticmethod
+    def token_subjects(user: User) -> list[str]:
+        """
+        The token_subjects function returns every subject the tokens of the user can have:
+        the user_id, and the email while email-subject tokens are accepted.
+
+        :param user: The user.
+        :type user: User
+        :return: The subjects.
+        :rtype: list[str]
+        """
+        if settings.accept_email_subject_tokens:
+            return [str(user.user_id), user.email]
+        return [str(user.user_id)]
+
+    async def create_session(self, user: User) -> str:
+        """
+        The create_session function starts a new session of the user and returns its first refresh token.
+        The session lives in the refresh token store, see sessions.RefreshTokenStore, so no database write is needed.
+
+        :param self: Represent the instance of the class.
+        :param user: The user.
+        :type user: User
+        :return: A refresh token with the jti, fam and gen claims of the session.
+        :rtype: str
+        """
+        claims = self.user_claims(user)
+        try:
+            family, jti, generation = await refresh_tokens.start(claims["sub"])
+        except RedisError as e:
+            logger.warning("Redis error in Auth.create_session: %s", e)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Session store unavailable")
+        return await self.create_refresh_token(data={**claims, "jti": jti, "fam": family, "gen": generation})
+
+    async def rotate_session(self, refresh_token: str, db: AsyncSession) -> tuple[dict, str]:
+        """
+        The rotate_session function exchanges a refresh token for the next one of its session.
+        A token can be exchanged only once: using it again ends the session, as does revoking the sessions of the user.
+        A session started with an email subject is replaced by a new one with the user_id subject.
+        A token issued before sessions existed, without a family, is exchanged for a new session only if it is
+        still the refresh token stored for the user in the users table, see users.take_refresh_token.
+
+        :param self: Represent the instance of the class.
+        :param refresh_token: The refresh token sent with the request.
+        :type refresh_token: str
+        :param db: The database session.
+        :type db: AsyncSession
+        :return: The claims identifying the user and the new refresh token.
+        :rtype: tuple[dict, str]
+        """
+        payload = await self.decode_refresh_token(refresh_token)
+        subject, jti, family, generation = (payload.get(claim) for claim in ("sub", "jti", "fam", "gen"))
+        legacy = bool(subject) and not subject.isdigit()
+        if legacy and not settings.accept_email_subject_tokens:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+        # only tokens from before sessions, which all have an email subject, come without a family
+        if legacy and family is None:
+            return await self._redeem_legacy_token(subject, refresh_token, db)
+        if not (subject and jti and family) or generation is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+        try:
+            next_jti = await refresh_tokens.rotate(subject, family, jti, generation)
+            if legacy and next_jti is not None:
+                await refresh_tokens.end(family)
+        except RedisError as e:
+            logger.warning("Redis error in Auth.rotate_session: %s", e)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Session store unavailable")
+        if next_jti is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+        if legacy:
+            user = await repository_users.get_user_by_email(subject, db)
+            if user is None:
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+            return self.user_claims(user), await self.create_session(user)
+        claims = {"sub": subject, "email": payload.get("email")}
+        return claims, await self.create_refresh_token(
+            data={**claims, "jti": next_jti, "fam": family, "gen": generation})
+
+    async def _redeem_legacy_token(self, email: str, refresh_token: str, db: AsyncSession) -> tuple[dict, str]:
+        """
+        The _redeem_legacy_token function exchanges a refresh token from before sessions for a new session.
+        Like the login that issued it, it is refused once the sessions of the user have been revoked.
+        """
+        try:
+            revoked = await refresh_tokens.generation(email)
+        except RedisError as e:
+            logger.warning("Redis error in Auth._redeem_legacy_token: %s", e)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Session store unavailable")
+        user = await repository_users.get_user_by_email(email, db)
+        if revoked or user is None or not await repository_users.take_refresh_token(user, refresh_token, db):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+        return self.user_claims(user), await self.create_session(user)
+
+    async def end_session(self, refresh_token: str) -> None:
+        """
+        The end_session function ends the session of a refresh token, later refreshes of the session fail.
+
+        :param self: Represent the instance of the class.
+        :param refresh_token: A refresh token of the session.
+        :type refresh_token: str
+        :return: None
+        :rtype: None
+        """
+        payload = await self.decode_refresh_token(refresh_token)
+        if payload.get("fam") is None:
+            return
+        try:
+            await refresh_tokens.end(payload["fam"])
+        except RedisError as e:
+            logger.warning("Redis error in Auth.end_session: %s", e)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Session store unavailable")
+
+    async def revoke_sessions(self, user: User) -> None:
+        """
+        The revoke_sessions function ends every session of the user.
+
+        :param self: Represent the instance of the class.
+        :param user: The user.
+        :type user: User
+        :return: None
+        :rtype: None
+        """
+        try:
+            for subject in self.token_subjects(user):
+                await refresh_tokens.revoke_all(subject)
+        except RedisError as e:
+            logger.warning("Redis error in Auth.revoke_sessions: %s", e)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Session store unavailable")
+
+    async def revoke_access_token(self, token: str) -> None:
+        """
+        The revoke_access_token function revokes one access token before its expiry.
+
+        :param self: Represent the instance of the class.
+        :param token: The access token.
+        :type token: str
+        :return: None
+        :rtype: None
+        """
+        try:
+            payload = self.decode_token(token)
+        except JWTError:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                detail='Could not validate credentials')
+        if payload.get('scope') != 'access_token' or not payload.get('jti'):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid scope for token')
+        try:
+            await revocation_list.revoke_token(payload['jti'], payload['exp'])
+        except RedisError as e:
+            logger.warning("Redis error in Auth.revoke_access_token: %s", e)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Session store unavailable")
+
+    async def revoke_access_tokens(self, user: User) -> None:
+        """
+        The revoke_access_tokens function revokes every access token issued to the user so far,
+        e.g. after a password change.
+
+        :param self: Represent the instance of the class.
+        :param user: The user.
+        :type user: User
+        :return: None
+        :rtype: None
+        """
+        try:
+            for subject in self.token_subjects(user):
+                await revocation_list.revoke_user(subject)
+        except RedisError as e:
+            logger.warning("Redis error in Auth.revoke_access_tokens: %s", e)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Session store unavailable")
+
+    async def get_current_user(self, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
         """
         The get_current_user function is a dependency that will be used in the
             UserRouter class. It takes in a token and db session, and returns the user
             associated with that token. If no user is found, it raises an exception.
+            Revoked tokens are refused, see sessions.RevocationList, and while revocations can not be checked
+            every token is refused with 503.
+            The subject of the token is the user_id, the user record is served from the user cache
+            when possible and is otherwise loaded by primary key. Tokens with an email subject are accepted
+            while accept_email_subject_tokens is set.
 
         :param self: Represent the instance of the class.
         :param token: Get the token from the header of our request.
         :type token: str
         :param db: The database session.
-        :type db: Session
+        :type db: AsyncSession
         :return: The user object.
         :rtype: User
         """
@@ -152,20 +443,40 @@ class Auth:
 
         try:
             # Decode JWT
-            payload = jwt.decode(token, self.SECRET_KEY,
-                                 algorithms=[self.ALGORITHM])
+            payload = self.decode_token(token)
             if payload['scope'] == 'access_token':
-                email = payload["sub"]
-                if email is None:
+                subject = payload["sub"]
+                if subject is None:
                     raise credentials_exception
             else:
                 raise credentials_exception
         except JWTError as e:
             raise credentials_exception
+        try:
+            revoked = await revocation_list.is_revoked(payload)
+        except RedisError as e:
+            logger.warning("Redis error in Auth.get_current_user: %s", e)
+            # nothing rules out a revocation, e.g. after a password change, so the token is not accepted
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Session store unavailable")
+        if revoked:
+            raise credentials_exception
 
-        user = await repository_users.get_user_by_email(email, db)
+        if not subject.isdigit():
+            # a token issued before the subject became the user_id
+            if not settings.accept_email_subject_tokens:
+                raise credentials_exception
+            user = await repository_users.get_user_by_email(subject, db)
+            if user is None:
+                raise credentials_exception
+            return user
+        user_id = int(subject)
+        user = await user_cache.get(user_id)
         if user is None:
-            raise credentials_exception
+            user = await repository_users.get_user_by_id(user_id, db)
+            if user is None:
+                raise credentials_exception
+            await user_cache.set(user)
         return user
 
     def create_email_token(self, data: dict) -> str:
@@ -199,8 +510,7 @@ class Auth:
         :rtype: str
         """
         try:
-            payload = jwt.decode(token, self.SECRET_KEY,
-                                 algorithms=[self.ALGORITHM])
+            payload = self.decode_token(token)
             email = payload["sub"]
             return email
         except JWTError as e:
@@ -210,3 +520,9 @@ class Auth:
 
 
 auth_service = Auth()
+
+metrics.register("password_hash_queue_depth", lambda: auth_service.hash_queue_depth)
+metrics.register("token_cache_entries", lambda: len(auth_service.token_cache))
+metrics.register("token_cache_hit_ratio",
+                 lambda: metrics.values["token_cache_hit_total"] /
+                 max(1, metrics.values["token_cache_hit_total"] + metrics.values["token_cache_miss_total"]))
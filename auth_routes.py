@@ -1,8 +1,9 @@
 from fastapi import APIRouter, HTTPException, Depends, status, Security, BackgroundTasks, Request
 from fastapi.security import OAuth2PasswordRequestForm, HTTPAuthorizationCredentials, HTTPBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from my_db import get_db
+from models import User
 from shemas import UserModel, UserResponse, TokenModel, RequestEmail
 import users as repository_users
 from auth import auth_service
@@ -13,7 +14,7 @@ security = HTTPBearer()
 
 
 @router.post("/signup", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def signup(body: UserModel, background_tasks: BackgroundTasks, request: Request, db: Session = Depends(get_db)):
+async def signup(body: UserModel, background_tasks: BackgroundTasks, request: Request, db: AsyncSession = Depends(get_db)):
     """
     The signup function creates a new user in the database.
         It takes a UserModel object as input, which is validated by pydantic.
@@ -28,7 +29,7 @@ async def signup(body: UserModel, background_tasks: BackgroundTasks, request: Re
     :param request: Get the base url of the server.
     :type request: Request
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: A dictionary with two keys: user and detail.
     :rtype: dict
     """
@@ -36,7 +37,7 @@ async def signup(body: UserModel, background_tasks: BackgroundTasks, request: Re
     if exist_user:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail="Account already exists")
-    body.password = auth_service.get_password_hash(body.password)
+    body.password = await auth_service.get_password_hash(body.password)
     new_user = await repository_users.create_user(body, db)
     background_tasks.add_task(
         send_email, new_user.email, new_user.username, request.base_url)
@@ -44,7 +45,7 @@ async def signup(body: UserModel, background_tasks: BackgroundTasks, request: Re
 
 
 @router.post("/login", response_model=TokenModel)
-async def login(body: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(body: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     """
     The login function is used to authenticate a user.
         It takes the username and password from the request body,
@@ -53,7 +54,7 @@ async def login(body: OAuth2PasswordRequestForm = Depends(), db: Session = Depen
     :param body: Get the username and password from the request body.
     :type body: OAuth2PasswordRequestForm
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: The access token and refresh token.
     :rtype: dict   
     """
@@ -64,46 +65,83 @@ async def login(body: OAuth2PasswordRequestForm = Depends(), db: Session = Depen
     if not user.confirmed:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Email not confirmed")
-    if not auth_service.verify_password(body.password, user.password):
+    if not await auth_service.verify_password(body.password, user.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid password")
     # Generate JWT
-    access_token = await auth_service.create_access_token(data={"sub": user.email})
-    refresh_token = await auth_service.create_refresh_token(data={"sub": user.email})
-    await repository_users.update_token(user, refresh_token, db)
+    access_token = await auth_service.create_access_token(data=auth_service.user_claims(user))
+    refresh_token = await auth_service.create_session(user)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
 @router.get('/refresh_token', response_model=TokenModel)
-async def refresh_token(credentials: HTTPAuthorizationCredentials = Security(security), db: Session = Depends(get_db)):
+async def refresh_token(credentials: HTTPAuthorizationCredentials = Security(security), db: AsyncSession = Depends(get_db)):
     """
     The refresh_token function is used to refresh the access token.
         The function takes in a refresh token and returns an access_token, a new refresh_token, and the type of token.
-        If the user's current refresh_token does not match what was passed into this function then it will return an error.
+        Every refresh token can be used once: if it has already been exchanged, its whole session is ended
+        and an error is returned.
 
     :param credentials: Get the token from the request header.
     :type credentials: HTTPAuthorizationCredentials
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: A dictionary with the access_token, refresh_token and token type.
     :rtype: dict
     """
-    token = credentials.credentials
-    email = await auth_service.decode_refresh_token(token)
-    user = await repository_users.get_user_by_email(email, db)
-    if user.refresh_token != token:
-        await repository_users.update_token(user, None, db)
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
-
-    access_token = await auth_service.create_access_token(data={"sub": email})
-    refresh_token = await auth_service.create_refresh_token(data={"sub": email})
-    await repository_users.update_token(user, refresh_token, db)
+    claims, refresh_token = await auth_service.rotate_session(credentials.credentials, db)
+    access_token = await auth_service.create_access_token(data=claims)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
+@router.post('/logout')
+async def logout(credentials: HTTPAuthorizationCredentials = Security(security)):
+    """
+    The logout function ends the session of the refresh token sent in the request header.
+    Other sessions of the user stay valid.
+
+    :param credentials: Get the refresh token from the request header.
+    :type credentials: HTTPAuthorizationCredentials
+    :return: A message to the user.
+    :rtype: dict
+    """
+    await auth_service.end_session(credentials.credentials)
+    return {"message": "Logged out"}
+
+
+@router.post('/revoke_all')
+async def revoke_all(current_user: User = Depends(auth_service.get_current_user)):
+    """
+    The revoke_all function ends every session of the current user, on all devices.
+    Access and refresh tokens issued before the call are refused.
+
+    :param current_user: The user authenticated by the access token.
+    :type current_user: User
+    :return: A message to the user.
+    :rtype: dict
+    """
+    await auth_service.revoke_sessions(current_user)
+    await auth_service.revoke_access_tokens(current_user)
+    return {"message": "All sessions revoked"}
+
+
+@router.post('/revoke_token')
+async def revoke_token(credentials: HTTPAuthorizationCredentials = Security(security)):
+    """
+    The revoke_token function revokes the access token sent in the request header before its expiry,
+    e.g. when the client logs out.
+
+    :param credentials: Get the access token from the request header.
+    :type credentials: HTTPAuthorizationCredentials
+    :return: A message to the user.
+    :rtype: dict
+    """
+    await auth_service.revoke_access_token(credentials.credentials)
+    return {"message": "Token revoked"}
+
+
 @router.get('/confirmed_email/{token}')
-async def confirmed_email(token: str, db: Session = Depends(get_db)):
+async def confirmed_email(token: str, db: AsyncSession = Depends(get_db)):
     """
     The confirmed_email function is used to confirm a user's email address.
         It takes the token from the URL and uses it to get the user's email address.
@@ -115,7 +153,7 @@ async def confirmed_email(token: str, db: Session = Depends(get_db)):
     :param token: Get the token from the url.
     :type token: str
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: A message that the email has been confirmed.
     :rtype: dict   
     """
@@ -132,7 +170,7 @@ async def confirmed_email(token: str, db: Session = Depends(get_db)):
 
 @router.post('/request_email')
 async def request_email(body: RequestEmail, background_tasks: BackgroundTasks, request: Request,
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db)):
     """
     The request_email function is used to send an email to the user with a link that they can click on
     to confirm their email address. The function takes in a RequestEmail object, which contains the
@@ -147,7 +185,7 @@ async def request_email(body: RequestEmail, background_tasks: BackgroundTasks, r
     :param request: Get the base url of the server.
     :type request: Request
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: A message to the user
     :rtype: dict
     """
@@ -0,0 +1,85 @@
+"""
+Compares the per-row cost of the two contact read paths on a list of 10k contacts:
+
+* orm: ORM Contact objects -> ContactResponse validation -> FastAPI's JSON encoding
+* core: plain column rows from SQLAlchemy Core -> orjson
+
+Run from the project root:
+
+    python benchmarks/bench_contacts_read.py [rows] [repeats]
+
+The database is an in-memory SQLite one, so the numbers measure the Python side of the request.
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+from sqlalchemy import select, insert  # noqa: E402
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker  # noqa: E402
+
+from models import Base, User, Contact, birthday_key  # noqa: E402
+from shemas import ContactResponse  # noqa: E402
+from contacts import CONTACT_COLUMNS  # noqa: E402
+
+
+async def fill(session_maker, rows: int) -> None:
+    async with session_maker() as db:
+        user = User(username="bench", email="bench@example.com", password="x")
+        db.add(user)
+        await db.flush()
+        await db.execute(insert(Contact), [
+            dict(first_name=f"First{i}", last_name=f"Last{i % 500}", email=f"contact{i}@example.com",
+                 telephon_number=f"+38050{i:07d}", birthday=date(1990, 1 + i % 12, 1 + i % 28),
+                 birthday_md=birthday_key(date(1990, 1 + i % 12, 1 + i % 28)),
+                 description="x" * 100, user_id=user.user_id)
+            for i in range(rows)])
+        await db.commit()
+
+
+async def orm_path(session_maker) -> bytes:
+    adapter = TypeAdapter(list[ContactResponse])
+    async with session_maker() as db:
+        contacts = await db.execute(select(Contact).order_by(Contact.last_name, Contact.contact_id))
+        contacts = contacts.scalars().all()
+    content = adapter.dump_python(adapter.validate_python(contacts), mode="json")
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+async def core_path(session_maker) -> bytes:
+    async with session_maker() as db:
+        rows = await db.execute(select(*CONTACT_COLUMNS).order_by(Contact.last_name, Contact.contact_id))
+        rows = rows.all()
+    return orjson.dumps([row._asdict() for row in rows])
+
+
+async def main(rows: int, repeats: int) -> None:
+    engine = create_async_engine("sqlite+aiosqlite://")
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await fill(session_maker, rows)
+
+    assert orjson.loads(await orm_path(session_maker)) == orjson.loads(await core_path(session_maker))
+    for name, path in (("orm", orm_path), ("core", core_path)):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            await path(session_maker)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print(f"{name:5} best of {repeats}: {best * 1000:8.1f} ms total, {best / rows * 1e6:6.2f} us/row")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    rows_ = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    repeats_ = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    asyncio.run(main(rows_, repeats_))
@@ -0,0 +1,612 @@
+import hashlib
+import logging
+import math
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Iterable
+
+import orjson
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+from config import settings
+from metrics import metrics
+from models import User
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    A bounded in-process cache. The least recently used entry is evicted when the cache is full,
+    and every entry carries its own expiry time.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict[Any, tuple[Any, float]] = OrderedDict()
+
+    def get(self, key: Any) -> Any | None:
+        """
+        The get function returns the cached value, or None if the key is missing or expired.
+
+        :param key: The cache key.
+        :type key: Any
+        :return: The cached value or None.
+        :rtype: Any | None
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Any, value: Any, expires_at: float) -> None:
+        """
+        The set function stores a value until the expires_at unix timestamp.
+
+        :param key: The cache key.
+        :type key: Any
+        :param value: The value to store.
+        :type value: Any
+        :param expires_at: The unix timestamp after which the entry is dropped.
+        :type expires_at: float
+        :return: None
+        :rtype: None
+        """
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        """
+        The pop function removes the key from the cache if it is there.
+
+        :param key: The cache key.
+        :type key: Any
+        :return: None
+        :rtype: None
+        """
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class BloomFilter:
+    """
+    A fixed-size set of strings that answers "no" exactly and "maybe" with a false positive rate of about error_rate
+    while it holds at most capacity items. Items cannot be removed; build a new filter instead.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str) -> list[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str) -> None:
+        """
+        The add function puts the item into the filter.
+
+        :param item: The item to add.
+        :type item: str
+        :return: None
+        :rtype: None
+        """
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class UserCache:
+    """
+    A short-lived cache of the authenticated user record. Redis is shared by all workers;
+    the optional in-process LRU tier in front of it saves the Redis round trip as well,
+    at the cost of up to local_ttl seconds of staleness in the other workers after an invalidation.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: int, local_size: int = 0, local_ttl: int = 5):
+        self.client = client
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.local = LRUCache(local_size)
+
+    # what the request path reads from the authenticated user; secrets such as the password hash
+    # and bookkeeping columns that change without a user update are never cached
+    COLUMNS = ("user_id", "username", "email", "avatar", "confirmed")
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f"user:{user_id}"
+
+    @classmethod
+    def dumps(cls, user: User) -> bytes:
+        """
+        The dumps function encodes the cached columns of the user as a JSON object.
+        Unlike pickle the format does not depend on the classes of the process that reads it,
+        and only the column values are stored, not the SQLAlchemy state of the object.
+
+        :param user: The user loaded from the database.
+        :type user: User
+        :return: The encoded user.
+        :rtype: bytes
+        """
+        return orjson.dumps({name: getattr(user, name) for name in cls.COLUMNS})
+
+    @classmethod
+    def loads(cls, data: bytes) -> User:
+        """
+        The loads function builds a detached user from the output of dumps.
+        Keys of columns that no longer exist are ignored.
+
+        :param data: The encoded user.
+        :type data: bytes
+        :return: The user.
+        :rtype: User
+        """
+        values = orjson.loads(data)
+        return User(**{name: values[name] for name in cls.COLUMNS if name in values})
+
+    async def get(self, user_id: int) -> User | None:
+        """
+        The get function returns the cached user with the given id, or None on a cache miss.
+
+        :param user_id: The id of the user.
+        :type user_id: int
+        :return: The cached user or None.
+        :rtype: User | None
+        """
+        user = self.local.get(user_id)
+        if user is not None:
+            return user
+        try:
+            data = await self.client.get(self.key(user_id))
+        except RedisError as e:
+            logger.warning("Redis error in UserCache.get: %s", e)
+            return None
+        if data is None:
+            return None
+        user = self.loads(data)
+        self.local.set(user_id, user, time.time() + self.local_ttl)
+        return user
+
+    async def set(self, user: User) -> None:
+        """
+        The set function stores the user for ttl seconds. Both tiers keep the same copy of the cached columns.
+
+        :param user: The user loaded from the database.
+        :type user: User
+        :return: None
+        :rtype: None
+        """
+        data = self.dumps(user)
+        self.local.set(user.user_id, self.loads(data), time.time() + self.local_ttl)
+        try:
+            await self.client.set(self.key(user.user_id), data, ex=self.ttl)
+        except RedisError as e:
+            logger.warning("Redis error in UserCache.set: %s", e)
+
+    async def invalidate(self, user_id: int) -> None:
+        """
+        The invalidate function drops the cached user, it must be called after every change of the user row.
+
+        :param user_id: The id of the user.
+        :type user_id: int
+        :return: None
+        :rtype: None
+        """
+        self.local.pop(user_id)
+        try:
+            await self.client.delete(self.key(user_id))
+        except RedisError as e:
+            logger.warning("Redis error in UserCache.invalidate: %s", e)
+
+
+class SuggestIndex:
+    """
+    A per-user prefix index of contact names and emails for autocomplete.
+    Terms live in a Redis sorted set as "term\\x00contact_id" members with equal scores,
+    so a prefix lookup is a single ZRANGEBYLEX. The display fields of every contact are kept in a hash
+    next to it, together with a ready marker that tells whether the index has been built from the database.
+    Both keys share a TTL that is renewed on every write, so an idle index expires as a whole.
+
+    Writes watch the hash, so the previous terms of a contact are read and replaced in one transaction.
+    A build marks the hash with a random token before it reads the database and only replaces the index
+    if the token is still there: every add or remove clears it, so a build from a snapshot older than
+    a change never overwrites that change.
+    """
+
+    READY = b"_ready"
+    BUILDING = b"_building"
+
+    def __init__(self, client: redis.Redis, ttl: int):
+        self.client = client
+        self.ttl = ttl
+
+    @staticmethod
+    def members(contact_id: Any, first_name: str, last_name: str, email: str) -> list[str]:
+        first_name, last_name = first_name.lower(), last_name.lower()
+        terms = {first_name, last_name, f"{first_name} {last_name}", email.lower()}
+        return [f"{term}\x00{contact_id}" for term in terms]
+
+    @staticmethod
+    def keys(user_id: int) -> tuple[str, str]:
+        return f"suggest:{user_id}", f"suggest:{user_id}:contacts"
+
+    @staticmethod
+    def _entry(contact: Any) -> bytes:
+        return orjson.dumps({"contact_id": contact.contact_id, "first_name": contact.first_name,
+                             "last_name": contact.last_name, "email": contact.email})
+
+    async def _remove_members(self, pipe, user_id: int, contact_ids: list[int]) -> None:
+        # the pipe watches the hash and is still in immediate mode, it is switched to MULTI here
+        terms_key, contacts_key = self.keys(user_id)
+        entries = await pipe.hmget(contacts_key, contact_ids) if contact_ids else []
+        pipe.multi()
+        pipe.hdel(contacts_key, self.BUILDING)
+        for contact_id, entry in zip(contact_ids, entries):
+            if entry is None:
+                continue
+            old = orjson.loads(entry)
+            pipe.zrem(terms_key, *self.members(contact_id, old["first_name"], old["last_name"], old["email"]))
+            pipe.hdel(contacts_key, contact_id)
+
+    async def add(self, user_id: int, contacts: Iterable[Any]) -> None:
+        """
+        The add function indexes new or changed contacts, replacing their previous terms.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :param contacts: Objects or rows with contact_id, first_name, last_name and email.
+        :type contacts: Iterable[Any]
+        :return: None
+        :rtype: None
+        """
+        contacts = list(contacts)
+        terms_key, contacts_key = self.keys(user_id)
+
+        async def replace(pipe) -> None:
+            await self._remove_members(pipe, user_id, [contact.contact_id for contact in contacts])
+            for contact in contacts:
+                pipe.zadd(terms_key, dict.fromkeys(self.members(contact.contact_id, contact.first_name,
+                                                                 contact.last_name, contact.email), 0))
+                pipe.hset(contacts_key, contact.contact_id, self._entry(contact))
+            pipe.expire(terms_key, self.ttl)
+            pipe.expire(contacts_key, self.ttl)
+
+        try:
+            await self.client.transaction(replace, contacts_key)
+        except RedisError as e:
+            logger.warning("Redis error in SuggestIndex.add: %s", e)
+
+    async def remove(self, user_id: int, contact_ids: Iterable[int]) -> None:
+        """
+        The remove function drops deleted contacts from the index.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :param contact_ids: The ids of the deleted contacts.
+        :type contact_ids: Iterable[int]
+        :return: None
+        :rtype: None
+        """
+        contact_ids = list(contact_ids)
+        try:
+            await self.client.transaction(lambda pipe: self._remove_members(pipe, user_id, contact_ids),
+                                          self.keys(user_id)[1])
+        except RedisError as e:
+            logger.warning("Redis error in SuggestIndex.remove: %s", e)
+
+    async def reset(self, user_id: int) -> None:
+        """
+        The reset function drops the whole index of the user, it is rebuilt on the next lookup.
+
+        :param user_id: The owner of the index.
+        :type user_id: int
+        :return: None
+        :rtype: None
+        """
+        try:
+            await self.client.delete(*self.keys(user_id))
+        except RedisError as e:
+            logger.warning("Redis error in SuggestIndex.reset: %s", e)
+
+    async def begin_build(self, user_id: int) -> str | None:
+        """
+        The begin_build function marks the index of the user as being built. It must be called
+        before the contacts are read from the database, and the returned token passed to build.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :return: The build token, or None if Redis is unavailable.
+        :rtype: str | None
+        """
+        token = uuid.uuid4().hex
+        contacts_key = self.keys(user_id)[1]
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.hset(contacts_key, self.BUILDING, token)
+            pipe.expire(contacts_key, self.ttl)
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning("Redis error in SuggestIndex.begin_build: %s", e)
+            return None
+        return token
+
+    async def build(self, user_id: int, contacts: Iterable[Any], token: str) -> bool:
+        """
+        The build function replaces the index of the user with the given contacts and marks it ready,
+        unless the index has changed since begin_build returned the token.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :param contacts: All contacts of the user, read after begin_build.
+        :type contacts: Iterable[Any]
+        :param token: The token returned by begin_build.
+        :type token: str
+        :return: True if the index has been replaced.
+        :rtype: bool
+        """
+        terms_key, contacts_key = self.keys(user_id)
+        members, entries = {}, {self.READY: b"1"}
+        for contact in contacts:
+            members.update(dict.fromkeys(self.members(contact.contact_id, contact.first_name,
+                                                      contact.last_name, contact.email), 0))
+            entries[contact.contact_id] = self._entry(contact)
+
+        async def replace(pipe) -> bool:
+            if await pipe.hget(contacts_key, self.BUILDING) != token.encode():
+                return False
+            pipe.multi()
+            pipe.delete(terms_key, contacts_key)
+            if members:
+                pipe.zadd(terms_key, members)
+            pipe.hset(contacts_key, mapping=entries)
+            pipe.expire(terms_key, self.ttl)
+            pipe.expire(contacts_key, self.ttl)
+            return True
+
+        try:
+            return await self.client.transaction(replace, contacts_key, value_from_callable=True)
+        except RedisError as e:
+            logger.warning("Redis error in SuggestIndex.build: %s", e)
+            return False
+
+    async def suggest(self, user_id: int, prefix: str, limit: int) -> list[dict] | None:
+        """
+        The suggest function returns up to limit contacts with a name or email starting with prefix.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :param prefix: The text typed so far.
+        :type prefix: str
+        :param limit: The maximum number of suggestions.
+        :type limit: int
+        :return: The suggestions, or None if the index is not built yet or Redis is unavailable.
+        :rtype: list[dict] | None
+        """
+        terms_key, contacts_key = self.keys(user_id)
+        prefix = prefix.lower().encode()
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hexists(contacts_key, self.READY)
+            # a contact matches through at most four terms, so 4 * limit members always hold limit contacts
+            pipe.zrangebylex(terms_key, b"[" + prefix, b"[" + prefix + b"\xff", 0, 4 * limit)
+            ready, members = await pipe.execute()
+            if not ready:
+                return None
+            contact_ids = []
+            for member in members:
+                contact_id = member.rsplit(b"\x00", 1)[1]
+                if contact_id not in contact_ids:
+                    contact_ids.append(contact_id)
+                    if len(contact_ids) == limit:
+                        break
+            entries = await self.client.hmget(contacts_key, contact_ids) if contact_ids else []
+        except RedisError as e:
+            logger.warning("Redis error in SuggestIndex.suggest: %s", e)
+            return None
+        return [orjson.loads(entry) for entry in entries if entry is not None]
+
+
+class ResponseCache:
+    """
+    A cache of encoded contact responses, keyed by user, endpoint and query parameters.
+    Every key also holds the current contacts version of the user. A write only has to bump the version
+    to make all cached responses of the user unreachable, they are never served again and expire on their own.
+    A missing version is initialised from the clock, so a version lost with an evicted key is never reused.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: int):
+        self.client = client
+        self.ttl = ttl
+
+    @staticmethod
+    def version_key(user_id: int) -> str:
+        return f"contacts:version:{user_id}"
+
+    @staticmethod
+    def digest(name: str, params: dict) -> str:
+        return hashlib.sha1(name.encode() + orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    @staticmethod
+    def key(user_id: int, version: int, name: str, params: dict) -> str:
+        return f"contacts:response:{user_id}:{version}:{ResponseCache.digest(name, params)}"
+
+    @staticmethod
+    def etag(user_id: int, version: int, name: str, params: dict) -> str:
+        """
+        The etag function returns a strong entity tag of a contact read.
+        It changes with the contacts version of the user, so it can be checked before the response is built.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :param version: The current contacts version of the user.
+        :type version: int
+        :param name: The name of the endpoint.
+        :type name: str
+        :param params: The query parameters that change the response.
+        :type params: dict
+        :return: The quoted entity tag.
+        :rtype: str
+        """
+        return f'"{user_id}-{version}-{ResponseCache.digest(name, params)[:16]}"'
+
+    async def version(self, user_id: int) -> int | None:
+        """
+        The version function returns the current contacts version of the user.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :return: The version, or None if Redis is unavailable.
+        :rtype: int | None
+        """
+        key = self.version_key(user_id)
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.set(key, time.time_ns(), nx=True)
+            pipe.get(key)
+            _, version = await pipe.execute()
+        except RedisError as e:
+            logger.warning("Redis error in ResponseCache.version: %s", e)
+            return None
+        return int(version)
+
+    async def bump(self, user_id: int) -> None:
+        """
+        The bump function moves the user to a new contacts version, it must be called after every change of a contact.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :return: None
+        :rtype: None
+        """
+        key = self.version_key(user_id)
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.set(key, time.time_ns(), nx=True)
+            pipe.incr(key)
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning("Redis error in ResponseCache.bump: %s", e)
+
+    async def get(self, user_id: int, version: int, name: str, params: dict) -> bytes | None:
+        """
+        The get function returns the cached response body for the current version of the user.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :param version: The version returned by the version function.
+        :type version: int
+        :param name: The name of the endpoint.
+        :type name: str
+        :param params: The query parameters that change the response.
+        :type params: dict
+        :return: The cached body, or None on a miss or if Redis is unavailable.
+        :rtype: bytes | None
+        """
+        try:
+            body = await self.client.get(self.key(user_id, version, name, params))
+        except RedisError as e:
+            logger.warning("Redis error in ResponseCache.get: %s", e)
+            return None
+        metrics.inc("response_cache_hit_total" if body is not None else "response_cache_miss_total")
+        return body
+
+    async def set(self, user_id: int, version: int, name: str, params: dict, body: bytes) -> None:
+        """
+        The set function stores a response body for ttl seconds under the version it was built for.
+
+        :param user_id: The owner of the contacts.
+        :type user_id: int
+        :param version: The version read before the response was built.
+        :type version: int
+        :param name: The name of the endpoint.
+        :type name: str
+        :param params: The query parameters that change the response.
+        :type params: dict
+        :param body: The encoded response.
+        :type body: bytes
+        :return: None
+        :rtype: None
+        """
+        try:
+            await self.client.set(self.key(user_id, version, name, params), body, ex=self.ttl)
+        except RedisError as e:
+            logger.warning("Redis error in ResponseCache.set: %s", e)
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """
+    A pipeline that reports the round trip of execute as one Redis command, see InstrumentedRedis.
+    """
+
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        except RedisError:
+            metrics.inc("redis_command_errors_total")
+            raise
+        finally:
+            metrics.observe("redis_command_seconds", time.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    An asyncio Redis client that records the count and the total time of its commands
+    as the redis_command_seconds metric, and failed commands as redis_command_errors_total.
+    """
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        except RedisError:
+            metrics.inc("redis_command_errors_total")
+            raise
+        finally:
+            metrics.observe("redis_command_seconds", time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Any = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+# One pool is shared by the caches, the auth service and the rate limiter of the process.
+# Connections are opened on first use, so the pool binds to the event loop of the application.
+redis_pool = redis.ConnectionPool(host=settings.redis_host, port=settings.redis_port, db=0,
+                                  max_connections=settings.redis_max_connections)
+
+redis_client = InstrumentedRedis(connection_pool=redis_pool)
+
+metrics.register("redis_pool_max_connections", lambda: redis_pool.max_connections)
+metrics.register("redis_pool_in_use_connections", lambda: len(redis_pool._in_use_connections))
+metrics.register("redis_pool_idle_connections", lambda: len(redis_pool._available_connections))
+
+user_cache = UserCache(redis_client, settings.user_cache_ttl,
+                       settings.user_cache_local_size, settings.user_cache_local_ttl)
+
+suggest_index = SuggestIndex(redis_client, settings.suggest_index_ttl)
+
+response_cache = ResponseCache(redis_client, settings.response_cache_ttl)
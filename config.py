@@ -23,6 +23,25 @@ class Settings(BaseSettings):
     validate_certs: bool
     redis_host: str
     redis_port: int
+    redis_max_connections: int = 50
+    access_token_ttl: int = 900
+    refresh_token_ttl: int = 604800
+    token_cache_size: int = 10000
+    accept_email_subject_tokens: bool = True
+    revocation_bloom_capacity: int = 100000
+    revocation_bloom_error_rate: float = 0.001
+    revocation_rebuild_interval: int = 300
+    user_cache_ttl: int = 300
+    user_cache_local_size: int = 0
+    user_cache_local_ttl: int = 5
+    suggest_index_ttl: int = 86400
+    response_cache_ttl: int = 300
+    phone_country_code: str = "380"
+    password_hash_executor: str = "thread"
+    password_hash_workers: int = 2
+    # the bearer token of the monitoring system, /api/metrics is not served without one
+    metrics_token: str | None = None
+    password_hash_max_queue: int = 100
     cloudinary_name: str
     cloudinary_api_key: str
     cloudinary_api_secret: str
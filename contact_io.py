@@ -0,0 +1,162 @@
+import csv
+import io
+import json
+from typing import BinaryIO, Iterator, Tuple, List
+
+import orjson
+from pydantic import ValidationError
+from sqlalchemy import Row
+
+from shemas import ContactSchema, ContactResponse
+
+
+FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "ndjson": ("application/x-ndjson", ".ndjson"),
+}
+
+
+def detect_format(filename: str | None, content_type: str | None) -> str | None:
+    """
+    The detect_format function picks the import format from the content type or the file extension of an upload.
+
+    :param filename: The name of the uploaded file.
+    :type filename: str | None
+    :param content_type: The content type of the uploaded file.
+    :type content_type: str | None
+    :return: csv, ndjson or None if the format is not supported.
+    :rtype: str | None
+    """
+    for fmt, (media_type, extension) in FORMATS.items():
+        if content_type == media_type or (filename or "").lower().endswith(extension):
+            return fmt
+    return None
+
+
+def _iter_csv(text: io.TextIOBase) -> Iterator[Tuple[int, dict | None, str | None]]:
+    reader = csv.DictReader(text)
+    line_num = 1
+    for row in reader:
+        # DictReader puts surplus values of a row under the None key
+        row.pop(None, None)
+        yield line_num + 1, row, None
+        line_num = reader.line_num
+
+
+def _iter_ndjson(text: io.TextIOBase) -> Iterator[Tuple[int, dict | None, str | None]]:
+    for line_num, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_num, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield line_num, None, "Expected a JSON object"
+            continue
+        yield line_num, row, None
+
+
+def read_contacts(file: BinaryIO, fmt: str) -> Iterator[Tuple[int, ContactSchema | None, str | None]]:
+    """
+    The read_contacts function reads an uploaded CSV or NDJSON file row by row and validates every row with ContactSchema.
+    Only one row is held in memory at a time.
+
+    :param file: The uploaded file opened in binary mode.
+    :type file: BinaryIO
+    :param fmt: The format returned by detect_format.
+    :type fmt: str
+    :return: Tuples of line number, validated contact or None, and the error message or None.
+    :rtype: Iterator[Tuple[int, ContactSchema | None, str | None]]
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        rows = _iter_csv(text) if fmt == "csv" else _iter_ndjson(text)
+        for line_num, row, error in rows:
+            if error:
+                yield line_num, None, error
+                continue
+            try:
+                yield line_num, ContactSchema.model_validate(row), None
+            except ValidationError as e:
+                yield line_num, None, "; ".join(
+                    f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+    except UnicodeDecodeError as e:
+        yield 0, None, f"File is not valid UTF-8: {e}"
+    finally:
+        text.detach()
+
+
+EXPORT_FIELDS = list(ContactResponse.model_fields)
+
+
+def _vcard_escape(value: str) -> str:
+    return (value.replace("\\", "\\\\").replace(",", "\\,").replace(";", "\\;")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def encode_ndjson(rows: List[Row]) -> bytes:
+    """
+    The encode_ndjson function encodes rows as JSON objects, one per line.
+
+    :param rows: Rows with the ContactResponse columns.
+    :type rows: List[Row]
+    :return: The encoded rows.
+    :rtype: bytes
+    """
+    return b"".join(orjson.dumps(row._asdict()) + b"\n" for row in rows)
+
+
+def encode_csv(rows: List[Row]) -> bytes:
+    """
+    The encode_csv function encodes rows as CSV lines, in the column order of csv_header.
+
+    :param rows: Rows with the ContactResponse columns.
+    :type rows: List[Row]
+    :return: The encoded rows.
+    :rtype: bytes
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def csv_header() -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(EXPORT_FIELDS)
+    return buffer.getvalue().encode()
+
+
+def encode_vcard(rows: List[Row]) -> bytes:
+    """
+    The encode_vcard function encodes rows as vCard 3.0 entries.
+
+    :param rows: Rows with the ContactResponse columns.
+    :type rows: List[Row]
+    :return: The encoded rows.
+    :rtype: bytes
+    """
+    cards = []
+    for row in rows:
+        first_name, last_name = _vcard_escape(row.first_name), _vcard_escape(row.last_name)
+        cards.append("\r\n".join([
+            "BEGIN:VCARD",
+            "VERSION:3.0",
+            f"UID:{row.contact_id}",
+            f"N:{last_name};{first_name};;;",
+            f"FN:{first_name} {last_name}",
+            f"EMAIL:{_vcard_escape(row.email)}",
+            f"TEL:{_vcard_escape(row.telephon_number)}",
+            f"BDAY:{row.birthday.isoformat()}",
+            f"NOTE:{_vcard_escape(row.description or '')}",
+            "END:VCARD",
+        ]) + "\r\n")
+    return "".join(cards).encode()
+
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", b"", encode_ndjson),
+    "csv": ("text/csv", csv_header(), encode_csv),
+    "vcard": ("text/vcard", b"", encode_vcard),
+}
@@ -1,40 +1,355 @@
-from sqlalchemy import or_, and_
-from models import Contact, User
-from typing import List
-from sqlalchemy.orm import Session
-from shemas import ContactSchema
-from datetime import datetime
+from sqlalchemy import or_, and_, select, update, delete, tuple_, case, func, cast, literal_column, table, column, \
+    Select, Row, Date
+from sqlalchemy.dialects import postgresql, sqlite
+from models import Contact, ContactChange, ContactSequence, User, birthday_key, derived_columns
+from typing import List, Tuple, Iterable, AsyncIterator
+from sqlalchemy.ext.asyncio import AsyncSession
+from shemas import ContactSchema, ContactResponse, ContactUpdateSchema
+from cache import suggest_index, response_cache, SuggestIndex
+from dedup import find_clusters
+from datetime import date, datetime, timedelta
+from calendar import isleap
+from itertools import islice
+import asyncio
+import base64
+import json
+import re
 
 
-async def get_contacts(contact_field: str, user: User, db: Session) -> List[Contact] | Contact:
+CONTACT_COLUMNS = [getattr(Contact, field) for field in ContactResponse.model_fields]
+SUGGEST_COLUMNS = [Contact.contact_id, Contact.first_name, Contact.last_name, Contact.email]
+
+
+def parse_fields(fields: str | None) -> List[str] | None:
+    """
+    The parse_fields function validates a comma-separated list of ContactResponse fields.
+    The result is deduplicated and in ContactResponse order, so equivalent lists give equal results.
+
+    :param fields: The fields requested by the client, e.g. "contact_id,first_name,last_name".
+    :type fields: str | None
+    :return: The field names, or None if all fields are requested.
+    :rtype: List[str] | None
+    :raises ValueError: If a field is not a ContactResponse field, the message lists the unknown fields.
+    """
+    if not fields:
+        return None
+    names = {name.strip() for name in fields.split(',') if name.strip()}
+    unknown = names - ContactResponse.model_fields.keys()
+    if unknown:
+        raise ValueError(', '.join(sorted(unknown)))
+    return [name for name in ContactResponse.model_fields if name in names] or None
+
+
+def _columns(fields: List[str] | None, *required: str) -> list:
+    """
+    The _columns function returns the columns to select for the requested fields,
+    plus the required ones the query needs itself, e.g. for the keyset cursor.
+    """
+    if fields is None:
+        return CONTACT_COLUMNS
+    return [getattr(Contact, name) for name in dict.fromkeys([*fields, *required])]
+
+
+def encode_cursor(contact: Contact | Row) -> str:
+    """
+    The encode_cursor function builds an opaque pagination cursor from the last contact of a page.
+    The cursor holds the (last_name, contact_id) pair the next page has to start after.
+
+    :param contact: The last contact of the current page.
+    :type contact: Contact | Row
+    :return: The urlsafe base64 cursor.
+    :rtype: str
+    """
+    raw = json.dumps([contact.last_name, contact.contact_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """
+    The decode_cursor function restores the (last_name, contact_id) pair from a cursor built by encode_cursor.
+
+    :param cursor: The cursor received from the client.
+    :type cursor: str
+    :return: The last_name and contact_id of the last contact of the previous page.
+    :rtype: Tuple[str, int]
+    :raises ValueError: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        last_name, contact_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(last_name, str) or not isinstance(contact_id, int):
+        raise ValueError('Invalid cursor')
+    return last_name, contact_id
+
+
+def _filter_contacts(query: Select, user: User, contact_field: str | None = None) -> Select:
+    """
+    The _filter_contacts function restricts a query to the contacts of the user,
+    optionally matching contact_field against the first name, last name or email.
+    """
+    query = query.filter(Contact.user_id == user.user_id)
+    if contact_field:
+        query = query.filter(or_(
+            Contact.first_name == contact_field,
+            Contact.last_name == contact_field,
+            Contact.email == contact_field))
+    return query
+
+
+async def get_contacts(contact_field: str, user: User, db: AsyncSession, limit: int = 50,
+                       cursor: str | None = None, fields: List[str] | None = None) -> Tuple[List[Row], str | None]:
     """
-    Retrieves a list of contacts for a specific user with specified search parameters.
+    Retrieves a page of contacts for a specific user with specified search parameters.
+    Contacts are ordered by (last_name, contact_id) and paginated with a keyset cursor,
+    so every page costs the same regardless of the size of the address book.
+    Rows are plain tuples of the ContactResponse columns, no ORM objects are built.
         Args:
             contact_field (str): The parameter for search of the desired Contact.
             user (User): The User who owns the desired Contact.
+            limit (int): The maximum number of contacts on the page.
+            cursor (str): The next_cursor returned with the previous page.
+            fields (List[str]): The columns to select, see parse_fields.
 
     :param contact_field: contact field by which we search.
     :type contact_field: str
     :param user: The user to retrieve contacts for.
     :type user: User
     :param db: The database session.
-    :type db: Session
-    :return: A list of contacts.
-    :rtype: List[Contact] | Contact
+    :type db: AsyncSession
+    :param limit: The maximum number of contacts to return.
+    :type limit: int
+    :param cursor: The cursor of the previous page, or None for the first page.
+    :type cursor: str | None
+    :param fields: The fields to select, or None for all. last_name and contact_id are always selected for the cursor.
+    :type fields: List[str] | None
+    :return: A list of contact rows and the cursor of the next page, or None if this is the last page.
+    :rtype: Tuple[List[Row], str | None]
+    :raises ValueError: If the cursor is malformed.
+    """
+    query = _filter_contacts(select(*_columns(fields, 'last_name', 'contact_id')), user, contact_field)
+    if cursor:
+        query = query.filter(tuple_(Contact.last_name, Contact.contact_id) > tuple_(*decode_cursor(cursor)))
+    query = query.order_by(Contact.last_name, Contact.contact_id).limit(limit + 1)
+    contacts = await db.execute(query)
+    contacts = contacts.all()
+    next_cursor = None
+    if len(contacts) > limit:
+        contacts = contacts[:limit]
+        next_cursor = encode_cursor(contacts[-1])
+    return contacts, next_cursor
+
+
+def search_terms(query: str) -> List[str]:
+    """
+    The search_terms function splits a search query into lowercase word terms.
+    Anything that is not a letter, digit or underscore separates terms, so the result is safe
+    to use in tsquery and FTS5 MATCH expressions.
+
+    :param query: The text typed by the user.
+    :type query: str
+    :return: The search terms.
+    :rtype: List[str]
+    """
+    return re.findall(r"\w+", query.lower())
+
+
+async def search_contacts(query: str, user: User, db: AsyncSession, limit: int = 20, offset: int = 0,
+                          fields: List[str] | None = None) -> List[Row]:
+    """
+    Searches the contacts of a specific user by names, email, phone and description.
+    Every term matches as a prefix ("joh" finds "John") and all terms must match. Results are ranked by relevance.
+    Postgres uses the GIN-indexed search_vector column, SQLite the contacts_fts FTS5 table.
+        Args:
+            query (str): The text typed by the user.
+            user (User): The User who owns the contacts.
+
+    :param query: The search text.
+    :type query: str
+    :param user: The user to search contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :param limit: The maximum number of contacts to return.
+    :type limit: int
+    :param offset: The number of best matches to skip.
+    :type offset: int
+    :param fields: The fields to select, or None for all.
+    :type fields: List[str] | None
+    :return: A list of contact rows, best match first.
+    :rtype: List[Row]
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    if db.get_bind().dialect.name == 'postgresql':
+        search_vector = literal_column('contacts.search_vector')
+        ts_query = func.to_tsquery('simple', ' & '.join(f"{term}:*" for term in terms))
+        stmt = select(*_columns(fields)).filter(
+            Contact.user_id == user.user_id, search_vector.op('@@')(ts_query))
+        stmt = stmt.order_by(func.ts_rank(search_vector, ts_query).desc(), Contact.contact_id)
+    else:
+        contacts_fts = table('contacts_fts', column('rowid'), column('rank'))
+        stmt = select(*_columns(fields)).join(contacts_fts, contacts_fts.c.rowid == Contact.contact_id).filter(
+            Contact.user_id == user.user_id,
+            literal_column('contacts_fts').op('MATCH')(' '.join(f'"{term}"*' for term in terms)))
+        stmt = stmt.order_by(contacts_fts.c.rank, Contact.contact_id)
+    contacts = await db.execute(stmt.limit(limit).offset(offset))
+    return contacts.all()
+
+
+async def suggest_contacts(query: str, user: User, db: AsyncSession, limit: int = 10) -> List[dict]:
+    """
+    Autocompletes a contact name or email of a specific user from the prefix index in Redis.
+    The index is built from the database on the first lookup and kept up to date by every change of a contact,
+    so a lookup normally does not touch the database. If Redis is unavailable the contacts are matched in memory.
+        Args:
+            query (str): The text typed so far.
+            user (User): The User who owns the contacts.
+
+    :param query: The prefix of a first name, last name, "first last" or email.
+    :type query: str
+    :param user: The user to suggest contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :param limit: The maximum number of suggestions.
+    :type limit: int
+    :return: Contact ids, names and emails ordered by the matching term.
+    :rtype: List[dict]
     """
-    if not contact_field:
-        contacts = db.query(Contact).filter(
-            Contact.user_id == user.user_id).all()
-        return contacts
-    contact = db.query(Contact).filter(and_(Contact.user_id == user.user_id, or_(
-        Contact.first_name == contact_field,
-        Contact.last_name == contact_field,
-        Contact.email == contact_field))).all()
-    if contact:
-        return contact
+    suggestions = await suggest_index.suggest(user.user_id, query, limit)
+    if suggestions is not None:
+        return suggestions
+    token = await suggest_index.begin_build(user.user_id)
+    rows = await db.execute(select(*SUGGEST_COLUMNS).filter(Contact.user_id == user.user_id))
+    rows = rows.all()
+    if token is not None:
+        await suggest_index.build(user.user_id, rows, token)
+    suggestions = await suggest_index.suggest(user.user_id, query, limit)
+    if suggestions is not None:
+        return suggestions
+    prefix = query.lower()
+    matches = []
+    for row in rows:
+        terms = [m for m in SuggestIndex.members(*row) if m.startswith(prefix)]
+        if terms:
+            matches.append((min(terms), row))
+    matches.sort(key=lambda match: match[0])
+    return [row._asdict() for _, row in matches[:limit]]
 
 
-async def get_contact(contact_id: int, user: User, db: Session) -> Contact | None:
+async def stream_contacts(contact_field: str | None, user: User, db: AsyncSession,
+                          chunk_size: int = 500) -> AsyncIterator[List[Row]]:
+    """
+    Streams the contacts of a specific user with a server-side cursor, chunk_size rows at a time.
+    Rows are plain column tuples, no ORM objects are built, so memory use does not depend on the size of the address book.
+        Args:
+            contact_field (str): The parameter for search of the desired Contact.
+            user (User): The User who owns the contacts.
+
+    :param contact_field: contact field by which we search.
+    :type contact_field: str | None
+    :param user: The user to export contacts for.
+    :type user: User
+    :param db: The database session, it must stay open until the iteration ends.
+    :type db: AsyncSession
+    :param chunk_size: The number of rows fetched per round trip.
+    :type chunk_size: int
+    :return: Lists of rows with the ContactResponse columns.
+    :rtype: AsyncIterator[List[Row]]
+    """
+    query = _filter_contacts(select(*CONTACT_COLUMNS), user, contact_field)
+    query = query.order_by(Contact.last_name, Contact.contact_id).execution_options(yield_per=chunk_size)
+    result = await db.stream(query)
+    async for rows in result.partitions():
+        yield rows
+
+
+def encode_sync_token(seq: int, contact_id: int) -> str:
+    """
+    The encode_sync_token function builds an opaque delta sync token from the last change returned to the client.
+
+    :param seq: The sequence number of the last change.
+    :type seq: int
+    :param contact_id: The contact of the last change.
+    :type contact_id: int
+    :return: The urlsafe base64 token.
+    :rtype: str
+    """
+    raw = json.dumps([seq, contact_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_sync_token(token: str) -> Tuple[int, int]:
+    """
+    The decode_sync_token function restores the (seq, contact_id) pair from a token built by encode_sync_token.
+
+    :param token: The token received from the client.
+    :type token: str
+    :return: The sequence number and contact of the last change the client has seen.
+    :rtype: Tuple[int, int]
+    :raises ValueError: If the token is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        seq, contact_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError('Invalid sync token') from e
+    if not isinstance(seq, int) or not isinstance(contact_id, int):
+        raise ValueError('Invalid sync token')
+    return seq, contact_id
+
+
+async def get_changes(user: User, db: AsyncSession, since: str | None = None, limit: int = 500) -> dict:
+    """
+    Returns the contacts of a specific user changed or deleted after a sync token, oldest change first.
+    Without a token every contact is returned, which is the initial sync. Only changes are read,
+    through the (user_id, seq, contact_id) index, so a sync costs as many rows as there are changes.
+        Args:
+            user (User): The User who owns the contacts.
+            since (str): The next_since token of the previous sync.
+            limit (int): The maximum number of changes to return.
+
+    :param user: The user to sync contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :param since: The token of the previous sync, or None for a full sync.
+    :type since: str | None
+    :param limit: The maximum number of changes to return.
+    :type limit: int
+    :return: The changed contacts, the ids of deleted contacts, the token of the next sync
+        and whether more changes are waiting.
+    :rtype: dict
+    :raises ValueError: If the token is malformed.
+    """
+    query = select(ContactChange.seq, ContactChange.contact_id.label('changed_id'), ContactChange.deleted,
+                   *CONTACT_COLUMNS).outerjoin(
+        Contact, and_(Contact.contact_id == ContactChange.contact_id, Contact.user_id == ContactChange.user_id))
+    query = query.filter(ContactChange.user_id == user.user_id)
+    if since:
+        query = query.filter(tuple_(ContactChange.seq, ContactChange.contact_id) > tuple_(*decode_sync_token(since)))
+    else:
+        query = query.filter(ContactChange.deleted.is_(False))
+    query = query.order_by(ContactChange.seq, ContactChange.contact_id).limit(limit + 1)
+    rows = await db.execute(query)
+    rows = rows.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    changes = {"changed": [], "deleted": [], "next_since": since, "has_more": has_more}
+    for row in rows:
+        if row.deleted or row.contact_id is None:
+            changes["deleted"].append(row.changed_id)
+        else:
+            changes["changed"].append({field: getattr(row, field) for field in ContactResponse.model_fields})
+    if rows:
+        changes["next_since"] = encode_sync_token(rows[-1].seq, rows[-1].changed_id)
+    return changes
+
+
+async def get_contact(contact_id: int, user: User, db: AsyncSession) -> Contact | None:
     """
     Retrieves a single contact with the specified ID for a specific user.
         Args:
@@ -46,16 +361,43 @@ async def get_contact(contact_id: int, user: User, db: Session) -> Contact | Non
     :param user: The user to retrieve the contact for.
     :type user: User
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: The contact with the specified ID, or None if it does not exist.
     :rtype: Contact | None
     """
-    contact = db.query(Contact).filter(
-        and_(Contact.user_id == user.user_id, Contact.contact_id == contact_id)).first()
+    query = select(Contact).filter(
+        and_(Contact.user_id == user.user_id, Contact.contact_id == contact_id))
+    contact = await db.execute(query)
+    contact = contact.scalar_one_or_none()
     return contact
 
 
-async def create_contact(body: ContactSchema, user: User, db: Session) -> Contact:
+async def get_contacts_by_ids(contact_ids: List[int], user: User, db: AsyncSession,
+                              fields: List[str] | None = None) -> List[Row]:
+    """
+    Retrieves the contacts with the specified IDs for a specific user in one query.
+    IDs of contacts that do not exist or belong to another user are simply not returned.
+        Args:
+            contact_ids (List[int]): The ids of the desired Contacts.
+            user (User): The User who owns the desired Contacts.
+
+    :param contact_ids: The IDs of the contacts to retrieve.
+    :type contact_ids: List[int]
+    :param user: The user to retrieve the contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :param fields: The fields to select, or None for all. contact_id is always selected.
+    :type fields: List[str] | None
+    :return: A list of contact rows, in no particular order.
+    :rtype: List[Row]
+    """
+    contacts = await db.execute(select(*_columns(fields, 'contact_id')).filter(
+        Contact.user_id == user.user_id, Contact.contact_id.in_(contact_ids)))
+    return contacts.all()
+
+
+async def create_contact(body: ContactSchema, user: User, db: AsyncSession) -> Contact:
     """
     Creates a new contact in the database for a specific user.
         Args:
@@ -67,21 +409,24 @@ async def create_contact(body: ContactSchema, user: User, db: Session) -> Contac
     :param user: The user to create the contact for.
     :type user: User
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: The contact object.
     :rtype: Contact
     """
     contact = Contact(**body.model_dump(exclude_unset=True),
                       user_id=user.user_id)
     db.add(contact)
-    db.commit()
-    db.refresh(contact)
+    await db.flush()
+    await _log_changes([contact.contact_id], user, db)
+    await db.commit()
+    await db.refresh(contact)
+    await _after_write(user, changed=[contact])
     return contact
 
 
-async def update_contact(contact_id: int, body: ContactSchema, user: User, db: Session) -> Contact | None:
+async def update_contact(contact_id: int, body: ContactSchema, user: User, db: AsyncSession) -> Contact | None:
     """
-    Updates a single contact with the specified ID for a specific user.
+    Updates a single contact with the specified ID for a specific user in one UPDATE ... RETURNING round trip.
         Args:        
             contact_id (int): The id of the contact to update.
             body (ContactModel): The updated contact information.
@@ -94,27 +439,61 @@ async def update_contact(contact_id: int, body: ContactSchema, user: User, db: S
     :param user: The user to update the contact for.
     :type user: User
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: The updated contact, or None if it does not exist.
     :rtype: Contact | None
     """
-    contact = db.query(Contact).filter(
-        and_(Contact.user_id == user.user_id, Contact.contact_id == contact_id)).first()
-    if contact:
-        contact.first_name = body.first_name
-        contact.last_name = body.last_name
-        contact.email = body.email
-        contact.telephon_number = body.telephon_number
-        contact.birthday = body.birthday
-        contact.description = body.description
-        db.commit()
-        db.refresh(contact)
+    return await _update_contact(contact_id, body.model_dump(), user, db)
+
+
+async def patch_contact(contact_id: int, body: ContactUpdateSchema, user: User, db: AsyncSession) -> Contact | None:
+    """
+    Updates only the supplied fields of a single contact with the specified ID for a specific user.
+        Args:
+            contact_id (int): The id of the contact to update.
+            body (ContactUpdateSchema): The fields to change.
+            user (User): The current user, used for authorization purposes.
+
+    :param contact_id: The ID of the contact to update.
+    :type contact_id: int
+    :param body: The fields to change, fields that are not set keep their values.
+    :type body: ContactUpdateSchema
+    :param user: The user to update the contact for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :return: The updated contact, or None if it does not exist.
+    :rtype: Contact | None
+    """
+    values = body.model_dump(exclude_unset=True, exclude_none=True)
+    if not values:
+        return await get_contact(contact_id, user, db)
+    return await _update_contact(contact_id, values, user, db)
+
+
+async def _update_contact(contact_id: int, values: dict, user: User, db: AsyncSession) -> Contact | None:
+    """
+    The _update_contact function changes a contact of the user with a single UPDATE ... RETURNING statement.
+    """
+    values.update(derived_columns(values))
+    contact = await db.execute(
+        update(Contact)
+        .where(Contact.user_id == user.user_id, Contact.contact_id == contact_id)
+        .values(**values)
+        .returning(Contact)
+        .execution_options(synchronize_session=False, populate_existing=True))
+    contact = contact.scalar_one_or_none()
+    if contact is not None:
+        await _log_changes([contact_id], user, db)
+    await db.commit()
+    if contact is not None:
+        await _after_write(user, changed=[contact])
     return contact
 
 
-async def delete_contact(contact_id: int, user: User, db: Session) -> Contact | None:
+async def delete_contact(contact_id: int, user: User, db: AsyncSession) -> Contact | None:
     """
-    Removes a single contact with the specified ID for a specific user.
+    Removes a single contact with the specified ID for a specific user in one DELETE ... RETURNING round trip.
         Args:
             contact_id (int): The id of the contact to be removed.
             user (User): The user who is removing the contact. This is used to ensure that only contacts belonging to this
@@ -125,37 +504,407 @@ async def delete_contact(contact_id: int, user: User, db: Session) -> Contact |
     :param user: The user to remove the contact for.
     :type user: User
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: The removed contact, or None if it does not exist.
     :rtype: Contact | None
     """
-    contact = db.query(Contact).filter(
-        and_(Contact.user_id == user.user_id, Contact.contact_id == contact_id)).first()
-    if contact:
-        db.delete(contact)
-        db.commit()
+    contact = await db.execute(
+        delete(Contact)
+        .where(Contact.user_id == user.user_id, Contact.contact_id == contact_id)
+        .returning(Contact)
+        .execution_options(synchronize_session=False))
+    contact = contact.scalar_one_or_none()
+    if contact is not None:
+        await _log_changes([contact_id], user, db, deleted=True)
+    await db.commit()
+    if contact is not None:
+        await _after_write(user, deleted=[contact_id])
     return contact
 
 
-async def get_contacts_birthdays(user: User, db: Session) -> List[Contact]:
+async def delete_contacts(contact_ids: List[int], user: User, db: AsyncSession) -> List[int]:
+    """
+    Removes the contacts with the specified IDs for a specific user in one DELETE ... RETURNING round trip.
+        Args:
+            contact_ids (List[int]): The ids of the contacts to be removed.
+            user (User): The user who is removing the contacts, only their contacts are deleted.
+
+    :param contact_ids: The IDs of the contacts to remove.
+    :type contact_ids: List[int]
+    :param user: The user to remove the contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :return: The IDs of the removed contacts.
+    :rtype: List[int]
+    """
+    deleted = await db.execute(
+        delete(Contact)
+        .where(Contact.user_id == user.user_id, Contact.contact_id.in_(contact_ids))
+        .returning(Contact.contact_id)
+        .execution_options(synchronize_session=False))
+    deleted = deleted.scalars().all()
+    if deleted:
+        await _log_changes(deleted, user, db, deleted=True)
+    await db.commit()
+    if deleted:
+        await _after_write(user, deleted=deleted)
+    return deleted
+
+
+async def upsert_contacts(bodies: List[ContactSchema], user: User, db: AsyncSession) -> List[Row]:
+    """
+    Creates or updates contacts of a specific user keyed by email, in one INSERT ... ON CONFLICT DO UPDATE statement.
+    A contact whose email belongs to another user is left untouched and not returned.
+    If the same email is sent more than once, the last one wins.
+        Args:
+            bodies (List[ContactSchema]): The contacts to create or update.
+            user (User): The owner of the contacts.
+
+    :param bodies: The contacts to create or update.
+    :type bodies: List[ContactSchema]
+    :param user: The user to upsert the contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :return: Rows of the created or updated contacts.
+    :rtype: List[Row]
+    :raises IntegrityError: If a telephone number belongs to another contact.
+    """
+    bodies = {body.email: body for body in bodies}.values()
+    values = [_contact_values(body, user) for body in bodies]
+    stmt = _insert(db)(Contact).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Contact.email],
+        set_={field: stmt.excluded[field] for field in values[0] if field not in ('email', 'user_id')},
+        where=Contact.user_id == stmt.excluded.user_id)
+    upserted = await db.execute(stmt.returning(*CONTACT_COLUMNS))
+    upserted = upserted.all()
+    if upserted:
+        await _log_changes([row.contact_id for row in upserted], user, db)
+    await db.commit()
+    if upserted:
+        await _after_write(user, changed=upserted)
+    return upserted
+
+
+async def find_duplicates(user: User, db: AsyncSession, window: int = 5, threshold: float = 0.9) -> List[List[Row]]:
+    """
+    Finds clusters of contacts of a specific user that probably describe the same person.
+    Contacts are linked by the same normalized email or phone number, or by similar names
+    (sorted neighbourhood over "last first" and "first last"), see dedup.find_clusters.
+    The matching runs in a worker thread, so a large address book does not block the event loop.
+        Args:
+            user (User): The User who owns the contacts.
+            window (int): The window of the sorted neighbourhood name comparison.
+            threshold (float): The minimal name similarity, from 0 to 1.
+
+    :param user: The user to deduplicate contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :param window: The window of the sorted neighbourhood name comparison.
+    :type window: int
+    :param threshold: The minimal name similarity.
+    :type threshold: float
+    :return: Clusters of two or more contact rows, largest first.
+    :rtype: List[List[Row]]
+    """
+    rows = await db.execute(select(*CONTACT_COLUMNS, Contact.email_normalized, Contact.phone_normalized)
+                            .filter(Contact.user_id == user.user_id))
+    rows = rows.all()
+    return await asyncio.to_thread(
+        find_clusters, rows,
+        blocking_keys=[lambda row: row.email_normalized, lambda row: row.phone_normalized],
+        name_keys=[lambda row: f"{row.last_name} {row.first_name}".lower(),
+                   lambda row: f"{row.first_name} {row.last_name}".lower()],
+        window=window, threshold=threshold)
+
+
+async def merge_contacts(target_id: int, source_ids: List[int], user: User, db: AsyncSession) -> Contact | None:
+    """
+    Merges duplicate contacts of a specific user into one: the target keeps its fields,
+    the distinct descriptions of all contacts are joined into its description and the sources are deleted.
+        Args:
+            target_id (int): The id of the Contact to keep.
+            source_ids (List[int]): The ids of the duplicates to merge into it.
+            user (User): The User who owns the contacts.
+
+    :param target_id: The ID of the contact to keep.
+    :type target_id: int
+    :param source_ids: The IDs of the contacts to merge into the target and remove.
+    :type source_ids: List[int]
+    :param user: The user to merge the contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :return: The merged contact, or None if any of the contacts does not exist.
+    :rtype: Contact | None
+    :raises ValueError: If there is no source other than the target.
+    """
+    contact_ids = list(dict.fromkeys([target_id, *source_ids]))
+    if len(contact_ids) < 2:
+        raise ValueError('Nothing to merge')
+    found = await db.execute(select(Contact).filter(
+        Contact.user_id == user.user_id, Contact.contact_id.in_(contact_ids)))
+    found = {contact.contact_id: contact for contact in found.scalars().all()}
+    if len(found) != len(contact_ids):
+        return None
+    source_ids = contact_ids[1:]
+    target = found[target_id]
+    descriptions = dict.fromkeys(found[contact_id].description for contact_id in contact_ids
+                                 if found[contact_id].description)
+    await db.execute(
+        delete(Contact)
+        .where(Contact.user_id == user.user_id, Contact.contact_id.in_(source_ids))
+        .execution_options(synchronize_session=False))
+    target.description = "\n".join(descriptions)[:250]
+    await _log_changes(source_ids, user, db, deleted=True)
+    await _log_changes([target_id], user, db)
+    await db.commit()
+    await _after_write(user, changed=[target], deleted=source_ids)
+    return target
+
+
+async def _log_changes(contact_ids: Iterable[int], user: User, db: AsyncSession, deleted: bool = False) -> None:
+    """
+    The _log_changes function records changed or deleted contacts in the change log, in the transaction of the change.
+    Every function that changes contacts must call it before the commit.
+    The user's sequence counter is incremented with an upsert ... RETURNING; the row lock it takes is held until
+    the commit, so the changes of a user become visible in sequence order and a sync never skips one.
+    """
+    seq = _insert(db)(ContactSequence).values(user_id=user.user_id, seq=1)
+    seq = await db.execute(
+        seq.on_conflict_do_update(index_elements=[ContactSequence.user_id], set_=dict(seq=ContactSequence.seq + 1))
+        .returning(ContactSequence.seq))
+    seq = seq.scalar_one()
+    stmt = _insert(db)(ContactChange).values(
+        [dict(user_id=user.user_id, contact_id=contact_id, seq=seq, deleted=deleted) for contact_id in contact_ids])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ContactChange.user_id, ContactChange.contact_id],
+        set_=dict(seq=stmt.excluded.seq, deleted=stmt.excluded.deleted))
+    await db.execute(stmt)
+
+
+async def _after_write(user: User, changed: Iterable[Contact] = (), deleted: Iterable[int] = (),
+                       reset: bool = False) -> None:
+    """
+    The _after_write function updates the derived state of the user's contacts after a committed change:
+    it bumps the response cache version and updates the autocomplete index.
+    Every function that changes contacts must call it. A reset drops the autocomplete index instead,
+    which is cheaper to rebuild on the next lookup than to update term by term after a large import.
+    """
+    await response_cache.bump(user.user_id)
+    if reset:
+        await suggest_index.reset(user.user_id)
+        return
+    if changed:
+        await suggest_index.add(user.user_id, changed)
+    if deleted:
+        await suggest_index.remove(user.user_id, deleted)
+
+
+def _contact_values(body: ContactSchema, user: User) -> dict:
+    """
+    The _contact_values function returns the column values of a new contact of the user, derived columns included.
+    """
+    values = dict(body.model_dump(), user_id=user.user_id)
+    values.update(derived_columns(values))
+    return values
+
+
+def _insert(db: AsyncSession):
+    """
+    The _insert function returns the INSERT construct of the session's dialect,
+    which supports ON CONFLICT on both Postgres and SQLite.
+    """
+    if db.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+async def _insert_batch(batch: List[Tuple[int, ContactSchema]], user: User, db: AsyncSession) -> List[int]:
+    """
+    The _insert_batch function inserts a batch of contacts with one multi-row INSERT ... ON CONFLICT DO NOTHING.
+
+    :param batch: Line numbers and contacts to insert.
+    :type batch: List[Tuple[int, ContactSchema]]
+    :param user: The owner of the contacts.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :return: The line numbers of the rows skipped because the email or phone already exists.
+    :rtype: List[int]
+    """
+    values = [_contact_values(body, user) for _, body in batch]
+    stmt = _insert(db)(Contact).values(values).on_conflict_do_nothing().returning(Contact.contact_id, Contact.email)
+    inserted = await db.execute(stmt)
+    inserted = dict(inserted.all())
+    if inserted:
+        await _log_changes(inserted, user, db)
+    await db.commit()
+    inserted = set(inserted.values())
+    return [line for line, body in batch if body.email not in inserted]
+
+
+async def import_contacts(rows: Iterable[Tuple[int, ContactSchema | None, str | None]], user: User,
+                          db: AsyncSession, batch_size: int = 500) -> dict:
+    """
+    Imports contacts for a specific user in batches of multi-row inserts, one transaction per batch.
+    Rows whose email or phone number already exists, in the database or earlier in the same upload,
+    are skipped and reported instead of aborting the import. The rows are taken batch_size at a time
+    in a worker thread, so parsing and validating the upload does not block the event loop.
+        Args:
+            rows (Iterable): Line numbers with a validated contact or a validation error, see contact_io.read_contacts.
+            user (User): The owner of the new contacts.
+
+    :param rows: The rows of the uploaded file.
+    :type rows: Iterable[Tuple[int, ContactSchema | None, str | None]]
+    :param user: The user to create the contacts for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :param batch_size: The number of rows per INSERT statement.
+    :type batch_size: int
+    :return: The number of inserted rows, the line numbers of duplicates and the validation errors.
+    :rtype: dict
+    """
+    report = {"inserted": 0, "duplicates": [], "errors": []}
+    batch, emails, phones = [], set(), set()
+    rows = iter(rows)
+    while chunk := await asyncio.to_thread(list, islice(rows, batch_size)):
+        for line, body, error in chunk:
+            if error:
+                report["errors"].append({"row": line, "error": error})
+                continue
+            if body.email in emails or body.telephon_number in phones:
+                report["duplicates"].append(line)
+                continue
+            batch.append((line, body))
+            emails.add(body.email)
+            phones.add(body.telephon_number)
+            if len(batch) >= batch_size:
+                duplicates = await _insert_batch(batch, user, db)
+                report["inserted"] += len(batch) - len(duplicates)
+                report["duplicates"].extend(duplicates)
+                batch, emails, phones = [], set(), set()
+    if batch:
+        duplicates = await _insert_batch(batch, user, db)
+        report["inserted"] += len(batch) - len(duplicates)
+        report["duplicates"].extend(duplicates)
+    report["duplicates"].sort()
+    if report["inserted"]:
+        await _after_write(user, reset=True)
+    return report
+
+
+def birthday_window(today: date, days: int) -> Tuple[int, int] | None:
+    """
+    The birthday_window function converts "the next N days starting today" into a range of birthday keys.
+    The range wraps around the new year when start > end. Contacts born on February 29 are
+    celebrated on February 28 in non-leap years.
+
+    :param today: The first day of the window.
+    :type today: date
+    :param days: The length of the window in days.
+    :type days: int
+    :return: The (start, end) birthday keys, or None if the window covers the whole year.
+    :rtype: Tuple[int, int] | None
+    """
+    if days >= 366:
+        return None
+    last_day = today + timedelta(days=days - 1)
+    start, end = birthday_key(today), birthday_key(last_day)
+    if end == 228 and not isleap(last_day.year):
+        end = 229
+    return start, end
+
+
+async def get_contacts_birthdays(user: User, db: AsyncSession, days: int = 7,
+                                 fields: List[str] | None = None) -> List[Row]:
     """
     The birthday_list function takes a user and database session as arguments.
-    It returns a list of contacts whose birthdays are within the next 7 days.
+    It returns a list of contacts whose birthdays are within the next days, closest first.
+    The filtering runs in the database on the indexed birthday_md column.
         Args:
             user (User): The current user, used for authorization purposes.
+            days (int): The length of the window, today included.
 
     :param user: User: Get the user id from the database
-    :param db: Session: Access the database
-    :return: A list of contacts with birthdays in the next week    
-    """
-    contacts_list = []
-    today = datetime.now().date()
-    contacts_all = db.query(Contact).filter(
-        Contact.user_id == user.user_id).all()
-    for contact in contacts_all:
-        days_ = (datetime(year=today.year,
-                          month=contact.birthday.month,
-                          day=contact.birthday.day).date() - today).days
-        if 0 <= days_ < 7:
-            contacts_list.append(contact)
-    return contacts_list
+    :param db: AsyncSession: Access the database
+    :param days: int: The number of days to look ahead
+    :param fields: List[str] | None: The fields to select, all by default
+    :return: A list of contact rows with birthdays in the next days
+    """
+    today = date.today()
+    window = birthday_window(today, days)
+    start = birthday_key(today)
+    query = select(*_columns(fields)).filter(Contact.user_id == user.user_id)
+    if window:
+        start, end = window
+        if start <= end:
+            query = query.filter(Contact.birthday_md.between(start, end))
+        else:
+            query = query.filter(or_(Contact.birthday_md >= start, Contact.birthday_md <= end))
+    query = query.order_by(case((Contact.birthday_md >= start, 0), else_=1), Contact.birthday_md)
+    contacts_list = await db.execute(query)
+    return contacts_list.all()
+
+
+async def get_contact_stats(user: User, db: AsyncSession, weeks: int = 12, top_domains: int = 10) -> dict:
+    """
+    Computes the address book statistics of a specific user with GROUP BY aggregates in the database:
+    the number of contacts, birthdays per month, contacts added per week and the most common email domains.
+    Only the aggregated rows leave the database, whatever the size of the address book.
+        Args:
+            user (User): The User who owns the contacts.
+            weeks (int): The number of weeks, the current one included, to count added contacts for.
+            top_domains (int): The number of email domains to return.
+
+    :param user: The user to compute the statistics for.
+    :type user: User
+    :param db: The database session.
+    :type db: AsyncSession
+    :param weeks: The number of weeks to count added contacts for.
+    :type weeks: int
+    :param top_domains: The number of email domains to return.
+    :type top_domains: int
+    :return: The total, and lists of month, week and domain counts. Months and weeks without contacts count 0.
+    :rtype: dict
+    """
+    # the aggregates are grouped by their output names, so Postgres does not have to match
+    # expressions with bound parameters between the select list and GROUP BY
+    owned = Contact.user_id == user.user_id
+    total = await db.execute(select(func.count()).select_from(Contact).filter(owned))
+    total = total.scalar_one()
+
+    month = (Contact.birthday_md // 100).label('month')
+    months = await db.execute(select(month, func.count()).filter(owned).group_by(literal_column('month')))
+    months = dict(months.all())
+
+    today = date.today()
+    first_week = today - timedelta(days=today.weekday(), weeks=weeks - 1)
+    if db.get_bind().dialect.name == 'postgresql':
+        week = cast(func.date_trunc('week', Contact.created_at), Date)
+        domain = func.lower(func.split_part(Contact.email, '@', 2))
+    else:
+        week = func.date(Contact.created_at, 'weekday 0', '-6 days')
+        domain = func.lower(func.substr(Contact.email, func.instr(Contact.email, '@') + 1))
+    week = week.label('week')
+    since = datetime.combine(first_week, datetime.min.time())
+    added = await db.execute(select(week, func.count()).filter(owned, Contact.created_at >= since)
+                             .group_by(literal_column('week')))
+    added = {value if isinstance(value, date) else date.fromisoformat(value): count for value, count in added.all()}
+
+    domain = domain.label('domain')
+    domains = await db.execute(select(domain, func.count().label('count')).filter(owned)
+                               .group_by(literal_column('domain'))
+                               .order_by(literal_column('count').desc(), literal_column('domain')).limit(top_domains))
+
+    return {
+        "total": total,
+        "birthdays_by_month": [{"month": m, "count": months.get(m, 0)} for m in range(1, 13)],
+        "added_by_week": [{"week": first_week + timedelta(weeks=i), "count": added.get(first_week + timedelta(weeks=i), 0)}
+                          for i in range(weeks)],
+        "top_email_domains": [{"domain": domain, "count": count} for domain, count in domains.all()],
+    }
@@ -0,0 +1,120 @@
+from difflib import SequenceMatcher
+from typing import Callable, Dict, Hashable, Iterable, List, Sequence, Any
+
+
+class DisjointSet:
+    """
+    A union-find structure over arbitrary hashable items, with path halving and union by size.
+    """
+
+    def __init__(self):
+        self.parent: Dict[Hashable, Hashable] = {}
+        self.size: Dict[Hashable, int] = {}
+
+    def find(self, item: Hashable) -> Hashable:
+        """
+        The find function returns the representative of the set holding item, adding item as a singleton if needed.
+
+        :param item: The item to look up.
+        :type item: Hashable
+        :return: The representative item of its set.
+        :rtype: Hashable
+        """
+        self.parent.setdefault(item, item)
+        self.size.setdefault(item, 1)
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a: Hashable, b: Hashable) -> None:
+        """
+        The union function merges the sets holding a and b.
+
+        :param a: An item of the first set.
+        :type a: Hashable
+        :param b: An item of the second set.
+        :type b: Hashable
+        :return: None
+        :rtype: None
+        """
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def groups(self) -> List[List[Hashable]]:
+        """
+        The groups function returns the sets with more than one item.
+
+        :return: The items of every set of two or more, in insertion order.
+        :rtype: List[List[Hashable]]
+        """
+        groups: Dict[Hashable, List[Hashable]] = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return [group for group in groups.values() if len(group) > 1]
+
+
+def name_similarity(a: str, b: str) -> float:
+    """
+    The name_similarity function compares two normalized names, 1.0 means equal.
+
+    :param a: The first name.
+    :type a: str
+    :param b: The second name.
+    :type b: str
+    :return: The similarity ratio between 0 and 1.
+    :rtype: float
+    """
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def find_clusters(rows: Sequence[Any], blocking_keys: Iterable[Callable[[Any], Hashable]],
+                  name_keys: Iterable[Callable[[Any], str]], window: int = 5, threshold: float = 0.9) -> List[List[Any]]:
+    """
+    The find_clusters function groups rows that probably describe the same contact.
+
+    Two rows are linked if they share the value of any blocking key (e.g. the normalized phone),
+    or if their names are similar. Names are compared with the sorted neighbourhood method:
+    the rows are sorted by every name key and each row is only compared with the next window - 1 rows,
+    so the cost is O(n log n) for the sort plus O(n * window) comparisons instead of O(n^2).
+    Linked rows are merged transitively into clusters with union-find.
+
+    :param rows: The rows to deduplicate, each with a contact_id attribute.
+    :type rows: Sequence[Any]
+    :param blocking_keys: Functions returning an exact-match key of a row, or None if the row has none.
+    :type blocking_keys: Iterable[Callable[[Any], Hashable]]
+    :param name_keys: Functions returning a normalized name of a row to sort and compare by.
+    :type name_keys: Iterable[Callable[[Any], str]]
+    :param window: The size of the sliding window of the sorted neighbourhood method.
+    :type window: int
+    :param threshold: The minimal name similarity to link two rows.
+    :type threshold: float
+    :return: The clusters of two or more rows, largest first.
+    :rtype: List[List[Any]]
+    """
+    by_id = {row.contact_id: row for row in rows}
+    links = DisjointSet()
+    for key in blocking_keys:
+        seen: Dict[Hashable, int] = {}
+        for row in rows:
+            value = key(row)
+            if value is None:
+                continue
+            if value in seen:
+                links.union(seen[value], row.contact_id)
+            else:
+                seen[value] = row.contact_id
+    for key in name_keys:
+        ordered = sorted((key(row), row.contact_id) for row in rows)
+        for i, (name, contact_id) in enumerate(ordered):
+            for other_name, other_id in ordered[i + 1:i + window]:
+                if name_similarity(name, other_name) >= threshold:
+                    links.union(contact_id, other_id)
+    clusters = [[by_id[contact_id] for contact_id in sorted(group)] for group in links.groups()]
+    clusters.sort(key=lambda cluster: (-len(cluster), cluster[0].contact_id))
+    return clusters
@@ -1,14 +1,20 @@
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import FastAPI, Depends, HTTPException, Request, Security, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import hmac
 import time
 import my_routes
 import auth_routes
 import users_routes
 from my_db import get_db
 from models import Contact
-import redis.asyncio as redis
+from auth import auth_service
 from config import settings
+from metrics import metrics
+from cache import redis_client, redis_pool
+from sessions import revocation_list
 from fastapi_limiter import FastAPILimiter
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -49,27 +55,77 @@ async def startup():
     The startup function is called when the application starts up.
     It's a good place to initialize things that are used by the app, such as databases or caches.
 
+    The rate limiter gets the Redis client of the caches, so all of them share one connection pool.
+    The revocation list of access tokens starts following the revocations of the other workers.
+
     :return: A future object, which is a special type of object that represents the result of an asynchronous operation
     """
-    r = await redis.Redis(host=settings.redis_host, port=settings.redis_port, db=0, encoding="utf-8",
-                          decode_responses=True)
-    await FastAPILimiter.init(r)
+    await FastAPILimiter.init(redis_client)
+    revocation_list.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    The shutdown function is called when the application stops.
+    It waits in a worker thread for the password hashing jobs to drain, so the event loop keeps serving
+    the requests still in flight, and closes the Redis connections.
+
+    :return: None
+    """
+    await asyncio.to_thread(auth_service.hash_executor.shutdown, wait=True)
+    await revocation_list.stop()
+    await redis_client.aclose()
+    await redis_pool.disconnect()
+
+
+metrics_security = HTTPBearer(auto_error=False)
+
+
+async def metrics_access(credentials: HTTPAuthorizationCredentials | None = Security(metrics_security)) -> None:
+    """
+    The metrics_access function admits only the monitoring system, which sends settings.metrics_token
+    as a bearer token. Without a configured token the metrics are not served at all.
+
+    :param credentials: The bearer token of the request, if any.
+    :type credentials: HTTPAuthorizationCredentials | None
+    :return: None
+    :rtype: None
+    """
+    if not settings.metrics_token:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if credentials is None or not hmac.compare_digest(credentials.credentials.encode(),
+                                                      settings.metrics_token.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.get("/api/metrics", dependencies=[Depends(metrics_access)], include_in_schema=False)
+async def get_metrics():
+    """
+    The get_metrics function returns the counters and gauges of this worker process.
+    They describe sessions, revocations and the connection pools, so only the monitoring system may read them.
+
+    :return: A dictionary of metric names and values
+    """
+    return metrics.snapshot()
 
 
 @app.get("/api/healthchecker")
-async def healthchecker(db: Session = Depends(get_db)):
+async def healthchecker(db: AsyncSession = Depends(get_db)):
     """
     The healthchecker function is a simple function that checks the health of the database.
     It does this by making a request to the database and checking if it returns any results.
     If there are no results, then we know something is wrong with our connection to the database.
 
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: A dictionary with a message key    
     """
     try:
         # Make request
-        result = db.execute(select(Contact)).all()
+        result = await db.execute(select(Contact).limit(1))
+        result = result.all()
 
         if result is None:
             raise HTTPException(
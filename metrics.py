@@ -0,0 +1,82 @@
+from collections import defaultdict
+from typing import Callable
+
+
+class Metrics:
+    """
+    A minimal in-process registry of counters and gauges, exported by GET /api/metrics.
+    Values are per worker process.
+    """
+
+    def __init__(self):
+        self.values: dict[str, float] = defaultdict(float)
+        self.callbacks: dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, value: float = 1) -> None:
+        """
+        The inc function increases a counter or gauge.
+
+        :param name: The name of the metric.
+        :type name: str
+        :param value: The amount to add.
+        :type value: float
+        :return: None
+        :rtype: None
+        """
+        self.values[name] += value
+
+    def dec(self, name: str, value: float = 1) -> None:
+        """
+        The dec function decreases a gauge.
+
+        :param name: The name of the metric.
+        :type name: str
+        :param value: The amount to subtract.
+        :type value: float
+        :return: None
+        :rtype: None
+        """
+        self.values[name] -= value
+
+    def observe(self, name: str, value: float) -> None:
+        """
+        The observe function records one measurement, e.g. a duration in seconds,
+        as the {name}_count and {name}_sum counters. Their ratio is the mean.
+
+        :param name: The name of the metric.
+        :type name: str
+        :param value: The measured value.
+        :type value: float
+        :return: None
+        :rtype: None
+        """
+        self.values[f"{name}_count"] += 1
+        self.values[f"{name}_sum"] += value
+
+    def register(self, name: str, callback: Callable[[], float]) -> None:
+        """
+        The register function adds a gauge whose value is read from the callback at export time.
+
+        :param name: The name of the metric.
+        :type name: str
+        :param callback: A function returning the current value.
+        :type callback: Callable[[], float]
+        :return: None
+        :rtype: None
+        """
+        self.callbacks[name] = callback
+
+    def snapshot(self) -> dict[str, float]:
+        """
+        The snapshot function returns the current value of every metric.
+
+        :return: A dictionary of metric names and values.
+        :rtype: dict[str, float]
+        """
+        data = dict(self.values)
+        for name, callback in self.callbacks.items():
+            data[name] = callback()
+        return data
+
+
+metrics = Metrics()
@@ -0,0 +1,27 @@
+"""Contacts keyset index
+
+Revision ID: 096a6f3a293c
+Revises: e6e8aabca3ac
+Create Date: 2026-10-18 04:18:09.878224
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '096a6f3a293c'
+down_revision: Union[str, None] = 'e6e8aabca3ac'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_contacts_user_id_last_name_contact_id', 'contacts',
+                    ['user_id', 'last_name', 'contact_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_contacts_user_id_last_name_contact_id', table_name='contacts')
@@ -0,0 +1,31 @@
+"""Contacts full-text search
+
+Revision ID: 0b78d7d64e93
+Revises: 6da19d6835d0
+Create Date: 2026-10-18 04:33:00.747981
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b78d7d64e93'
+down_revision: Union[str, None] = '6da19d6835d0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute(
+        "ALTER TABLE contacts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', "
+        "first_name || ' ' || last_name || ' ' || email || ' ' || translate(email, '@.', '  ') || ' ' || "
+        "telephon_number || ' ' || coalesce(description, ''))) STORED")
+    op.execute("CREATE INDEX ix_contacts_search_vector ON contacts USING GIN (search_vector)")
+
+
+def downgrade() -> None:
+    op.drop_index('ix_contacts_search_vector', table_name='contacts')
+    op.drop_column('contacts', 'search_vector')
@@ -0,0 +1,31 @@
+"""contacts created_at
+
+Revision ID: 2d8a0011aa74
+Revises: b4b6bab90400
+Create Date: 2026-10-18 04:49:11.260855
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2d8a0011aa74'
+down_revision: Union[str, None] = 'b4b6bab90400'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # existing rows keep NULL, their creation time is unknown
+    op.add_column('contacts', sa.Column('created_at', sa.DateTime(), nullable=True))
+    op.alter_column('contacts', 'created_at', server_default=sa.text('now()'))
+    op.create_index('ix_contacts_user_id_created_at', 'contacts',
+                    ['user_id', 'created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_contacts_user_id_created_at', table_name='contacts')
+    op.drop_column('contacts', 'created_at')
@@ -0,0 +1,32 @@
+"""Contacts birthday month-day key
+
+Revision ID: 6da19d6835d0
+Revises: 096a6f3a293c
+Create Date: 2026-10-18 04:20:39.366376
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6da19d6835d0'
+down_revision: Union[str, None] = '096a6f3a293c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('contacts', sa.Column('birthday_md', sa.SmallInteger(), nullable=True))
+    op.execute("UPDATE contacts SET birthday_md = "
+               "EXTRACT(MONTH FROM birthday) * 100 + EXTRACT(DAY FROM birthday)")
+    op.alter_column('contacts', 'birthday_md', nullable=False)
+    op.create_index('ix_contacts_user_id_birthday_md', 'contacts',
+                    ['user_id', 'birthday_md'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_contacts_user_id_birthday_md', table_name='contacts')
+    op.drop_column('contacts', 'birthday_md')
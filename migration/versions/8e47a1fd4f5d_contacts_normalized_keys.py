@@ -0,0 +1,46 @@
+"""contacts normalized email and phone
+
+Revision ID: 8e47a1fd4f5d
+Revises: 2d8a0011aa74
+Create Date: 2026-10-18 04:51:56.156604
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e47a1fd4f5d'
+down_revision: Union[str, None] = '2d8a0011aa74'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('contacts', sa.Column('email_normalized', sa.String(length=50), nullable=True))
+    op.add_column('contacts', sa.Column('phone_normalized', sa.String(length=16), nullable=True))
+    # the phone rules are not expressible in portable SQL, so the backfill runs the application normalizers
+    from models import normalize_email, normalize_phone
+    conn = op.get_bind()
+    contacts = sa.table('contacts', sa.column('contact_id', sa.Integer), sa.column('email', sa.String),
+                        sa.column('telephon_number', sa.String), sa.column('email_normalized', sa.String),
+                        sa.column('phone_normalized', sa.String))
+    rows = conn.execute(sa.select(contacts.c.contact_id, contacts.c.email, contacts.c.telephon_number)).all()
+    if rows:
+        conn.execute(contacts.update().where(contacts.c.contact_id == sa.bindparam('id')).values(
+            email_normalized=sa.bindparam('email_key'), phone_normalized=sa.bindparam('phone_key')),
+            [dict(id=contact_id, email_key=normalize_email(email), phone_key=normalize_phone(phone))
+             for contact_id, email, phone in rows])
+    op.create_index('ix_contacts_user_id_email_normalized', 'contacts',
+                    ['user_id', 'email_normalized'], unique=False)
+    op.create_index('ix_contacts_user_id_phone_normalized', 'contacts',
+                    ['user_id', 'phone_normalized'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_contacts_user_id_phone_normalized', table_name='contacts')
+    op.drop_index('ix_contacts_user_id_email_normalized', table_name='contacts')
+    op.drop_column('contacts', 'phone_normalized')
+    op.drop_column('contacts', 'email_normalized')
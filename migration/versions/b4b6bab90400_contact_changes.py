@@ -0,0 +1,45 @@
+"""contact change log
+
+Revision ID: b4b6bab90400
+Revises: 0b78d7d64e93
+Create Date: 2026-10-18 04:41:33.608452
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4b6bab90400'
+down_revision: Union[str, None] = '0b78d7d64e93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('contact_sequences',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('seq', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.user_id'], ),
+                    sa.PrimaryKeyConstraint('user_id')
+                    )
+    op.create_table('contact_changes',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('contact_id', sa.Integer(), nullable=False),
+                    sa.Column('seq', sa.Integer(), nullable=False),
+                    sa.Column('deleted', sa.Boolean(), nullable=False),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.user_id'], ),
+                    sa.PrimaryKeyConstraint('user_id', 'contact_id')
+                    )
+    op.create_index('ix_contact_changes_user_id_seq_contact_id', 'contact_changes',
+                    ['user_id', 'seq', 'contact_id'], unique=False)
+    op.execute("INSERT INTO contact_changes (user_id, contact_id, seq, deleted) "
+               "SELECT user_id, contact_id, 0, false FROM contacts WHERE user_id IS NOT NULL")
+
+
+def downgrade() -> None:
+    op.drop_index('ix_contact_changes_user_id_seq_contact_id', table_name='contact_changes')
+    op.drop_table('contact_changes')
+    op.drop_table('contact_sequences')
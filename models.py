@@ -1,11 +1,101 @@
-from sqlalchemy import String, Date, ForeignKey, func, Boolean
+import re
+from datetime import date, datetime
+from sqlalchemy import String, Date, ForeignKey, func, Boolean, Index, SmallInteger, Integer, DateTime, DDL, event
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
+from config import settings
+
 
 class Base(DeclarativeBase):
     pass
 
 
+def birthday_key(birthday: date) -> int:
+    """
+    The birthday_key function packs the month and day of a birthday into one sortable integer (MMDD),
+    so upcoming birthdays can be found with an index range scan regardless of the birth year.
+
+    :param birthday: The date of birth.
+    :type birthday: date
+    :return: month * 100 + day, e.g. 1225 for December 25.
+    :rtype: int
+    """
+    return birthday.month * 100 + birthday.day
+
+
+def normalize_email(email: str) -> str:
+    """
+    The normalize_email function returns the duplicate-detection key of an email: trimmed and lowercased.
+
+    :param email: The email as entered.
+    :type email: str
+    :return: The normalized email.
+    :rtype: str
+    """
+    return email.strip().lower()
+
+
+def normalize_phone(phone: str, country_code: str | None = None) -> str:
+    """
+    The normalize_phone function returns the duplicate-detection key of a phone number in E.164 style, e.g. +380991234567.
+    Formatting characters are dropped, a 00 prefix becomes +, and a national number with a leading trunk 0
+    gets the default country code.
+
+    :param phone: The phone number as entered, e.g. "(099) 123-45-67".
+    :type phone: str
+    :param country_code: The country code of national numbers, settings.phone_country_code by default.
+    :type country_code: str | None
+    :return: The normalized phone number.
+    :rtype: str
+    """
+    country_code = country_code or settings.phone_country_code
+    digits = re.sub(r"\D", "", phone)
+    if phone.strip().startswith("+"):
+        return "+" + digits
+    if digits.startswith("00"):
+        return "+" + digits[2:]
+    if digits.startswith(country_code):
+        return "+" + digits
+    if digits.startswith("0"):
+        return "+" + country_code + digits[1:]
+    return "+" + digits
+
+
+def derived_columns(values: dict) -> dict:
+    """
+    The derived_columns function computes the columns derived from the given contact values,
+    for statements that bypass the column defaults: bulk inserts, upserts and updates.
+
+    :param values: Contact column values, possibly partial.
+    :type values: dict
+    :return: birthday_md, email_normalized and phone_normalized for the values that are present.
+    :rtype: dict
+    """
+    derived = {}
+    if values.get('birthday'):
+        derived['birthday_md'] = birthday_key(values['birthday'])
+    if values.get('email'):
+        derived['email_normalized'] = normalize_email(values['email'])
+    if values.get('telephon_number'):
+        derived['phone_normalized'] = normalize_phone(values['telephon_number'])
+    return derived
+
+
+def _birthday_md_default(context) -> int | None:
+    birthday = context.get_current_parameters().get('birthday')
+    return birthday_key(birthday) if birthday else None
+
+
+def _email_normalized_default(context) -> str | None:
+    email = context.get_current_parameters().get('email')
+    return normalize_email(email) if email else None
+
+
+def _phone_normalized_default(context) -> str | None:
+    phone = context.get_current_parameters().get('telephon_number')
+    return normalize_phone(phone) if phone else None
+
+
 class User(Base):
     __tablename__ = "users"
     user_id: Mapped[int] = mapped_column(
@@ -16,12 +106,21 @@ class User(Base):
     password: Mapped[str] = mapped_column(String(255), nullable=False)
     # created_at: Mapped[Date] = mapped_column(Date, default=func.now())
     avatar: Mapped[str] = mapped_column(String(255), nullable=True)
+    # the refresh token of the last login before sessions moved to Redis, see users.take_refresh_token
     refresh_token: Mapped[str] = mapped_column(String(255), nullable=True)
     confirmed: Mapped[str] = mapped_column(Boolean, default=False)
 
 
 class Contact(Base):
     __tablename__ = 'contacts'
+    __table_args__ = (
+        Index('ix_contacts_user_id_last_name_contact_id',
+              'user_id', 'last_name', 'contact_id'),
+        Index('ix_contacts_user_id_birthday_md', 'user_id', 'birthday_md'),
+        Index('ix_contacts_user_id_created_at', 'user_id', 'created_at'),
+        Index('ix_contacts_user_id_email_normalized', 'user_id', 'email_normalized'),
+        Index('ix_contacts_user_id_phone_normalized', 'user_id', 'phone_normalized'),
+    )
     contact_id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True)
     first_name: Mapped[str] = mapped_column(String(20), index=True)
@@ -29,7 +128,65 @@ class Contact(Base):
     email: Mapped[str] = mapped_column(String(50), index=True, unique=True)
     telephon_number: Mapped[str] = mapped_column(String(15), unique=True)
     birthday: Mapped[Date] = mapped_column(Date, nullable=False)
+    birthday_md: Mapped[int] = mapped_column(
+        SmallInteger, default=_birthday_md_default)
     description: Mapped[str] = mapped_column(String(250))
+    # duplicate-detection keys, see normalize_email and normalize_phone
+    email_normalized: Mapped[str] = mapped_column(String(50), default=_email_normalized_default)
+    phone_normalized: Mapped[str] = mapped_column(String(16), default=_phone_normalized_default)
+    # NULL for contacts created before the column existed
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), nullable=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.user_id'))
     user: Mapped["User"] = relationship(
-        'User', backref="contacts", lazy="joined")
+        'User', backref="contacts", lazy="raise")
+
+
+class ContactSequence(Base):
+    """
+    The sequence number of the last change of a user's contacts, see ContactChange.
+    It lives in its own row rather than on users, so contact writes do not lock the row read by every request.
+    """
+    __tablename__ = 'contact_sequences'
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.user_id'), primary_key=True)
+    seq: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class ContactChange(Base):
+    """
+    The change log behind delta sync: one row per contact the user ever had, holding the sequence number
+    of its last change. Deleted contacts keep their row as a tombstone.
+    Sequence numbers come from ContactSequence, whose row lock orders the changes of a user by commit.
+    """
+    __tablename__ = 'contact_changes'
+    __table_args__ = (
+        Index('ix_contact_changes_user_id_seq_contact_id', 'user_id', 'seq', 'contact_id'),
+    )
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.user_id'), primary_key=True)
+    contact_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    seq: Mapped[int] = mapped_column(Integer, nullable=False)
+    deleted: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+
+
+# Full-text search over contacts. Postgres uses the generated search_vector column and its GIN index,
+# created by the migrations; SQLite (local runs and tests) gets an external-content FTS5 table kept in sync by triggers.
+SEARCH_COLUMNS = "first_name, last_name, email, telephon_number, description"
+
+for ddl in (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5({SEARCH_COLUMNS}, "
+    "content='contacts', content_rowid='contact_id')",
+    f"CREATE TRIGGER IF NOT EXISTS contacts_fts_ai AFTER INSERT ON contacts BEGIN "
+    f"INSERT INTO contacts_fts(rowid, {SEARCH_COLUMNS}) VALUES (new.contact_id, new.first_name, new.last_name, "
+    "new.email, new.telephon_number, new.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS contacts_fts_ad AFTER DELETE ON contacts BEGIN "
+    f"INSERT INTO contacts_fts(contacts_fts, rowid, {SEARCH_COLUMNS}) VALUES ('delete', old.contact_id, "
+    "old.first_name, old.last_name, old.email, old.telephon_number, old.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS contacts_fts_au AFTER UPDATE ON contacts BEGIN "
+    f"INSERT INTO contacts_fts(contacts_fts, rowid, {SEARCH_COLUMNS}) VALUES ('delete', old.contact_id, "
+    "old.first_name, old.last_name, old.email, old.telephon_number, old.description); "
+    f"INSERT INTO contacts_fts(rowid, {SEARCH_COLUMNS}) VALUES (new.contact_id, new.first_name, new.last_name, "
+    "new.email, new.telephon_number, new.description); END",
+):
+    event.listen(Contact.__table__, "after_create", DDL(ddl).execute_if(dialect="sqlite"))
+
+event.listen(Contact.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS contacts_fts").execute_if(dialect="sqlite"))
@@ -1,19 +1,40 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.engine import make_url
 from config import settings
 
 
 SQLALCHEMY_DATABASE_URL = settings.sqlalchemy_database_url
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def get_async_url(url: str) -> str:
+    """
+    The get_async_url function maps a database url to the asyncio driver of its backend.
+    Alembic keeps using the synchronous url from the settings, the application uses this one.
+
+    :param url: The database url from the settings, e.g. postgresql+psycopg2://...
+    :type url: str
+    :return: The same url with an asyncio driver (asyncpg for Postgres, aiosqlite for SQLite).
+    :rtype: str
+    """
+    url_ = make_url(url)
+    backend = url_.get_backend_name()
+    if backend in ASYNC_DRIVERS:
+        url_ = url_.set(drivername=ASYNC_DRIVERS[backend])
+    return url_.render_as_string(hide_password=False)
+
+
+engine = create_async_engine(get_async_url(SQLALCHEMY_DATABASE_URL))
+
+SessionLocal = async_sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -1,112 +1,682 @@
 
-from fastapi import APIRouter, HTTPException, Depends, status, Query
-from my_db import get_db
-from shemas import ContactSchema, ContactResponse
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, HTTPException, Depends, status, Query, Path, UploadFile, File, Request
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
+from my_db import get_db, SessionLocal
+from shemas import ContactSchema, ContactUpdateSchema, ContactResponse, ContactPage, ContactImportReport, \
+    ContactSuggestion, ContactChanges, ContactIds, ContactBatch, ContactBatchDelete, ContactUpsertBatch, \
+    ContactUpsertReport, ContactStats, ContactMerge
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi_limiter.depends import RateLimiter
 import contacts
+import contact_io
 from contacts import User
 from auth import auth_service
+from cache import response_cache, ResponseCache
+from typing import Any, Awaitable, Callable, List
+from sqlalchemy import Row
+from datetime import date
+import hashlib
+import orjson
 
 
 router = APIRouter(prefix='/contacts', tags=['contacts'])
 
 
-@router.get('/', response_model=list[ContactResponse],
+def contact_fields(fields: str = Query(None, description='Comma-separated ContactResponse fields, all by default')) \
+        -> List[str] | None:
+    """
+    The contact_fields dependency parses the fields query parameter of the contact read routes.
+
+    :param fields: The requested fields, e.g. "contact_id,first_name,last_name".
+    :type fields: str
+    :return: The validated field names, or None for all fields.
+    :rtype: List[str] | None
+    """
+    try:
+        return contacts.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f'UNKNOWN FIELDS: {e}')
+
+
+def project(row: Row, fields: List[str] | None) -> dict:
+    """
+    The project function turns a contact row into a dictionary of the requested fields,
+    dropping the columns a query only selected for itself.
+    """
+    if fields is None:
+        return row._asdict()
+    return {field: row._mapping[field] for field in fields}
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    The etag_matches function checks an If-None-Match header against an entity tag with the weak comparison of RFC 9110.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+async def cached_response(request: Request, user: User, name: str, params: dict,
+                          build: Callable[[], Awaitable[Any]]) -> Response:
+    """
+    The cached_response function answers a contact read from the response cache, or builds, caches and returns it.
+    The ETag is derived from the contacts version of the user, so a client that already has the current
+    version gets 304 Not Modified before any query runs or anything is encoded.
+    Errors raised by build are not cached. Cached bodies are dropped by any change of the user's contacts.
+    Without Redis the response is built every time and the ETag is a hash of the body.
+
+    :param request: The incoming request, for its If-None-Match header.
+    :type request: Request
+    :param user: The owner of the contacts.
+    :type user: User
+    :param name: The name of the endpoint.
+    :type name: str
+    :param params: The query parameters that change the response.
+    :type params: dict
+    :param build: A coroutine function that queries the database and returns the content to encode.
+    :type build: Callable[[], Awaitable[Any]]
+    :return: The JSON response, or an empty 304 response.
+    :rtype: Response
+    """
+    if_none_match = request.headers.get('if-none-match')
+    version = await response_cache.version(user.user_id)
+    body = None
+    if version is not None:
+        etag = ResponseCache.etag(user.user_id, version, name, params)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        body = await response_cache.get(user.user_id, version, name, params)
+    if body is None:
+        body = orjson.dumps(await build())
+        if version is not None:
+            await response_cache.set(user.user_id, version, name, params, body)
+        else:
+            etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(body, media_type='application/json', headers={'ETag': etag, 'Cache-Control': 'private, no-cache'})
+
+
+@router.get('/', response_model=ContactPage,
             description='No more than 10 requests per minute',
             dependencies=[Depends(RateLimiter(times=10, seconds=60))])
-async def get_contacts(contact_field: str = Query(None), db: Session = Depends(get_db),
+async def get_contacts(request: Request, contact_field: str = Query(None), limit: int = Query(50, ge=1, le=500),
+                       cursor: str = Query(None), fields: List[str] | None = Depends(contact_fields),
+                       db: AsyncSession = Depends(get_db),
                        current_user: User = Depends(auth_service.get_current_user)):
     """
-    The get_contacts function returns a list of contacts for the current user.
+    The get_contacts function returns a page of contacts for the current user.
     May search_field function searches for a contacts in the database.
     It takes a string as an argument and returns all contacts that contain this string in any of their fields.
     If no such contacts are found, it raises an HTTPException with status code 404.
+    Pages are chained with the next_cursor of the previous response.
+    The rows are encoded straight to JSON, without ORM objects or a second pydantic validation.
+    The encoded page is cached per user until the next change of the user's contacts,
+    and a client sending the ETag of the current version in If-None-Match gets 304 without a query.
         Args:
-            contact_field (str): The parameter for search of the desired Contact.            
-            db (Session): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            request (Request): The incoming request, for its If-None-Match header.
+            contact_field (str): The parameter for search of the desired Contact.
+            limit (int): The maximum number of contacts on the page.
+            cursor (str): The next_cursor of the previous page.
+            fields (List[str]): The fields to return, all by default.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
             current_user (User): The User who owns the desired Contact.
 
+    :param request: The incoming request.
+    :type request: Request
     :param contact_field: The parameter for search of the desired Contact.
     :type contact_field: str
+    :param limit: The maximum number of contacts on the page.
+    :type limit: int
+    :param cursor: The next_cursor of the previous page.
+    :type cursor: str
+    :param fields: The fields to return, only these columns are read from the database.
+    :type fields: List[str] | None
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :param current_user: Get the current user from the auth_service.
     :type current_user: User
-    :return: A list of contacts
+    :return: A page of contacts and the cursor of the next page
+    :rtype: dict
+    """
+    async def build():
+        try:
+            contacts_, next_cursor = await contacts.get_contacts(contact_field, current_user, db, limit, cursor, fields)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail='INVALID CURSOR')
+        if contact_field and not contacts_ and not cursor:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail='CONTACTS NOT FOUND')
+        return {"items": [project(row, fields) for row in contacts_], "next_cursor": next_cursor}
+
+    params = {"contact_field": contact_field, "limit": limit, "cursor": cursor, "fields": fields}
+    return await cached_response(request, current_user, 'list', params, build)
+
+
+@router.get('/birthdays', response_model=list[ContactResponse],
+            description='No more than 10 requests per minute',
+            dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def get_contacts_birthdays(request: Request, days: int = Query(7, ge=1, le=366),
+                                 fields: List[str] | None = Depends(contact_fields),
+                                 db: AsyncSession = Depends(get_db),
+                                 current_user: User = Depends(auth_service.get_current_user)):
+    """
+    The birthday_list function takes a user and database session as arguments.
+    It returns a list of contacts whose birthdays are within the next days.
+        Args:
+            days (int): The length of the window, 7 days by default.
+            user (User): The current user, used for authorization purposes.
+
+    :param request: Request: The If-None-Match header is answered with 304 while the contacts are unchanged
+    :param days: int: The number of days to look ahead
+    :param fields: List[str] | None: The fields to return, all by default
+    :param user: User: Get the user id from the database
+    :param db: AsyncSession: Access the database
+    :return: A list of contacts with birthdays in the next days
+    """
+    async def build():
+        contacts_ = await contacts.get_contacts_birthdays(current_user, db, days, fields)
+        if contacts_ is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail='CONTACTS NOT FOUND')
+        return [project(row, fields) for row in contacts_]
+
+    # the window moves every day, so the date is part of the key
+    params = {"days": days, "today": date.today().isoformat(), "fields": fields}
+    return await cached_response(request, current_user, 'birthdays', params, build)
+
+
+@router.get('/search', response_model=list[ContactResponse],
+            description='No more than 10 requests per minute',
+            dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def search_contacts(q: str = Query(min_length=1, max_length=100), limit: int = Query(20, ge=1, le=100),
+                          offset: int = Query(0, ge=0), fields: List[str] | None = Depends(contact_fields),
+                          db: AsyncSession = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+    The search_contacts function searches the contacts of the current user by names, email, phone and description.
+    Every word of the query matches as a prefix, results are ranked by relevance.
+        Args:
+            q (str): The search text.
+            limit (int): The maximum number of contacts on the page.
+            offset (int): The number of best matches to skip.
+            fields (List[str]): The fields to return, all by default.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The User who owns the contacts.
+
+    :param q: The search text.
+    :type q: str
+    :param limit: The maximum number of contacts on the page.
+    :type limit: int
+    :param offset: The number of best matches to skip.
+    :type offset: int
+    :param fields: The fields to return.
+    :type fields: List[str] | None
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to search contacts for.
+    :type current_user: User
+    :return: A list of contacts, best match first
     :rtype: List[Contact]
     """
-    contacts_ = await contacts.get_contacts(contact_field, current_user, db)
-    if contacts_ is None:
+    contacts_ = await contacts.search_contacts(q, current_user, db, limit, offset, fields)
+    return ORJSONResponse([project(row, fields) for row in contacts_])
+
+
+@router.get('/suggest', response_model=list[ContactSuggestion],
+            description='No more than 120 requests per minute',
+            dependencies=[Depends(RateLimiter(times=120, seconds=60))])
+async def suggest_contacts(q: str = Query(min_length=1, max_length=100), limit: int = Query(10, ge=1, le=50),
+                           db: AsyncSession = Depends(get_db),
+                           current_user: User = Depends(auth_service.get_current_user)):
+    """
+    The suggest_contacts function autocompletes the name or email of a contact of the current user.
+    It is meant to be called on every keystroke, so it is served from a prefix index in Redis
+    and has a looser rate limit than the other contact lookups.
+        Args:
+            q (str): The text typed so far.
+            limit (int): The maximum number of suggestions.
+            db (AsyncSession): A database session object, used only to build the index on the first lookup.
+            current_user (User): The User who owns the contacts.
+
+    :param q: The text typed so far.
+    :type q: str
+    :param limit: The maximum number of suggestions.
+    :type limit: int
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to suggest contacts for.
+    :type current_user: User
+    :return: Contact ids, names and emails starting with q
+    :rtype: List[dict]
+    """
+    return ORJSONResponse(await contacts.suggest_contacts(q, current_user, db, limit))
+
+
+@router.get('/changes', response_model=ContactChanges,
+            description='No more than 10 requests per minute',
+            dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def get_changes(since: str = Query(None), limit: int = Query(500, ge=1, le=1000),
+                      db: AsyncSession = Depends(get_db),
+                      current_user: User = Depends(auth_service.get_current_user)):
+    """
+    The get_changes function returns the contacts of the current user changed or deleted since the previous sync.
+    The first sync is called without since and returns every contact. Every response carries next_since
+    for the following sync; while has_more is true the client should call again straight away.
+        Args:
+            since (str): The next_since token of the previous sync.
+            limit (int): The maximum number of changes in the response.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The User who owns the contacts.
+
+    :param since: The next_since token of the previous sync.
+    :type since: str
+    :param limit: The maximum number of changes in the response.
+    :type limit: int
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to sync contacts for.
+    :type current_user: User
+    :return: The changed contacts, the ids of the deleted ones and the token of the next sync
+    :rtype: dict
+    """
+    try:
+        changes = await contacts.get_changes(current_user, db, since, limit)
+    except ValueError:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail='CONTACTS NOT FOUND')
-    return contacts_
+            status_code=status.HTTP_400_BAD_REQUEST, detail='INVALID SYNC TOKEN')
+    return ORJSONResponse(changes)
+
+
+@router.get('/stats', response_model=ContactStats,
+            description='No more than 10 requests per minute',
+            dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def get_contact_stats(request: Request, weeks: int = Query(12, ge=1, le=104),
+                            db: AsyncSession = Depends(get_db),
+                            current_user: User = Depends(auth_service.get_current_user)):
+    """
+    The get_contact_stats function returns the address book statistics of the current user:
+    the number of contacts, birthdays per month, contacts added per week and the most common email domains.
+    The aggregates run in the database and the result is cached until the next change of the user's contacts.
+        Args:
+            request (Request): The incoming request, for its If-None-Match header.
+            weeks (int): The number of weeks to count added contacts for.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The User who owns the contacts.
+
+    :param request: The incoming request.
+    :type request: Request
+    :param weeks: The number of weeks, the current one included, to count added contacts for.
+    :type weeks: int
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to compute the statistics for.
+    :type current_user: User
+    :return: The statistics
+    :rtype: dict
+    """
+    async def build():
+        return await contacts.get_contact_stats(current_user, db, weeks)
+
+    # the weekly window moves every day, so the date is part of the key
+    params = {"weeks": weeks, "today": date.today().isoformat()}
+    return await cached_response(request, current_user, 'stats', params, build)
+
+
+@router.get('/duplicates', response_model=list[list[ContactResponse]],
+            description='No more than 2 requests per minute',
+            dependencies=[Depends(RateLimiter(times=2, seconds=60))])
+async def find_duplicates(request: Request, threshold: float = Query(0.9, ge=0.5, le=1.0),
+                          db: AsyncSession = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+    The find_duplicates function returns clusters of contacts of the current user that probably describe the same person:
+    contacts with the same email or phone number up to formatting and case, or with similar names.
+    The clusters are cached until the next change of the user's contacts. Merge them with POST /merge.
+        Args:
+            request (Request): The incoming request, for its If-None-Match header.
+            threshold (float): The minimal name similarity, 1.0 matches equal names only.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The User who owns the contacts.
+
+    :param request: The incoming request.
+    :type request: Request
+    :param threshold: The minimal name similarity.
+    :type threshold: float
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to deduplicate contacts for.
+    :type current_user: User
+    :return: Clusters of duplicate contacts, largest first
+    :rtype: List[List[dict]]
+    """
+    fields = list(ContactResponse.model_fields)
+
+    async def build():
+        clusters = await contacts.find_duplicates(current_user, db, threshold=threshold)
+        return [[project(row, fields) for row in cluster] for cluster in clusters]
+
+    return await cached_response(request, current_user, 'duplicates', {"threshold": threshold}, build)
+
+
+@router.get('/export', response_class=StreamingResponse,
+            description='No more than 2 requests per minute',
+            dependencies=[Depends(RateLimiter(times=2, seconds=60))])
+async def export_contacts(format: str = Query('ndjson', pattern='^(ndjson|csv|vcard)$'),
+                          contact_field: str = Query(None),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+    Streams all contacts of the current user as NDJSON, CSV or vCard.
+    Rows are written to the response while they are read from the database, so the first bytes
+    are sent before the query finishes and memory use stays flat for any address book.
+    The stream has its own database session, because the request session is closed
+    before a streaming response is sent.
+        Args:
+            format (str): ndjson, csv or vcard.
+            contact_field (str): The parameter for search of the desired Contact.
+            current_user (User): The User who owns the contacts.
+
+    :param format: The export format.
+    :type format: str
+    :param contact_field: The parameter for search of the desired Contact.
+    :type contact_field: str
+    :param current_user: The user to export the contacts of.
+    :type current_user: User
+    :return: A streaming response with the contacts.
+    :rtype: StreamingResponse
+    """
+    media_type, header, encode = contact_io.EXPORT_FORMATS[format]
+
+    async def body():
+        if header:
+            yield header
+        async with SessionLocal() as db:
+            async for rows in contacts.stream_contacts(contact_field, current_user, db):
+                yield encode(rows)
+
+    extension = 'vcf' if format == 'vcard' else format
+    return StreamingResponse(body(), media_type=media_type,
+                             headers={'Content-Disposition': f'attachment; filename="contacts.{extension}"'})
 
 
 @router.get('/{contact_id}', response_model=ContactResponse,
             description='No more than 10 requests per minute',
             dependencies=[Depends(RateLimiter(times=10, seconds=60))])
-async def get_contact(contact_id: int, db: Session = Depends(get_db),
+async def get_contact(request: Request, contact_id: int, fields: List[str] | None = Depends(contact_fields),
+                      db: AsyncSession = Depends(get_db),
                       current_user: User = Depends(auth_service.get_current_user)):
     """
     Retrieves a single contact with the specified ID for a specific user.
         Args:
+            request (Request): The incoming request, for its If-None-Match header.
             contact_id (int): The id of the desired Contact.
-            db (Session): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            fields (List[str]): The fields to return, all by default.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
             current_user (User): The User who owns the desired Contact.
 
+    :param request: The incoming request.
+    :type request: Request
     :param contact_id: The ID of the contact to retrieve.
     :type contact_id: int
+    :param fields: The fields to return.
+    :type fields: List[str] | None
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :param current_user: The user to retrieve the contact for.
     :type current_user: User    
     :return: The contact with the specified ID, or None if it does not exist.
     :rtype: Contact | None
     """
-    contact = await contacts.get_contact(contact_id, current_user, db)
-    if contact is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail='CONTACT NOT FOUND')
-    return contact
+    async def build():
+        contact = await contacts.get_contact(contact_id, current_user, db)
+        if contact is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail='CONTACT NOT FOUND')
+        return ContactResponse.model_validate(contact).model_dump(include=fields and set(fields))
+
+    params = {"contact_id": contact_id, "fields": fields}
+    return await cached_response(request, current_user, 'contact', params, build)
 
 
 @router.post('/', response_model=ContactResponse, status_code=status.HTTP_201_CREATED,
              description='No more than 10 requests per minute',
              dependencies=[Depends(RateLimiter(times=10, seconds=60))])
-async def create_contact(body: ContactSchema, db: Session = Depends(get_db),
+async def create_contact(body: ContactSchema, db: AsyncSession = Depends(get_db),
                          current_user: User = Depends(auth_service.get_current_user)):
     """
     Creates a new contact in the database for a specific user.
         Args:
             body (ContactModel): The contact to create.
-            db (Session): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
             current_user (User): The current user, who is creating the contact.
 
     :param body: The data for the contact to create.
     :type body: ContactSchema
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :param current_user: The user to create the contact for.
     :type current_user: User    
     :return: The contact object.
     :rtype: Contact
     """
-    contact = await contacts.create_contact(body, current_user, db)
+    try:
+        contact = await contacts.create_contact(body, current_user, db)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail='CONTACT WITH THIS EMAIL OR PHONE ALREADY EXISTS')
+    return contact
+
+
+@router.post('/import', response_model=ContactImportReport,
+             description='No more than 2 requests per minute',
+             dependencies=[Depends(RateLimiter(times=2, seconds=60))])
+async def import_contacts(file: UploadFile = File(), db: AsyncSession = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+    Imports contacts from an uploaded CSV or NDJSON file for a specific user.
+    The file is read row by row, every row is validated with ContactSchema and valid rows are inserted in batches.
+    Duplicates and invalid rows are reported per line instead of failing the whole import.
+        Args:
+            file (UploadFile): A CSV file with a header row or an NDJSON file with one contact per line.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The current user, who is importing the contacts.
+
+    :param file: The uploaded file.
+    :type file: UploadFile
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to create the contacts for.
+    :type current_user: User
+    :return: The import report.
+    :rtype: dict
+    """
+    fmt = contact_io.detect_format(file.filename, file.content_type)
+    if fmt is None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail='ONLY CSV AND NDJSON FILES ARE SUPPORTED')
+    return await contacts.import_contacts(contact_io.read_contacts(file.file, fmt), current_user, db)
+
+
+@router.post('/batch-get', response_model=ContactBatch,
+             description='No more than 10 requests per minute',
+             dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def batch_get_contacts(body: ContactIds, fields: List[str] | None = Depends(contact_fields),
+                             db: AsyncSession = Depends(get_db),
+                             current_user: User = Depends(auth_service.get_current_user)):
+    """
+    Retrieves up to 100 contacts of the current user by id with one query.
+        Args:
+            body (ContactIds): The ids of the desired Contacts.
+            fields (List[str]): The fields to return, all by default.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The User who owns the desired Contacts.
+
+    :param body: The ids of the contacts to retrieve.
+    :type body: ContactIds
+    :param fields: The fields to return.
+    :type fields: List[str] | None
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to retrieve the contacts for.
+    :type current_user: User
+    :return: The found contacts in the requested order and the ids that were not found
+    :rtype: dict
+    """
+    contact_ids = list(dict.fromkeys(body.ids))
+    rows = await contacts.get_contacts_by_ids(contact_ids, current_user, db, fields)
+    found = {row.contact_id: project(row, fields) for row in rows}
+    return ORJSONResponse({"items": [found[contact_id] for contact_id in contact_ids if contact_id in found],
+                           "not_found": [contact_id for contact_id in contact_ids if contact_id not in found]})
+
+
+@router.post('/batch-delete', response_model=ContactBatchDelete,
+             description='No more than 10 requests per minute',
+             dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def batch_delete_contacts(body: ContactIds, db: AsyncSession = Depends(get_db),
+                                current_user: User = Depends(auth_service.get_current_user)):
+    """
+    Removes up to 100 contacts of the current user by id with one query.
+        Args:
+            body (ContactIds): The ids of the Contacts to remove.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The User who owns the Contacts.
+
+    :param body: The ids of the contacts to remove.
+    :type body: ContactIds
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to remove the contacts for.
+    :type current_user: User
+    :return: The ids of the removed contacts and the ids that were not found
+    :rtype: dict
+    """
+    contact_ids = list(dict.fromkeys(body.ids))
+    deleted = set(await contacts.delete_contacts(contact_ids, current_user, db))
+    return {"deleted": [contact_id for contact_id in contact_ids if contact_id in deleted],
+            "not_found": [contact_id for contact_id in contact_ids if contact_id not in deleted]}
+
+
+@router.post('/merge', response_model=ContactResponse,
+             description='No more than 10 requests per minute',
+             dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def merge_contacts(body: ContactMerge, db: AsyncSession = Depends(get_db),
+                         current_user: User = Depends(auth_service.get_current_user)):
+    """
+    Merges duplicate contacts of the current user into the target contact and removes them.
+    The target keeps its fields, the descriptions of all merged contacts are joined.
+        Args:
+            body (ContactMerge): The id of the Contact to keep and the ids of its duplicates.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The User who owns the contacts.
+
+    :param body: The target contact and the duplicates to merge into it.
+    :type body: ContactMerge
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to merge the contacts for.
+    :type current_user: User
+    :return: The merged contact.
+    :rtype: Contact
+    """
+    if body.target_id in body.source_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail='CANNOT MERGE A CONTACT INTO ITSELF')
+    contact = await contacts.merge_contacts(body.target_id, body.source_ids, current_user, db)
+    if contact is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail='CONTACT NOT FOUND')
     return contact
 
 
+@router.put('/by-email', response_model=ContactUpsertReport,
+            description='No more than 10 requests per minute',
+            dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def upsert_contacts(body: ContactUpsertBatch, db: AsyncSession = Depends(get_db),
+                          current_user: User = Depends(auth_service.get_current_user)):
+    """
+    Creates or updates up to 500 contacts of the current user keyed by email, in a single statement.
+    Emails that belong to contacts of other users are reported as conflicts and not changed.
+        Args:
+            body (ContactUpsertBatch): The contacts to create or update.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The current user, who owns the contacts.
+
+    :param body: The contacts to create or update.
+    :type body: ContactUpsertBatch
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to upsert the contacts for.
+    :type current_user: User
+    :return: The created or updated contacts and the conflicting emails
+    :rtype: dict
+    """
+    try:
+        upserted = await contacts.upsert_contacts(body.items, current_user, db)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail='CONTACT WITH THIS PHONE ALREADY EXISTS')
+    emails = {row.email for row in upserted}
+    return ORJSONResponse({"upserted": [row._asdict() for row in upserted],
+                           "conflicts": list(dict.fromkeys(item.email for item in body.items if item.email not in emails))})
+
+
+@router.put('/by-email/{email}', response_model=ContactResponse,
+            description='No more than 10 requests per minute',
+            dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def upsert_contact(body: ContactSchema, email: str = Path(min_length=10, max_length=50),
+                         db: AsyncSession = Depends(get_db),
+                         current_user: User = Depends(auth_service.get_current_user)):
+    """
+    Creates or updates the contact of the current user with the email in the path, in a single statement.
+    Clients can resend a contact without checking first whether it exists.
+        Args:
+            body (ContactSchema): The contact data, its email is replaced with the one in the path.
+            email (str): The email that identifies the contact.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            current_user (User): The current user, who owns the contact.
+
+    :param body: The contact data.
+    :type body: ContactSchema
+    :param email: The email that identifies the contact.
+    :type email: str
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: The user to upsert the contact for.
+    :type current_user: User
+    :return: The created or updated contact.
+    :rtype: dict
+    """
+    try:
+        upserted = await contacts.upsert_contacts([body.model_copy(update={'email': email})], current_user, db)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail='CONTACT WITH THIS PHONE ALREADY EXISTS')
+    if not upserted:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail='CONTACT WITH THIS EMAIL ALREADY EXISTS')
+    return ORJSONResponse(upserted[0]._asdict())
+
+
 @router.put('/{contact_id}', response_model=ContactResponse,
             description='No more than 10 requests per minute',
             dependencies=[Depends(RateLimiter(times=10, seconds=60))])
-async def update_contact(body: ContactSchema, contact_id: int, db: Session = Depends(get_db),
+async def update_contact(body: ContactSchema, contact_id: int, db: AsyncSession = Depends(get_db),
                          current_user: User = Depends(auth_service.get_current_user)):
     """
     The update_contact function updates a contact in the database.
         The function takes three arguments:
             body (ContactSchema): object containing the new values for the contact.
             contact_id (int): An integer representing the id of an existing contact to be updated.
-            db (Session): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
             current_user (User): The current user, who is creating the contact.
 
 
@@ -115,13 +685,49 @@ async def update_contact(body: ContactSchema, contact_id: int, db: Session = Dep
     :param contact_id: Specify the id of the contact to update.
     :type contact_id: int
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :param current_user: Get the current user.
     :type current_user: User
     :return: The updated contact
     :rtype: Contact
     """
-    contact = await contacts.update_contact(contact_id, body, current_user, db)
+    try:
+        contact = await contacts.update_contact(contact_id, body, current_user, db)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail='CONTACT WITH THIS EMAIL OR PHONE ALREADY EXISTS')
+    if contact is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail='CONTACT NOT FOUND')
+    return contact
+
+
+@router.patch('/{contact_id}', response_model=ContactResponse,
+              description='No more than 10 requests per minute',
+              dependencies=[Depends(RateLimiter(times=10, seconds=60))])
+async def patch_contact(body: ContactUpdateSchema, contact_id: int, db: AsyncSession = Depends(get_db),
+                        current_user: User = Depends(auth_service.get_current_user)):
+    """
+    The patch_contact function updates only the fields supplied in the request body.
+
+    :param body: The fields to change.
+    :type body : ContactUpdateSchema
+    :param contact_id: Specify the id of the contact to update.
+    :type contact_id: int
+    :param db: The database session.
+    :type db: AsyncSession
+    :param current_user: Get the current user.
+    :type current_user: User
+    :return: The updated contact
+    :rtype: Contact
+    """
+    try:
+        contact = await contacts.patch_contact(contact_id, body, current_user, db)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail='CONTACT WITH THIS EMAIL OR PHONE ALREADY EXISTS')
     if contact is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail='CONTACT NOT FOUND')
@@ -131,7 +737,7 @@ async def update_contact(body: ContactSchema, contact_id: int, db: Session = Dep
 @router.delete('/{contact_id}', response_model=ContactResponse,
                description='No more than 10 requests per minute',
                dependencies=[Depends(RateLimiter(times=10, seconds=60))])
-async def delete_contact(contact_id: int, db: Session = Depends(get_db),
+async def delete_contact(contact_id: int, db: AsyncSession = Depends(get_db),
                          current_user: User = Depends(auth_service.get_current_user)):
     """
     Removes a single contact with the specified ID for a specific user.
@@ -143,33 +749,14 @@ async def delete_contact(contact_id: int, db: Session = Depends(get_db),
     :param contact_id: The ID of the contact to remove.
     :type contact_id: int
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :param current_user: The user to remove the contact for.
     :type current_user: User
     :return: The removed contact, or None if it does not exist.
     :rtype: Contact | None
     """
     contact = await contacts.delete_contact(contact_id, current_user, db)
-    return contact
-
-
-@router.get('/7', response_model=list[ContactResponse],
-            description='No more than 10 requests per minute',
-            dependencies=[Depends(RateLimiter(times=10, seconds=60))])
-async def get_contacts_birthdays(db: Session = Depends(get_db),
-                                 current_user: User = Depends(auth_service.get_current_user)):
-    """
-    The birthday_list function takes a user and database session as arguments.
-    It returns a list of contacts whose birthdays are within the next 7 days.
-        Args:
-            user (User): The current user, used for authorization purposes.
-
-    :param user: User: Get the user id from the database
-    :param db: Session: Access the database
-    :return: A list of contacts with birthdays in the next week    
-    """
-    contacts_ = await contacts.get_contacts_birthdays(current_user, db)
-    if contacts_ is None:
+    if contact is None:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail='CONTACTS NOT FOUND')
-    return contacts_
+            status_code=status.HTTP_404_NOT_FOUND, detail='CONTACT NOT FOUND')
+    return contact
@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import math
+import time
+import uuid
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+from cache import redis_client, BloomFilter
+from config import settings
+from metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshTokenStore:
+    """
+    The server-side state of refresh tokens, kept in Redis instead of the users table.
+
+    Every login starts a session, a token family: "rt:{family}" holds the id (jti) of the one refresh token
+    of the family that may still be used and expires together with it, so a user can have any number of sessions.
+    Refreshing swaps the jti with a compare-and-swap script; presenting a token of the family that has already
+    been exchanged is reuse, most likely of a stolen token, and ends the session.
+    Logout deletes the family key. Revoking all sessions increments "rt:gen:{user}", the generation
+    stamped into every refresh token, so all earlier tokens of the user are refused on their next use.
+    Tokens are signed JWTs, the store only keeps their random ids.
+    """
+
+    MISSING, ROTATED, REUSED, REVOKED = 0, 1, -1, -2
+
+    ROTATE = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return 0
+end
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[3] then
+    redis.call('DEL', KEYS[1])
+    return -2
+end
+if current ~= ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return -1
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[4])
+return 1
+"""
+
+    def __init__(self, client: redis.Redis, ttl: int):
+        self.client = client
+        self.ttl = ttl
+        self.rotate_script = client.register_script(self.ROTATE)
+
+    @staticmethod
+    def family_key(family: str) -> str:
+        return f"rt:{family}"
+
+    @staticmethod
+    def generation_key(user: str) -> str:
+        return f"rt:gen:{user}"
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    async def start(self, user: str) -> tuple[str, str, int]:
+        """
+        The start function opens a new session of the user.
+
+        :param user: The subject of the tokens.
+        :type user: str
+        :return: The family, the jti of the first refresh token and the current generation of the user.
+        :rtype: tuple[str, str, int]
+        """
+        family, jti = self.new_id(), self.new_id()
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(self.generation_key(user))
+        pipe.set(self.family_key(family), jti, ex=self.ttl)
+        generation, _ = await pipe.execute()
+        return family, jti, int(generation or 0)
+
+    async def rotate(self, user: str, family: str, jti: str, generation: int) -> str | None:
+        """
+        The rotate function exchanges the current refresh token of a session for a new one.
+        If the token is not the current one of its family, or the sessions of the user have been revoked,
+        the session is ended.
+
+        :param user: The subject of the token.
+        :type user: str
+        :param family: The fam claim of the token.
+        :type family: str
+        :param jti: The jti claim of the token.
+        :type jti: str
+        :param generation: The gen claim of the token.
+        :type generation: int
+        :return: The jti of the next refresh token, or None if the token may not be used.
+        :rtype: str | None
+        """
+        next_jti = self.new_id()
+        result = await self.rotate_script(keys=[self.family_key(family), self.generation_key(user)],
+                                          args=[jti, next_jti, generation, self.ttl])
+        if result == self.ROTATED:
+            return next_jti
+        if result == self.REUSED:
+            metrics.inc("refresh_token_reuse_total")
+        return None
+
+    async def generation(self, user: str) -> int:
+        """
+        The generation function returns the current generation of the user, raised by every revoke_all.
+
+        :param user: The subject of the tokens.
+        :type user: str
+        :return: The generation, 0 if the sessions of the user have never been revoked.
+        :rtype: int
+        """
+        return int(await self.client.get(self.generation_key(user)) or 0)
+
+    async def end(self, family: str) -> None:
+        """
+        The end function ends one session.
+
+        :param family: The fam claim of a token of the session.
+        :type family: str
+        :return: None
+        :rtype: None
+        """
+        await self.client.delete(self.family_key(family))
+
+    async def revoke_all(self, user: str) -> None:
+        """
+        The revoke_all function ends every session of the user.
+
+        :param user: The subject of the tokens.
+        :type user: str
+        :return: None
+        :rtype: None
+        """
+        await self.client.incr(self.generation_key(user))
+
+
+class RevocationList:
+    """
+    The access tokens revoked before their expiry. Redis holds the exact entries:
+    "revoked:jti:{jti}" for a single token and "revoked:user:{user}" holding a cutoff timestamp in nanoseconds,
+    every token of the user issued at or before it is revoked. Entries expire when the tokens they cover do.
+
+    Every worker mirrors the entry names into a Bloom filter, kept up to date by the revocation messages
+    published on a channel and rebuilt from Redis every rebuild_interval seconds to shed the expired entries.
+    While the filter is in sync a token it does not contain is known to be valid without any network I/O;
+    only the rare "maybe" and the time before the first sync go to Redis.
+    """
+
+    PREFIX = "revoked:"
+    CHANNEL = "revoked"
+
+    def __init__(self, client: redis.Redis, ttl: int, capacity: int, error_rate: float, rebuild_interval: int):
+        self.client = client
+        self.ttl = ttl
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.next_bloom: BloomFilter | None = None
+        self.synced = False
+        self.task: asyncio.Task | None = None
+
+    @staticmethod
+    def issued_at(payload: dict) -> int:
+        """
+        The issued_at function returns when an access token was issued, in nanoseconds.
+        Tokens without the iat_ns claim were issued before it existed, their second is taken as a whole.
+        """
+        if "iat_ns" in payload:
+            return payload["iat_ns"]
+        return payload.get("iat", 0) * 10 ** 9
+
+    @staticmethod
+    def entries(payload: dict) -> list[str]:
+        entries = [f"user:{payload['sub']}"]
+        if payload.get("jti"):
+            entries.append(f"jti:{payload['jti']}")
+        return entries
+
+    def add(self, entry: str) -> None:
+        self.bloom.add(entry)
+        if self.next_bloom is not None:
+            self.next_bloom.add(entry)
+
+    async def rebuild(self) -> None:
+        """
+        The rebuild function replaces the Bloom filter with one built from the entries in Redis.
+        Messages received meanwhile are added to both filters.
+
+        :return: None
+        :rtype: None
+        """
+        self.next_bloom = BloomFilter(self.capacity, self.error_rate)
+        try:
+            async for key in self.client.scan_iter(match=f"{self.PREFIX}*", count=1000):
+                self.next_bloom.add(key[len(self.PREFIX):].decode())
+            self.bloom = self.next_bloom
+        finally:
+            self.next_bloom = None
+
+    async def listen(self) -> None:
+        """
+        The listen function keeps the Bloom filter in sync until it is cancelled.
+        It subscribes before rebuilding, so no revocation is missed, and starts over after a Redis error.
+
+        :return: None
+        :rtype: None
+        """
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.CHANNEL)
+                await self.rebuild()
+                self.synced = True
+                rebuilt_at = time.monotonic()
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None:
+                        self.add(message["data"].decode())
+                    if time.monotonic() - rebuilt_at >= self.rebuild_interval:
+                        await self.rebuild()
+                        rebuilt_at = time.monotonic()
+            except RedisError as e:
+                logger.warning("Redis error in RevocationList.listen: %s", e)
+                self.synced = False
+                await asyncio.sleep(1)
+            finally:
+                self.synced = False
+                await pubsub.aclose()
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _revoke(self, entry: str, value: int, ttl: int) -> None:
+        pipe = self.client.pipeline(transaction=True)
+        pipe.set(f"{self.PREFIX}{entry}", value, ex=ttl)
+        pipe.publish(self.CHANNEL, entry)
+        await pipe.execute()
+        self.add(entry)
+
+    async def revoke_token(self, jti: str, expires_at: float) -> None:
+        """
+        The revoke_token function revokes one access token until it expires.
+
+        :param jti: The jti claim of the token.
+        :type jti: str
+        :param expires_at: The exp claim of the token.
+        :type expires_at: float
+        :return: None
+        :rtype: None
+        """
+        ttl = math.ceil(expires_at - time.time())
+        if ttl > 0:
+            await self._revoke(f"jti:{jti}", 1, ttl)
+
+    async def revoke_user(self, user: str) -> None:
+        """
+        The revoke_user function revokes every access token of the user issued until now.
+        The cutoff is compared with the iat_ns claim, so a token issued right after it, e.g. on the login
+        that follows a password change, stays valid.
+
+        :param user: The subject of the tokens.
+        :type user: str
+        :return: None
+        :rtype: None
+        """
+        await self._revoke(f"user:{user}", time.time_ns(), self.ttl)
+
+    async def is_revoked(self, payload: dict) -> bool:
+        """
+        The is_revoked function tells whether an access token has been revoked.
+
+        :param payload: The claims of the token.
+        :type payload: dict
+        :return: True if the token has been revoked.
+        :rtype: bool
+        :raises RedisError: If the filter could not rule the token out and Redis is unavailable,
+            the token must then be refused.
+        """
+        entries = self.entries(payload)
+        if self.synced and not any(entry in self.bloom for entry in entries):
+            metrics.inc("revocation_bloom_negative_total")
+            return False
+        metrics.inc("revocation_redis_check_total")
+        values = await self.client.mget([f"{self.PREFIX}{entry}" for entry in entries])
+        cutoff, revoked = values[0], len(values) > 1 and values[1] is not None
+        return revoked or (cutoff is not None and self.issued_at(payload) <= int(cutoff))
+
+
+refresh_tokens = RefreshTokenStore(redis_client, settings.refresh_token_ttl)
+
+revocation_list = RevocationList(redis_client, settings.access_token_ttl, settings.revocation_bloom_capacity,
+                                 settings.revocation_bloom_error_rate, settings.revocation_rebuild_interval)
+
+metrics.register("revocation_bloom_entries", lambda: len(revocation_list.bloom))
+metrics.register("revocation_bloom_synced", lambda: int(revocation_list.synced))
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, EmailStr
-from datetime import date, datetime
+from datetime import date
 
 
 class ContactSchema(BaseModel):
@@ -11,6 +11,15 @@ class ContactSchema(BaseModel):
     description: str = Field(max_length=250)
 
 
+class ContactUpdateSchema(BaseModel):
+    first_name: str | None = Field(None, min_length=1, max_length=20)
+    last_name: str | None = Field(None, min_length=2, max_length=20)
+    email: str | None = Field(None, min_length=10, max_length=50)
+    telephon_number: str | None = Field(None, min_length=7, max_length=12)
+    birthday: date | None = Field(None)
+    description: str | None = Field(None, max_length=250)
+
+
 class ContactResponse(BaseModel):
     contact_id: int
     first_name: str
@@ -24,6 +33,86 @@ class ContactResponse(BaseModel):
         from_attributes = True
 
 
+class ContactSuggestion(BaseModel):
+    contact_id: int
+    first_name: str
+    last_name: str
+    email: str
+
+
+class ContactPage(BaseModel):
+    items: list[ContactResponse]
+    next_cursor: str | None = None
+
+
+class ContactChanges(BaseModel):
+    changed: list[ContactResponse]
+    deleted: list[int]
+    next_since: str | None = None
+    has_more: bool
+
+
+class ContactIds(BaseModel):
+    ids: list[int] = Field(min_length=1, max_length=100)
+
+
+class ContactBatch(BaseModel):
+    items: list[ContactResponse]
+    not_found: list[int]
+
+
+class ContactBatchDelete(BaseModel):
+    deleted: list[int]
+    not_found: list[int]
+
+
+class ContactUpsertBatch(BaseModel):
+    items: list[ContactSchema] = Field(min_length=1, max_length=500)
+
+
+class ContactUpsertReport(BaseModel):
+    upserted: list[ContactResponse]
+    conflicts: list[str]
+
+
+class MonthCount(BaseModel):
+    month: int
+    count: int
+
+
+class WeekCount(BaseModel):
+    week: date
+    count: int
+
+
+class DomainCount(BaseModel):
+    domain: str
+    count: int
+
+
+class ContactStats(BaseModel):
+    total: int
+    birthdays_by_month: list[MonthCount]
+    added_by_week: list[WeekCount]
+    top_email_domains: list[DomainCount]
+
+
+class ContactMerge(BaseModel):
+    target_id: int
+    source_ids: list[int] = Field(min_length=1, max_length=20)
+
+
+class ContactImportError(BaseModel):
+    row: int
+    error: str
+
+
+class ContactImportReport(BaseModel):
+    inserted: int
+    duplicates: list[int]
+    errors: list[ContactImportError]
+
+
 class UserModel(BaseModel):
     username: str = Field(min_length=5, max_length=16)
     email: str
@@ -31,15 +120,13 @@ class UserModel(BaseModel):
 
 
 class UserDb(BaseModel):
-    id: int
+    user_id: int
     username: str
     email: str
-    password: str
-    created_at: datetime
-    avatar: str
+    avatar: str | None
 
     class Config:
-        orm_mode = True
+        from_attributes = True
 
 
 class UserResponse(BaseModel):
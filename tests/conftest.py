@@ -30,7 +30,7 @@ def init_models_wrap():
             await conn.run_sync(Base.metadata.drop_all)
             await conn.run_sync(Base.metadata.create_all)
         async with TestingSessionLocal() as session:
-            hash_password = auth_service.get_password_hash(
+            hash_password = await auth_service.get_password_hash(
                 test_user["password"])
             current_user = User(username=test_user["username"], email=test_user["email"], password=hash_password,
                                 confirmed=True)
@@ -51,6 +51,7 @@ def client():
         except Exception as err:
             print(err)
             await session.rollback()
+            raise
         finally:
             await session.close()
 
@@ -1,4 +1,4 @@
-from unittest.mock import Mock, MagicMock
+from unittest.mock import Mock, MagicMock, AsyncMock
 from conftest import TestingSessionLocal
 from models import User
 import pytest
@@ -15,9 +15,10 @@ def test_create_user(client, monkeypatch):
     response = client.post("api/auth/signup", json=user_data)
 
     assert response.status_code == 201, response.text
-    data = response.json()
+    data = response.json()["user"]
     assert data["email"] == user_data["email"]
     assert data["username"] == user_data["username"]
+    assert "user_id" in data
     assert "password" not in data
 
 
@@ -40,7 +41,10 @@ def test_login_user_not_confirmed(client):
 
 
 @pytest.mark.asyncio
-async def test_login_user(client):
+async def test_login_user(client, monkeypatch):
+    refresh_tokens = AsyncMock()
+    refresh_tokens.start.return_value = ('fam', 'jti', 0)
+    monkeypatch.setattr("auth.refresh_tokens", refresh_tokens)
     async with TestingSessionLocal() as session:
         current_user = await session.execute(select(User).where(User.email == user_data.get("email")))
         current_user = current_user.scalar_one_or_none()
@@ -0,0 +1,58 @@
+from unittest.mock import AsyncMock
+import pytest
+from fastapi_limiter import FastAPILimiter, default_identifier
+
+
+contact_data = {"first_name": "Stepan", "last_name": "Cat", "email": "stepan_cat@gmail.com",
+                "telephon_number": "0999998877", "birthday": "1990-05-17", "description": "cat"}
+
+other_contact_data = dict(contact_data, first_name="Murchyk", email="murchyk_cat@gmail.com",
+                          telephon_number="0501112233")
+
+
+@pytest.fixture(autouse=True)
+def no_redis(monkeypatch):
+    limiter = AsyncMock()
+    limiter.evalsha.return_value = 0
+    monkeypatch.setattr(FastAPILimiter, "redis", limiter)
+    monkeypatch.setattr(FastAPILimiter, "identifier", default_identifier)
+    monkeypatch.setattr("contacts.suggest_index", AsyncMock())
+    monkeypatch.setattr("contacts.response_cache", AsyncMock())
+    monkeypatch.setattr("auth.revocation_list.is_revoked", AsyncMock(return_value=False))
+
+
+def test_create_contact(client, get_token):
+    for data in (contact_data, other_contact_data):
+        response = client.post("api/contacts", json=data, headers={"Authorization": f"Bearer {get_token}"})
+        assert response.status_code == 201, response.text
+        assert response.json()["email"] == data["email"]
+
+
+@pytest.mark.parametrize("method", ["put", "patch"])
+def test_update_contact_email_clash(client, get_token, method):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    contacts = client.get("api/contacts", headers=headers).json()["items"]
+    contact_id = next(contact["contact_id"] for contact in contacts if contact["email"] == other_contact_data["email"])
+    body = dict(other_contact_data, email=contact_data["email"]) if method == "put" else {"email": contact_data["email"]}
+
+    response = client.request(method, f"api/contacts/{contact_id}", json=body, headers=headers)
+    assert response.status_code == 409, response.text
+    assert response.json()["detail"] == "CONTACT WITH THIS EMAIL OR PHONE ALREADY EXISTS"
+
+    response = client.patch(f"api/contacts/{contact_id}", json={"description": "still works"}, headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["email"] == other_contact_data["email"]
+
+
+def test_import_contacts(client, get_token):
+    data = ("first_name,last_name,email,telephon_number,birthday,description\n"
+            "Vaska,Cat,vaska_cat@gmail.com,0671234567,2015-03-01,cat\n"
+            "Stepan,Cat,stepan_cat@gmail.com,0671234568,1990-05-17,duplicate email\n"
+            "Tom,Cat,tom_cat@gmail.com,0671234569,,no birthday\n")
+    response = client.post("api/contacts/import", files={"file": ("contacts.csv", data, "text/csv")},
+                           headers={"Authorization": f"Bearer {get_token}"})
+    assert response.status_code == 200, response.text
+    report = response.json()
+    assert report["inserted"] == 1
+    assert report["duplicates"] == [3]
+    assert [error["row"] for error in report["errors"]] == [4]
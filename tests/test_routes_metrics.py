@@ -0,0 +1,19 @@
+def test_metrics_disabled(client, monkeypatch):
+    monkeypatch.setattr("main.settings.metrics_token", None)
+    response = client.get("api/metrics", headers={"Authorization": "Bearer anything"})
+    assert response.status_code == 404, response.text
+
+
+def test_metrics_without_token(client, monkeypatch, get_token):
+    monkeypatch.setattr("main.settings.metrics_token", "scraper-secret")
+    assert client.get("api/metrics").status_code == 401
+    # a user's access token is not the metrics token
+    response = client.get("api/metrics", headers={"Authorization": f"Bearer {get_token}"})
+    assert response.status_code == 401, response.text
+
+
+def test_metrics(client, monkeypatch):
+    monkeypatch.setattr("main.settings.metrics_token", "scraper-secret")
+    response = client.get("api/metrics", headers={"Authorization": "Bearer scraper-secret"})
+    assert response.status_code == 200, response.text
+    assert "revocation_bloom_synced" in response.json()
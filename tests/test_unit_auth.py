@@ -0,0 +1,100 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+from fastapi import HTTPException
+from jose import JWTError
+from redis.exceptions import ConnectionError
+from metrics import metrics
+from cache import LRUCache
+from models import User
+from auth import Auth
+
+
+class TestDecodeToken(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.auth = Auth()
+        self.auth.token_cache = LRUCache(10)
+
+    async def test_second_decode_is_cached(self):
+        token = await self.auth.create_access_token(data={'sub': 'andrew@google.com'})
+        hits = metrics.values['token_cache_hit_total']
+        payload = self.auth.decode_token(token)
+        with patch('auth.jwt.decode') as decode:
+            self.assertIs(self.auth.decode_token(token), payload)
+            decode.assert_not_called()
+        self.assertEqual(metrics.values['token_cache_hit_total'], hits + 1)
+        self.assertEqual(len(self.auth.token_cache), 1)
+
+    async def test_expired_entry_is_verified_again(self):
+        token = await self.auth.create_access_token(data={'sub': 'andrew@google.com'}, expires_delta=60)
+        payload = self.auth.decode_token(token)
+        key = next(iter(self.auth.token_cache._data))
+        self.auth.token_cache.set(key, payload, payload['exp'] - 120)
+        misses = metrics.values['token_cache_miss_total']
+        self.assertEqual(self.auth.decode_token(token)['sub'], 'andrew@google.com')
+        self.assertEqual(metrics.values['token_cache_miss_total'], misses + 1)
+
+    async def test_invalid_token_is_not_cached(self):
+        token = await self.auth.create_access_token(data={'sub': 'andrew@google.com'})
+        with self.assertRaises(JWTError):
+            self.auth.decode_token(token + 'x')
+        self.assertEqual(len(self.auth.token_cache), 0)
+
+    async def test_shared_by_refresh_and_email_tokens(self):
+        token = self.auth.create_email_token({'sub': 'andrew@google.com'})
+        self.assertEqual(await self.auth.get_email_from_token(token), 'andrew@google.com')
+        self.assertEqual(await self.auth.get_email_from_token(token), 'andrew@google.com')
+        self.assertEqual(len(self.auth.token_cache), 1)
+
+
+class TestGetCurrentUser(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.auth = Auth()
+        self.user = User(user_id=1, username='Andrew', email='andrew@google.com', password='hash')
+        self.db = AsyncMock()
+        self.cache, self.revocations, self.users = (self.patch(name) for name in (
+            'auth.user_cache', 'auth.revocation_list', 'auth.repository_users'))
+        self.revocations.is_revoked.return_value = False
+        self.cache.get.return_value = None
+
+    def patch(self, name):
+        patcher = patch(name, AsyncMock())
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    async def test_user_id_subject(self):
+        self.users.get_user_by_id.return_value = self.user
+        token = await self.auth.create_access_token(data=Auth.user_claims(self.user))
+        self.assertIs(await self.auth.get_current_user(token, self.db), self.user)
+        self.cache.get.assert_awaited_once_with(1)
+        self.users.get_user_by_id.assert_awaited_once_with(1, self.db)
+        self.cache.set.assert_awaited_once_with(self.user)
+
+    async def test_email_subject(self):
+        self.users.get_user_by_email.return_value = self.user
+        token = await self.auth.create_access_token(data={'sub': 'andrew@google.com'})
+        self.assertIs(await self.auth.get_current_user(token, self.db), self.user)
+        self.users.get_user_by_email.assert_awaited_once_with('andrew@google.com', self.db)
+        with patch('auth.settings.accept_email_subject_tokens', False):
+            with self.assertRaises(HTTPException):
+                await self.auth.get_current_user(token, self.db)
+
+    async def test_revoked_token(self):
+        self.revocations.is_revoked.return_value = True
+        token = await self.auth.create_access_token(data=Auth.user_claims(self.user))
+        with self.assertRaises(HTTPException) as e:
+            await self.auth.get_current_user(token, self.db)
+        self.assertEqual(e.exception.status_code, 401)
+
+    async def test_revocations_unavailable(self):
+        self.revocations.is_revoked.side_effect = ConnectionError()
+        token = await self.auth.create_access_token(data=Auth.user_claims(self.user))
+        with self.assertRaises(HTTPException) as e:
+            await self.auth.get_current_user(token, self.db)
+        self.assertEqual(e.exception.status_code, 503)
+        self.users.get_user_by_id.assert_not_awaited()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+import orjson
+from redis.exceptions import ConnectionError
+from models import User
+from metrics import metrics
+from cache import LRUCache, BloomFilter, UserCache, SuggestIndex, ResponseCache, InstrumentedRedis
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1, time.time() + 60)
+        cache.set('b', 2, time.time() + 60)
+        cache.get('a')
+        cache.set('c', 3, time.time() + 60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expired_entry(self):
+        cache = LRUCache(2)
+        cache.set('a', 1, time.time() - 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1, time.time() + 60)
+        self.assertIsNone(cache.get('a'))
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f'jti:{i}')
+        self.assertTrue(all(f'jti:{i}' in bloom for i in range(1000)))
+        self.assertEqual(len(bloom), 1000)
+        false_positives = sum(f'other:{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class TestUserCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.client = AsyncMock()
+        self.cache = UserCache(self.client, ttl=60, local_size=10)
+        self.user = User(user_id=1, username='Andrew', email='andrew@google.com', password='hash')
+
+    async def test_get_from_redis(self):
+        self.client.get.return_value = UserCache.dumps(self.user)
+        result = await self.cache.get(self.user.user_id)
+        self.assertEqual(result.user_id, self.user.user_id)
+        self.assertEqual(result.email, self.user.email)
+        self.client.get.assert_awaited_once_with('user:1')
+
+    def test_serialization(self):
+        data = UserCache.dumps(self.user)
+        self.assertEqual(orjson.loads(data)['username'], 'Andrew')
+        self.assertNotIn('password', orjson.loads(data))
+        user = UserCache.loads(data[:-1] + b',"removed_column":1}')
+        self.assertIsInstance(user, User)
+        self.assertEqual((user.user_id, user.email), (1, 'andrew@google.com'))
+        self.assertIsNone(user.password)
+
+    async def test_get_from_local_tier(self):
+        await self.cache.set(self.user)
+        result = await self.cache.get(self.user.user_id)
+        self.assertEqual((result.user_id, result.email), (1, 'andrew@google.com'))
+        self.assertIsNone(result.password)
+        self.client.get.assert_not_awaited()
+
+    async def test_invalidate(self):
+        await self.cache.set(self.user)
+        self.client.get.return_value = None
+        await self.cache.invalidate(self.user.user_id)
+        self.assertIsNone(await self.cache.get(self.user.user_id))
+        self.client.delete.assert_awaited_once_with('user:1')
+
+    async def test_redis_unavailable(self):
+        self.client.get.side_effect = ConnectionError()
+        self.assertIsNone(await self.cache.get(self.user.user_id))
+
+
+class TestSuggestIndex(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.pipe = self.client.pipeline.return_value
+        self.pipe.execute = AsyncMock()
+        self.client.hmget = AsyncMock()
+        self.pipe.hmget = AsyncMock()
+        self.pipe.hget = AsyncMock()
+
+        async def transaction(func, *watches, value_from_callable=False):
+            value = await func(self.pipe)
+            return value if value_from_callable else await self.pipe.execute()
+
+        self.client.transaction = transaction
+        self.index = SuggestIndex(self.client, ttl=60)
+
+    def test_members(self):
+        members = SuggestIndex.members(7, 'Stepan', 'The Cat', 'Cat@Gmail.com')
+        self.assertEqual(sorted(members), ['cat@gmail.com\x007', 'stepan\x007',
+                                           'stepan the cat\x007', 'the cat\x007'])
+
+    async def test_suggest_not_built(self):
+        self.pipe.execute.return_value = [False, []]
+        self.assertIsNone(await self.index.suggest(1, 'ste', 10))
+
+    async def test_suggest_deduplicates_contacts(self):
+        entry = orjson.dumps({'contact_id': 7, 'first_name': 'Stepan', 'last_name': 'Stone', 'email': 's@mail.com'})
+        self.pipe.execute.return_value = [True, [b'stepan\x007', b'stepan stone\x007', b'stone\x007', b'stoney\x008']]
+        self.client.hmget.return_value = [entry, None]
+        result = await self.index.suggest(1, 'St', 2)
+        self.assertEqual(result, [orjson.loads(entry)])
+        self.pipe.zrangebylex.assert_called_once_with('suggest:1', b'[st', b'[st\xff', 0, 8)
+        self.client.hmget.assert_awaited_once_with('suggest:1:contacts', [b'7', b'8'])
+
+    async def test_redis_unavailable(self):
+        self.pipe.execute.side_effect = ConnectionError()
+        self.assertIsNone(await self.index.suggest(1, 'ste', 10))
+
+    async def test_add_replaces_previous_terms(self):
+        old = orjson.dumps({'contact_id': 7, 'first_name': 'Stepan', 'last_name': 'Stone', 'email': 's@mail.com'})
+        self.pipe.hmget.return_value = [old]
+        contact = MagicMock(contact_id=7, first_name='Stefan', last_name='Stone', email='s@mail.com')
+        await self.index.add(1, [contact])
+        self.pipe.hmget.assert_awaited_once_with('suggest:1:contacts', [7])
+        self.pipe.multi.assert_called_once()
+        self.pipe.hdel.assert_any_call('suggest:1:contacts', SuggestIndex.BUILDING)
+        self.pipe.zrem.assert_called_once_with('suggest:1', *SuggestIndex.members(7, 'Stepan', 'Stone', 's@mail.com'))
+        self.pipe.hset.assert_called_once_with('suggest:1:contacts', 7, SuggestIndex._entry(contact))
+
+    async def test_build(self):
+        self.pipe.hget.return_value = b'token'
+        contact = MagicMock(contact_id=7, first_name='Stepan', last_name='Stone', email='s@mail.com')
+        self.assertTrue(await self.index.build(1, [contact], 'token'))
+        self.pipe.delete.assert_called_once_with('suggest:1', 'suggest:1:contacts')
+        self.pipe.hset.assert_called_once_with('suggest:1:contacts', mapping={SuggestIndex.READY: b'1',
+                                                                              7: SuggestIndex._entry(contact)})
+
+    async def test_build_after_change(self):
+        # an add or remove since begin_build cleared the token, the rows may be older than the index
+        self.pipe.hget.return_value = None
+        contact = MagicMock(contact_id=7, first_name='Stepan', last_name='Stone', email='s@mail.com')
+        self.assertFalse(await self.index.build(1, [contact], 'token'))
+        self.pipe.delete.assert_not_called()
+        self.pipe.hset.assert_not_called()
+
+
+class TestResponseCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.pipe = self.client.pipeline.return_value
+        self.pipe.execute = AsyncMock()
+        self.client.get = AsyncMock()
+        self.client.set = AsyncMock()
+        self.cache = ResponseCache(self.client, ttl=60)
+
+    def test_key_ignores_param_order(self):
+        self.assertEqual(ResponseCache.key(1, 5, 'list', {'a': 1, 'b': None}),
+                         ResponseCache.key(1, 5, 'list', {'b': None, 'a': 1}))
+        self.assertNotEqual(ResponseCache.key(1, 5, 'list', {'a': 1}), ResponseCache.key(1, 6, 'list', {'a': 1}))
+
+    def test_etag_follows_version(self):
+        etag = ResponseCache.etag(1, 5, 'list', {'a': 1})
+        self.assertTrue(etag.startswith('"1-5-') and etag.endswith('"'))
+        self.assertNotEqual(etag, ResponseCache.etag(1, 6, 'list', {'a': 1}))
+        self.assertNotEqual(etag, ResponseCache.etag(1, 5, 'birthdays', {'a': 1}))
+
+    async def test_version_initialised(self):
+        self.pipe.execute.return_value = [True, b'42']
+        self.assertEqual(await self.cache.version(1), 42)
+        self.assertEqual(self.pipe.set.call_args.kwargs, {'nx': True})
+
+    async def test_get_hit(self):
+        self.client.get.return_value = b'[]'
+        body = await self.cache.get(1, 42, 'list', {'a': 1})
+        self.assertEqual(body, b'[]')
+        self.client.get.assert_awaited_once_with(ResponseCache.key(1, 42, 'list', {'a': 1}))
+
+    async def test_bump_initialises_missing_version(self):
+        await self.cache.bump(1)
+        self.pipe.set.assert_called_once()
+        self.assertEqual(self.pipe.set.call_args.kwargs, {'nx': True})
+        self.pipe.incr.assert_called_once_with('contacts:version:1')
+
+    async def test_redis_unavailable(self):
+        self.pipe.execute.side_effect = ConnectionError()
+        self.client.get.side_effect = ConnectionError()
+        self.assertIsNone(await self.cache.version(1))
+        self.assertIsNone(await self.cache.get(1, 42, 'list', {}))
+
+
+class TestInstrumentedRedis(unittest.IsolatedAsyncioTestCase):
+
+    async def test_failed_command_is_measured(self):
+        client = InstrumentedRedis(host='localhost', port=1, socket_connect_timeout=0.1)
+        count = metrics.values['redis_command_seconds_count']
+        errors = metrics.values['redis_command_errors_total']
+        with self.assertRaises(ConnectionError):
+            await client.get('key')
+        with self.assertRaises(ConnectionError):
+            await client.pipeline().get('key').execute()
+        self.assertEqual(metrics.values['redis_command_seconds_count'], count + 2)
+        self.assertEqual(metrics.values['redis_command_errors_total'], errors + 2)
+        await client.aclose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from types import SimpleNamespace
+from dedup import DisjointSet, find_clusters
+from models import normalize_email, normalize_phone, derived_columns
+
+
+def contact(contact_id, first_name, last_name, email, phone):
+    return SimpleNamespace(contact_id=contact_id, first_name=first_name, last_name=last_name,
+                           email_normalized=normalize_email(email), phone_normalized=normalize_phone(phone))
+
+
+class TestNormalize(unittest.TestCase):
+
+    def test_normalize_phone(self):
+        for phone in ['0999998877', '099-999-88-77', '(099) 999 88 77', '380999998877', '+380999998877',
+                      '00380999998877']:
+            self.assertEqual(normalize_phone(phone, '380'), '+380999998877')
+        self.assertEqual(normalize_phone('+1 212 555 0100', '380'), '+12125550100')
+
+    def test_normalize_email(self):
+        self.assertEqual(normalize_email(' Cat_Stepan@Gmail.com '), 'cat_stepan@gmail.com')
+
+    def test_derived_columns(self):
+        self.assertEqual(derived_columns({'description': 'x'}), {})
+        self.assertEqual(derived_columns({'email': 'A@b.com'}), {'email_normalized': 'a@b.com'})
+
+
+class TestFindClusters(unittest.TestCase):
+
+    def setUp(self):
+        self.blocking_keys = [lambda row: row.email_normalized, lambda row: row.phone_normalized]
+        self.name_keys = [lambda row: f"{row.last_name} {row.first_name}".lower(),
+                          lambda row: f"{row.first_name} {row.last_name}".lower()]
+
+    def test_disjoint_set(self):
+        links = DisjointSet()
+        links.union(1, 2)
+        links.union(3, 4)
+        links.union(2, 4)
+        links.find(5)
+        self.assertEqual(links.groups(), [[1, 2, 3, 4]])
+
+    def test_blocking_keys_are_transitive(self):
+        rows = [contact(1, 'Stepan', 'Cat', 'cat@gmail.com', '0999998877'),
+                contact(2, 'Murchyk', 'Kotyk', 'CAT@gmail.com', '0501112233'),
+                contact(3, 'Vaska', 'Pes', 'pes@gmail.com', '+38 050 111 22 33'),
+                contact(4, 'Bob', 'Jones', 'bob@gmail.com', '0661234567')]
+        clusters = find_clusters(rows, self.blocking_keys, self.name_keys)
+        self.assertEqual([[row.contact_id for row in cluster] for cluster in clusters], [[1, 2, 3]])
+
+    def test_similar_names(self):
+        rows = [contact(1, 'Stepan', 'Cat', 'a@gmail.com', '0999990001'),
+                contact(2, 'Stepan', 'Catt', 'b@gmail.com', '0999990002'),
+                contact(3, 'Bob', 'Jones', 'c@gmail.com', '0999990003')]
+        clusters = find_clusters(rows, self.blocking_keys, self.name_keys, threshold=0.9)
+        self.assertEqual([[row.contact_id for row in cluster] for cluster in clusters], [[1, 2]])
+        self.assertEqual(find_clusters(rows, self.blocking_keys, self.name_keys, threshold=1.0), [])
+
+    def test_window_limits_comparisons(self):
+        rows = [contact(i, f'Name{i:03d}', 'Same', f'{i}@gmail.com', f'09999{i:05d}') for i in range(20)]
+        rows.append(contact(99, 'Stepan', 'Cat', 'z@gmail.com', '0501112233'))
+        clusters = find_clusters(rows, self.blocking_keys, self.name_keys, window=2, threshold=0.99)
+        self.assertEqual(clusters, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
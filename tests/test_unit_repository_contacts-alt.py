@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import MagicMock, AsyncMock
+from unittest.mock import MagicMock, AsyncMock, patch
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from models import Contact, User
@@ -18,6 +18,12 @@ from contacts import (
 class TestNotes(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
+        suggest_index = patch('contacts.suggest_index', AsyncMock())
+        self.suggest_index = suggest_index.start()
+        self.addCleanup(suggest_index.stop)
+        response_cache = patch('contacts.response_cache', AsyncMock())
+        self.response_cache = response_cache.start()
+        self.addCleanup(response_cache.stop)
         self.session = AsyncMock(spec=AsyncSession)
         self.user = User(user_id=1, username='Peter',
                          email='pete@mail.py', password='12345678')
@@ -30,9 +36,9 @@ class TestNotes(unittest.IsolatedAsyncioTestCase):
                     Contact(contact_id=3, first_name='Ele', last_name='Kole',
                             telephon_number='380991112244', birthday='29.12.2001', user_id=1)]
         mocked_contacts = MagicMock()
-
-        self.session.query().filter().all.return_value = contacts
-        result = await get_contacts(contact_field=None, user=self.user, db=self.session)
+        mocked_contacts.all.return_value = contacts
+        self.session.execute.return_value = mocked_contacts
+        result, next_cursor = await get_contacts(contact_field=None, user=self.user, db=self.session)
         self.assertEqual(result, contacts)
 
 
@@ -1,10 +1,12 @@
 import unittest
-from unittest.mock import MagicMock, AsyncMock
+import uuid
+from unittest.mock import MagicMock, AsyncMock, patch
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects import sqlite
 from models import Contact, User
 from datetime import date, datetime, timedelta
-from shemas import ContactSchema, ContactResponse, UserModel, UserResponse
+from shemas import ContactSchema, ContactUpdateSchema, ContactResponse, UserModel, UserResponse
 from contacts import (
     get_contacts,
     get_contact,
@@ -12,13 +14,37 @@ from contacts import (
     update_contact,
     delete_contact,
     get_contacts_birthdays,
+    decode_cursor,
+    birthday_window,
+    import_contacts,
+    patch_contact,
+    search_contacts,
+    search_terms,
+    suggest_contacts,
+    get_changes,
+    encode_sync_token,
+    decode_sync_token,
+    get_contacts_by_ids,
+    delete_contacts,
+    upsert_contacts,
+    parse_fields,
+    get_contact_stats,
+    merge_contacts,
 )
+from conftest import TestingSessionLocal
 
 
 class TestNotes(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
-        self.session = MagicMock(spec=Session)
+        suggest_index = patch('contacts.suggest_index', AsyncMock())
+        self.suggest_index = suggest_index.start()
+        self.addCleanup(suggest_index.stop)
+        response_cache = patch('contacts.response_cache', AsyncMock())
+        self.response_cache = response_cache.start()
+        self.addCleanup(response_cache.stop)
+        self.session = AsyncMock(spec=AsyncSession)
+        self.session.execute.return_value = MagicMock()
         self.user = User(user_id=1)
         self.contact = ContactSchema(
             first_name='Stepan',
@@ -32,55 +58,191 @@ class TestNotes(unittest.IsolatedAsyncioTestCase):
 
     async def test_get_contacts(self):
         contacts = [Contact(), Contact(), Contact()]
-        self.session.query().filter().all.return_value = contacts
-        result = await get_contacts(contact_field=None, user=self.user, db=self.session)
+        self.session.execute.return_value.all.return_value = contacts
+        result, next_cursor = await get_contacts(contact_field=None, user=self.user, db=self.session)
         self.assertEqual(result, contacts)
+        self.assertIsNone(next_cursor)
 
     async def test_get_contacts_with_field(self):
         contacts = [Contact(), Contact(), Contact()]
-        self.session.query().filter().all.return_value = contacts
-        result = await get_contacts(contact_field='The Cat', user=self.user, db=self.session)
+        self.session.execute.return_value.all.return_value = contacts
+        result, next_cursor = await get_contacts(contact_field='The Cat', user=self.user, db=self.session)
         self.assertEqual(result, contacts)
-    '''
+
+    async def test_get_contacts_with_fields(self):
+        self.session.execute.return_value.all.return_value = []
+        await get_contacts(contact_field=None, user=self.user, db=self.session, fields=['first_name'])
+        stmt = self.session.execute.await_args.args[0]
+        self.assertEqual([column.name for column in stmt.selected_columns], ['first_name', 'last_name', 'contact_id'])
+
+    def test_parse_fields(self):
+        self.assertEqual(parse_fields('last_name, contact_id,last_name'), ['contact_id', 'last_name'])
+        self.assertIsNone(parse_fields(None))
+        self.assertIsNone(parse_fields(' , '))
+        with self.assertRaises(ValueError):
+            parse_fields('first_name,password')
+
+    async def test_get_contacts_next_page(self):
+        contacts = [Contact(contact_id=i, last_name='Cat') for i in range(1, 4)]
+        self.session.execute.return_value.all.return_value = contacts
+        result, next_cursor = await get_contacts(contact_field=None, user=self.user, db=self.session, limit=2)
+        self.assertEqual(result, contacts[:2])
+        self.assertEqual(decode_cursor(next_cursor), ('Cat', 2))
+
+    async def test_get_contacts_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            await get_contacts(contact_field=None, user=self.user, db=self.session, cursor='not-a-cursor')
+
     async def test_get_contact_found(self):
         contact = Contact()
-        self.session.query().filter_by().first.return_value = contact
+        self.session.execute.return_value.scalar_one_or_none.return_value = contact
         result = await get_contact(contact_id=1, user=self.user, db=self.session)
         self.assertEqual(result, contact)
 
     async def test_get_contact_not_found(self):
-        self.session.query().filter_by().return_value.first.return_value = None
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
         result = await get_contact(contact_id=1, user=self.user, db=self.session)
         self.assertIsNone(result)
-    '''
+
+    def test_search_terms(self):
+        self.assertEqual(search_terms('Joh "Smith"; DROP'), ['joh', 'smith', 'drop'])
+
+    async def test_get_changes(self):
+        live = MagicMock(seq=4, changed_id=1, deleted=False, **self.contact.model_dump(), contact_id=1)
+        tombstone = MagicMock(seq=5, changed_id=2, deleted=True, contact_id=None)
+        self.session.execute.return_value.all.return_value = [live, tombstone]
+        result = await get_changes(user=self.user, db=self.session, since=encode_sync_token(3, 7))
+        self.assertEqual([contact['contact_id'] for contact in result['changed']], [1])
+        self.assertEqual(result['deleted'], [2])
+        self.assertEqual(decode_sync_token(result['next_since']), (5, 2))
+        self.assertFalse(result['has_more'])
+
+    async def test_get_changes_nothing_new(self):
+        self.session.execute.return_value.all.return_value = []
+        since = encode_sync_token(3, 7)
+        result = await get_changes(user=self.user, db=self.session, since=since, limit=10)
+        self.assertEqual(result, {'changed': [], 'deleted': [], 'next_since': since, 'has_more': False})
+
+    async def test_get_changes_invalid_token(self):
+        with self.assertRaises(ValueError):
+            await get_changes(user=self.user, db=self.session, since='bm90IGEgdG9rZW4')
+
+    async def test_search_contacts_empty_query(self):
+        result = await search_contacts('*" ', user=self.user, db=self.session)
+        self.assertEqual(result, [])
+        self.session.execute.assert_not_awaited()
+
+    async def test_suggest_contacts_from_index(self):
+        suggestions = [{'contact_id': 1, 'first_name': 'Stepan', 'last_name': 'The Cat', 'email': 'cat_stepan@gmail.com'}]
+        self.suggest_index.suggest.return_value = suggestions
+        result = await suggest_contacts('ste', user=self.user, db=self.session)
+        self.assertEqual(result, suggestions)
+        self.session.execute.assert_not_awaited()
+
+    async def test_suggest_contacts_builds_index(self):
+        rows = [MagicMock()]
+        self.suggest_index.suggest.side_effect = [None, []]
+        self.suggest_index.begin_build.return_value = 'token'
+        self.session.execute.return_value.all.return_value = rows
+        result = await suggest_contacts('ste', user=self.user, db=self.session)
+        self.assertEqual(result, [])
+        self.suggest_index.build.assert_awaited_once_with(1, rows, 'token')
 
     async def test_create_contact(self):
         body = self.contact
         result = await create_contact(body=body, user=self.user, db=self.session)
+        self.suggest_index.add.assert_awaited_once_with(1, [result])
+        self.response_cache.bump.assert_awaited_once_with(1)
         self.assertEqual(result.first_name, body.first_name)
         self.assertEqual(result.last_name, body.last_name)
         self.assertEqual(result.email, body.email)
         self.assertEqual(result.telephon_number, body.telephon_number)
         self.assertEqual(result.birthday, body.birthday)
         self.assertTrue(hasattr(result, "contact_id"))
-    '''
-    async def test_remove_contact_found(self):
-        contact_id = 1
-        contact = Contact(contact_id=contact_id)
-        self.session.query(Contact).filter_by().first.return_value = contact
-        result = await delete_contact(contact_id, user=self.user, db=self.session)
-        self.assertEqual(result, contact)
-    
+
+    async def test_get_contacts_by_ids(self):
+        contacts = [Contact(contact_id=1), Contact(contact_id=3)]
+        self.session.execute.return_value.all.return_value = contacts
+        result = await get_contacts_by_ids([1, 2, 3], user=self.user, db=self.session)
+        self.assertEqual(result, contacts)
+        self.session.execute.assert_awaited_once()
+
+    async def test_delete_contacts(self):
+        self.session.execute.return_value.scalars.return_value.all.return_value = [1, 3]
+        result = await delete_contacts([1, 2, 3], user=self.user, db=self.session)
+        self.assertEqual(result, [1, 3])
+        self.session.commit.assert_awaited_once()
+        self.suggest_index.remove.assert_awaited_once_with(1, [1, 3])
+
+    async def test_delete_contacts_none_found(self):
+        self.session.execute.return_value.scalars.return_value.all.return_value = []
+        result = await delete_contacts([5], user=self.user, db=self.session)
+        self.assertEqual(result, [])
+        self.session.execute.assert_awaited_once()
+        self.response_cache.bump.assert_not_awaited()
+
+    async def test_upsert_contacts(self):
+        row = MagicMock(contact_id=1, email=self.contact.email)
+        self.session.execute.return_value.all.return_value = [row]
+        changed = self.contact.model_copy(update={'first_name': 'Murchyk'})
+        result = await upsert_contacts([self.contact, changed], user=self.user, db=self.session)
+        self.assertEqual(result, [row])
+        stmt = self.session.execute.await_args_list[0].args[0]
+        params = stmt.compile(dialect=sqlite.dialect()).params
+        self.assertEqual(params['first_name_m0'], 'Murchyk')
+        self.assertNotIn('first_name_m1', params)
+        self.session.commit.assert_awaited_once()
+        self.suggest_index.add.assert_awaited_once_with(1, [row])
+
+    async def test_upsert_contacts_owned_by_other_user(self):
+        self.session.execute.return_value.all.return_value = []
+        result = await upsert_contacts([self.contact], user=self.user, db=self.session)
+        self.assertEqual(result, [])
+        self.session.execute.assert_awaited_once()
+        self.response_cache.bump.assert_not_awaited()
+
+    async def test_merge_contacts(self):
+        target = Contact(contact_id=1, description='Cat')
+        sources = [Contact(contact_id=2, description='Cat'), Contact(contact_id=3, description='Supa')]
+        self.session.execute.return_value.scalars.return_value.all.return_value = [target, *sources]
+        result = await merge_contacts(1, [2, 3], user=self.user, db=self.session)
+        self.assertIs(result, target)
+        self.assertEqual(target.description, 'Cat\nSupa')
+        self.session.commit.assert_awaited_once()
+        self.suggest_index.remove.assert_awaited_once_with(1, [2, 3])
+
+    async def test_merge_contacts_not_found(self):
+        self.session.execute.return_value.scalars.return_value.all.return_value = [Contact(contact_id=1)]
+        result = await merge_contacts(1, [2], user=self.user, db=self.session)
+        self.assertIsNone(result)
+        self.session.commit.assert_not_awaited()
+
+    async def test_merge_contacts_without_sources(self):
+        for source_ids in ([], [1]):
+            with self.assertRaises(ValueError):
+                await merge_contacts(1, source_ids, user=self.user, db=self.session)
+        self.session.execute.assert_not_awaited()
+
     async def test_remove_contact_not_found(self):
-        self.session.query(Contact).filter().first.return_value = None
-        self.session.commit.return_value = None
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
         result = await delete_contact(contact_id=1, user=self.user, db=self.session)
-        print(result)
-        self.assertIsNone(result)'''
+        self.assertIsNone(result)
+
+    async def test_import_contacts(self):
+        duplicate = self.contact.model_copy(update={'telephon_number': '0999990000'})
+        other = self.contact.model_copy(update={'email': 'cat_murchyk@gmail.com', 'telephon_number': '0999991111'})
+        rows = [(2, self.contact, None), (3, None, 'birthday: Field required'), (4, duplicate, None), (5, other, None)]
+        self.session.execute.return_value.all.return_value = [(1, self.contact.email)]
+        result = await import_contacts(rows, user=self.user, db=self.session)
+        self.assertEqual(result['inserted'], 1)
+        self.assertEqual(result['duplicates'], [4, 5])
+        self.assertEqual(result['errors'], [{'row': 3, 'error': 'birthday: Field required'}])
+        self.session.commit.assert_awaited_once()
 
     async def test_update_contact_found(self):
         body = self.contact
-        self.session.commit.return_value = None
+        self.session.execute.return_value.scalar_one_or_none.return_value = Contact(
+            **body.model_dump(), contact_id=1)
         result = await update_contact(contact_id=1, body=body, user=self.user, db=self.session)
         self.assertEqual(result.first_name, body.first_name)
         self.assertEqual(result.last_name, body.last_name)
@@ -89,29 +251,117 @@ class TestNotes(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(result.birthday, body.birthday)
         # self.assertTrue(hasattr(result, "contact_id"))
 
+    async def test_patch_contact_empty_body(self):
+        contact = Contact(contact_id=1)
+        self.session.execute.return_value.scalar_one_or_none.return_value = contact
+        result = await patch_contact(contact_id=1, body=ContactUpdateSchema(), user=self.user, db=self.session)
+        self.assertEqual(result, contact)
+        self.session.commit.assert_not_awaited()
+
     async def test_update_note_not_found(self):
         body = self.contact
-        self.session.query().filter().first.return_value = None
-        self.session.commit.return_value = None
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
         result = await update_contact(contact_id=1, body=body, user=self.user, db=self.session)
         self.assertIsNone(result)
-    '''
-    async def test_birthday_list_found(self):
-        contacts = [Contact(birthday=datetime.now() + timedelta(days=1)),
-                    Contact(birthday=datetime.now() + timedelta(days=2)),
-                    Contact(birthday=datetime.now() + timedelta(days=3)),
-                    Contact(birthday=datetime.now() + timedelta(days=4)),
-                    Contact(birthday=datetime.now() + timedelta(days=5)),
-                    Contact(birthday=datetime.now() + timedelta(days=6)),
-                    Contact(birthday=datetime.now() + timedelta(days=7)),
-                    Contact(birthday=datetime.now() + timedelta(days=8)),
-                    Contact(birthday=datetime.now() + timedelta(days=9)),
-                    Contact(birthday=datetime.now() + timedelta(days=10)),
-                    ]
-        self.session.query().filter().all.return_value = contacts
-        result = await get_contacts_birthdays(user=self.user, db=self.session)
-        self.assertEqual(result, contacts[0:7])
-        '''
+
+    async def test_get_contact_stats(self):
+        this_week = date.today() - timedelta(days=date.today().weekday())
+        total, months, weeks, domains = MagicMock(), MagicMock(), MagicMock(), MagicMock()
+        total.scalar_one.return_value = 3
+        months.all.return_value = [(1, 2), (12, 1)]
+        weeks.all.return_value = [(this_week.isoformat(), 3)]
+        domains.all.return_value = [('gmail.com', 3)]
+        self.session.execute.side_effect = [total, months, weeks, domains]
+        result = await get_contact_stats(user=self.user, db=self.session, weeks=2)
+        self.assertEqual(result['total'], 3)
+        self.assertEqual(len(result['birthdays_by_month']), 12)
+        self.assertEqual(result['birthdays_by_month'][0], {'month': 1, 'count': 2})
+        self.assertEqual(result['birthdays_by_month'][1], {'month': 2, 'count': 0})
+        self.assertEqual(result['added_by_week'], [{'week': this_week - timedelta(weeks=1), 'count': 0},
+                                                   {'week': this_week, 'count': 3}])
+        self.assertEqual(result['top_email_domains'], [{'domain': 'gmail.com', 'count': 3}])
+
+    def test_birthday_window(self):
+        self.assertEqual(birthday_window(date(2024, 3, 10), 7), (310, 316))
+
+    def test_birthday_window_new_year(self):
+        self.assertEqual(birthday_window(date(2024, 12, 28), 7), (1228, 103))
+
+    def test_birthday_window_leap_day(self):
+        self.assertEqual(birthday_window(date(2023, 2, 22), 7), (222, 229))
+        self.assertEqual(birthday_window(date(2024, 2, 22), 7), (222, 228))
+
+    def test_birthday_window_whole_year(self):
+        self.assertIsNone(birthday_window(date(2024, 3, 10), 366))
+
+
+class TestContactsDatabase(unittest.IsolatedAsyncioTestCase):
+    """
+    The queries themselves, run against the SQLite database of the test session.
+    """
+
+    async def asyncSetUp(self):
+        suggest_index = patch('contacts.suggest_index', AsyncMock())
+        suggest_index.start()
+        self.addCleanup(suggest_index.stop)
+        response_cache = patch('contacts.response_cache', AsyncMock())
+        response_cache.start()
+        self.addCleanup(response_cache.stop)
+        self.db = TestingSessionLocal()
+        self.addAsyncCleanup(self.db.close)
+        self.user, self.other_user = (User(username='cat', email=f'{uuid.uuid4().hex}@example.com', password='hash')
+                                      for _ in range(2))
+        self.db.add_all([self.user, self.other_user])
+        await self.db.commit()
+
+    async def add_contact(self, user: User, number: int, birthday: date = date(1990, 5, 17)) -> Contact:
+        body = ContactSchema(first_name='Stepan', last_name=f'Cat {number}', email=f'cat{number}@{user.email}',
+                             telephon_number=f'09{user.user_id:04d}{number:04d}', birthday=birthday,
+                             description='cat')
+        return await create_contact(body=body, user=user, db=self.db)
+
+    async def test_delete_contact(self):
+        contact = await self.add_contact(self.user, 1)
+        since = (await get_changes(user=self.user, db=self.db))['next_since']
+        result = await delete_contact(contact.contact_id, user=self.user, db=self.db)
+        self.assertEqual(result.contact_id, contact.contact_id)
+        self.assertIsNone(await get_contact(contact.contact_id, user=self.user, db=self.db))
+        changes = await get_changes(user=self.user, db=self.db, since=since)
+        self.assertEqual((changes['changed'], changes['deleted']), ([], [contact.contact_id]))
+
+    async def test_delete_contact_of_other_user(self):
+        contact = await self.add_contact(self.other_user, 1)
+        self.assertIsNone(await delete_contact(contact.contact_id, user=self.user, db=self.db))
+        self.assertIsNotNone(await get_contact(contact.contact_id, user=self.other_user, db=self.db))
+
+    async def test_patch_contact(self):
+        contact = await self.add_contact(self.user, 1)
+        since = (await get_changes(user=self.user, db=self.db))['next_since']
+        result = await patch_contact(contact.contact_id, body=ContactUpdateSchema(description='SupaCat'),
+                                     user=self.user, db=self.db)
+        self.assertEqual((result.description, result.email), ('SupaCat', contact.email))
+        async with TestingSessionLocal() as db:
+            stored = await get_contact(contact.contact_id, user=self.user, db=db)
+        self.assertEqual((stored.description, stored.last_name), ('SupaCat', 'Cat 1'))
+        changes = await get_changes(user=self.user, db=self.db, since=since)
+        self.assertEqual([changed['contact_id'] for changed in changes['changed']], [contact.contact_id])
+
+    async def test_patch_contact_of_other_user(self):
+        contact = await self.add_contact(self.other_user, 1)
+        result = await patch_contact(contact.contact_id, body=ContactUpdateSchema(description='SupaCat'),
+                                     user=self.user, db=self.db)
+        self.assertIsNone(result)
+        self.assertEqual((await get_contact(contact.contact_id, user=self.other_user, db=self.db)).description, 'cat')
+
+    async def test_birthday_list(self):
+        today = date.today()
+        # born in 2000, a leap year, so the birthdays fall on the same days as this year's dates
+        birthdays = [(today + timedelta(days=days)).replace(year=2000) for days in (9, 3, -1, 0, 6, 7)]
+        for number, birthday in enumerate(birthdays):
+            await self.add_contact(self.user, number, birthday)
+        await self.add_contact(self.other_user, 0, today.replace(year=2000))
+        result = await get_contacts_birthdays(user=self.user, db=self.db, days=7)
+        self.assertEqual([row.last_name for row in result], ['Cat 3', 'Cat 1', 'Cat 4'])
 
 
 if __name__ == '__main__':
@@ -1,21 +1,25 @@
 import unittest
-from unittest.mock import MagicMock, patch
-from sqlalchemy.orm import Session
+import uuid
+from unittest.mock import MagicMock, AsyncMock, patch
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import User
 from shemas import UserModel
 from users import (
     get_user_by_email,
+    get_user_by_id,
     create_user,
     confirmed_email,
-    update_token,
     update_avatar,
+    take_refresh_token,
 )
+from conftest import TestingSessionLocal
 
 
 class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
-        self.session = MagicMock(spec=Session)
+        self.session = AsyncMock(spec=AsyncSession)
+        self.session.execute.return_value = MagicMock()
         self.user = UserModel(
             username='Andrew',
             email='andrew@google.com',
@@ -25,15 +29,22 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     async def test_get_user_by_email(self):
         user = User()
-        self.session.query().filter().first.return_value = user
+        self.session.execute.return_value.scalar_one_or_none.return_value = user
         result = await get_user_by_email(email=self.user.email, db=self.session)
         self.assertEqual(result, user)
 
     async def test_get_user_by_email_not_found(self):
-        self.session.query().filter().first.return_value = None
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
         result = await get_user_by_email(email=self.test_email, db=self.session)
         self.assertIsNone(result)
 
+    async def test_get_user_by_id(self):
+        user = User(user_id=1)
+        self.session.get.return_value = user
+        result = await get_user_by_id(user_id=1, db=self.session)
+        self.assertEqual(result, user)
+        self.session.get.assert_awaited_once_with(User, 1)
+
     async def test_create_user(self):
         with patch.object(self.session, "add") as mock_add, \
                 patch.object(self.session, "commit") as mock_commit, \
@@ -48,17 +59,6 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
         mock_commit.assert_called_once()
         mock_refresh.assert_called_once_with(user)
 
-    async def test_update_token(self):
-        user = User()
-        user.refresh_token = 'old_token'
-        token = 'new_token'
-
-        with patch.object(self.session, "commit") as mock_commit:
-            await update_token(user, token, self.session)
-
-        self.assertEqual(user.refresh_token, token)
-        mock_commit.assert_called_once()
-
     async def test_confirmed_email(self):
         await create_user(body=self.user, db=self.session)
         await confirmed_email(email=self.user.email, db=self.session)
@@ -67,16 +67,41 @@ class TestUsers(unittest.IsolatedAsyncioTestCase):
 
     async def test_update_avatar(self):
         user = User(email=self.user.email)
-        self.session.query().filter().first.return_value = user
+        self.session.execute.return_value.scalar_one_or_none.return_value = user
         result = await update_avatar(user.email, "avatar_url", self.session)
         self.assertEqual(result.avatar, user.avatar)
 
     async def test_update_user_password(self):
         user = User(password=self.user.email)
-        self.session.query().filter().first.return_value = user
+        self.session.execute.return_value.scalar_one_or_none.return_value = user
         result = await update_avatar(user.email, "test_password", self.session)
         self.assertEqual(result.password, user.password)
 
 
+class TestRefreshTokenColumn(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = TestingSessionLocal()
+        self.addAsyncCleanup(self.db.close)
+        self.user = User(username='Andrew', email=f'{uuid.uuid4().hex}@google.com', password='hash',
+                         refresh_token='current')
+        self.db.add(self.user)
+        await self.db.commit()
+
+    async def stored_token(self) -> str | None:
+        async with TestingSessionLocal() as db:
+            return (await db.get(User, self.user.user_id)).refresh_token
+
+    async def test_take_refresh_token(self):
+        self.assertTrue(await take_refresh_token(self.user, 'current', self.db))
+        self.assertIsNone(await self.stored_token())
+        self.assertFalse(await take_refresh_token(self.user, 'current', self.db))
+
+    async def test_take_older_refresh_token(self):
+        self.assertFalse(await take_refresh_token(self.user, 'older', self.db))
+        # the older token may have been stolen, so the current one is refused too
+        self.assertIsNone(await self.stored_token())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,192 @@
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi import HTTPException
+from redis.exceptions import ConnectionError
+from sessions import RefreshTokenStore, RevocationList
+from models import User
+from auth import auth_service
+
+
+class TestRefreshTokenStore(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.register_script.return_value = AsyncMock()
+        self.pipe = self.client.pipeline.return_value
+        self.pipe.execute = AsyncMock()
+        self.store = RefreshTokenStore(self.client, ttl=60)
+
+    async def test_start(self):
+        self.pipe.execute.return_value = [b'3', True]
+        family, jti, generation = await self.store.start('andrew@google.com')
+        self.assertEqual(generation, 3)
+        self.pipe.get.assert_called_once_with('rt:gen:andrew@google.com')
+        self.pipe.set.assert_called_once_with(f'rt:{family}', jti, ex=60)
+
+    async def test_rotate(self):
+        self.store.rotate_script.return_value = RefreshTokenStore.ROTATED
+        next_jti = await self.store.rotate('andrew@google.com', 'fam', 'jti', 0)
+        self.assertIsNotNone(next_jti)
+        self.store.rotate_script.assert_awaited_once_with(keys=['rt:fam', 'rt:gen:andrew@google.com'],
+                                                          args=['jti', next_jti, 0, 60])
+
+    async def test_generation(self):
+        self.client.get = AsyncMock(return_value=b'2')
+        self.assertEqual(await self.store.generation('andrew@google.com'), 2)
+        self.client.get.assert_awaited_once_with('rt:gen:andrew@google.com')
+
+    async def test_rotate_refused(self):
+        for result in (RefreshTokenStore.MISSING, RefreshTokenStore.REUSED, RefreshTokenStore.REVOKED):
+            self.store.rotate_script.return_value = result
+            self.assertIsNone(await self.store.rotate('andrew@google.com', 'fam', 'jti', 0))
+
+
+class TestRevocationList(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.mget = AsyncMock(return_value=[None, None])
+        self.pipe = self.client.pipeline.return_value
+        self.pipe.execute = AsyncMock()
+        self.revocations = RevocationList(self.client, ttl=900, capacity=1000, error_rate=0.01, rebuild_interval=60)
+        self.payload = {'sub': 'andrew@google.com', 'jti': 'abc', 'iat': int(time.time()) - 10}
+
+    async def test_not_revoked_answered_locally(self):
+        self.revocations.synced = True
+        self.assertFalse(await self.revocations.is_revoked(self.payload))
+        self.client.mget.assert_not_awaited()
+
+    async def test_not_synced_asks_redis(self):
+        self.assertFalse(await self.revocations.is_revoked(self.payload))
+        self.client.mget.assert_awaited_once_with(['revoked:user:andrew@google.com', 'revoked:jti:abc'])
+
+    async def test_revoke_token(self):
+        self.revocations.synced = True
+        await self.revocations.revoke_token('abc', time.time() + 60)
+        self.pipe.publish.assert_called_once_with('revoked', 'jti:abc')
+        self.client.mget.return_value = [None, b'1']
+        self.assertTrue(await self.revocations.is_revoked(self.payload))
+
+    async def test_revoke_user_cuts_off_older_tokens(self):
+        self.revocations.synced = True
+        await self.revocations.revoke_user('andrew@google.com')
+        cutoff = self.pipe.set.call_args.args[1]
+        self.client.mget.return_value = [str(cutoff).encode(), None]
+        self.assertTrue(await self.revocations.is_revoked(self.payload))
+        self.assertTrue(await self.revocations.is_revoked(dict(self.payload, iat_ns=cutoff)))
+        # issued in the same second, right after the cutoff
+        self.assertFalse(await self.revocations.is_revoked(dict(self.payload, iat=cutoff // 10 ** 9,
+                                                                iat_ns=cutoff + 1000)))
+
+    async def test_rebuild(self):
+        async def scan_iter(**kwargs):
+            yield b'revoked:jti:abc'
+        self.client.scan_iter = scan_iter
+        await self.revocations.rebuild()
+        self.assertIn('jti:abc', self.revocations.bloom)
+        self.assertNotIn('jti:other', self.revocations.bloom)
+
+    async def test_redis_unavailable(self):
+        self.client.mget.side_effect = ConnectionError()
+        # before the first sync, or after the listener lost Redis, nothing is known about the token
+        with self.assertRaises(ConnectionError):
+            await self.revocations.is_revoked(self.payload)
+        self.revocations.synced = True
+        self.revocations.add('jti:abc')
+        with self.assertRaises(ConnectionError):
+            await self.revocations.is_revoked(self.payload)
+        # a token the filter rules out needs no Redis
+        self.assertFalse(await self.revocations.is_revoked(dict(self.payload, sub='other', jti='other')))
+
+
+class TestAuthSessions(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        store = patch('auth.refresh_tokens', AsyncMock())
+        self.store = store.start()
+        self.addCleanup(store.stop)
+        self.store.start.return_value = ('fam', 'jti', 2)
+        self.user = User(user_id=1, username='Andrew', email='andrew@google.com', password='hash')
+        self.db = AsyncMock()
+
+    async def test_rotate_session(self):
+        self.store.rotate.return_value = 'next'
+        token = await auth_service.create_session(self.user)
+        claims, next_token = await auth_service.rotate_session(token, self.db)
+        self.assertEqual(claims, {'sub': '1', 'email': 'andrew@google.com'})
+        self.store.start.assert_awaited_once_with('1')
+        self.store.rotate.assert_awaited_once_with('1', 'fam', 'jti', 2)
+        payload = await auth_service.decode_refresh_token(next_token)
+        self.assertEqual((payload['jti'], payload['fam'], payload['gen']), ('next', 'fam', 2))
+
+    async def test_rotate_email_subject_session(self):
+        self.store.rotate.return_value = 'next'
+        token = await auth_service.create_refresh_token(
+            data={'sub': 'andrew@google.com', 'jti': 'jti', 'fam': 'old', 'gen': 0})
+        with patch('auth.repository_users.get_user_by_email', AsyncMock(return_value=self.user)):
+            claims, next_token = await auth_service.rotate_session(token, self.db)
+        self.assertEqual(claims['sub'], '1')
+        self.store.end.assert_awaited_once_with('old')
+        payload = await auth_service.decode_refresh_token(next_token)
+        self.assertEqual((payload['sub'], payload['fam']), ('1', 'fam'))
+
+    async def test_rotate_token_from_before_sessions(self):
+        self.store.generation.return_value = 0
+        token = await auth_service.create_refresh_token(data={'sub': 'andrew@google.com'})
+        with patch('auth.repository_users.get_user_by_email', AsyncMock(return_value=self.user)), \
+                patch('auth.repository_users.take_refresh_token', AsyncMock(side_effect=[True, False])) as take:
+            claims, next_token = await auth_service.rotate_session(token, self.db)
+            with self.assertRaises(HTTPException) as e:
+                await auth_service.rotate_session(token, self.db)
+        self.assertEqual(claims['sub'], '1')
+        self.assertEqual(e.exception.status_code, 401)
+        take.assert_awaited_with(self.user, token, self.db)
+        self.store.start.assert_awaited_once_with('1')
+        self.store.rotate.assert_not_awaited()
+        payload = await auth_service.decode_refresh_token(next_token)
+        self.assertEqual((payload['sub'], payload['fam'], payload['gen']), ('1', 'fam', 2))
+
+    async def test_token_from_before_sessions_revoked(self):
+        self.store.generation.return_value = 1
+        token = await auth_service.create_refresh_token(data={'sub': 'andrew@google.com'})
+        with patch('auth.repository_users.get_user_by_email', AsyncMock(return_value=self.user)), \
+                patch('auth.repository_users.take_refresh_token', AsyncMock(return_value=True)):
+            with self.assertRaises(HTTPException) as e:
+                await auth_service.rotate_session(token, self.db)
+        self.assertEqual(e.exception.status_code, 401)
+        self.store.start.assert_not_awaited()
+
+    async def test_rotate_reused_token(self):
+        self.store.rotate.return_value = None
+        token = await auth_service.create_session(self.user)
+        with self.assertRaises(HTTPException) as e:
+            await auth_service.rotate_session(token, self.db)
+        self.assertEqual(e.exception.status_code, 401)
+
+    async def test_token_without_session(self):
+        token = await auth_service.create_refresh_token(data={'sub': '1'})
+        with self.assertRaises(HTTPException) as e:
+            await auth_service.rotate_session(token, self.db)
+        self.assertEqual(e.exception.status_code, 401)
+        self.store.rotate.assert_not_awaited()
+
+    async def test_store_unavailable(self):
+        self.store.start.side_effect = ConnectionError()
+        with self.assertRaises(HTTPException) as e:
+            await auth_service.create_session(self.user)
+        self.assertEqual(e.exception.status_code, 503)
+
+    async def test_end_session(self):
+        token = await auth_service.create_session(self.user)
+        await auth_service.end_session(token)
+        self.store.end.assert_awaited_once_with('fam')
+
+    async def test_revoke_sessions_of_both_subjects(self):
+        await auth_service.revoke_sessions(self.user)
+        self.assertEqual([call.args for call in self.store.revoke_all.await_args_list],
+                         [('1',), ('andrew@google.com',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
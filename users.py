@@ -1,11 +1,13 @@
 from libgravatar import Gravatar
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from models import User
 from shemas import UserModel
+from cache import user_cache
 
 
-async def get_user_by_email(email: str, db: Session) -> User | None:
+async def get_user_by_email(email: str, db: AsyncSession) -> User | None:
     """
     The get_user_by_email function takes in an email and a database session,
     and returns the user associated with that email. If no such user exists, it returns None.
@@ -13,14 +15,30 @@ async def get_user_by_email(email: str, db: Session) -> User | None:
     :param email: Pass the email of the user to be retrieved.
     :type email: str
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: A user object if the user exists, and none if it doesn't.
     :rtype: User | None
     """
-    return db.query(User).filter_by(email=email).first()
+    user = await db.execute(select(User).filter_by(email=email))
+    return user.scalar_one_or_none()
 
 
-async def create_user(body: UserModel, db: Session) -> User:
+async def get_user_by_id(user_id: int, db: AsyncSession) -> User | None:
+    """
+    The get_user_by_id function returns the user with the given id, or None if there is no such user.
+    The lookup is by primary key, so a user already loaded in the session is returned without a query.
+
+    :param user_id: The id of the user.
+    :type user_id: int
+    :param db: The database session.
+    :type db: AsyncSession
+    :return: A user object if the user exists, and none if it doesn't.
+    :rtype: User | None
+    """
+    return await db.get(User, user_id)
+
+
+async def create_user(body: UserModel, db: AsyncSession) -> User:
     """
     The create_user function creates a new user in the database.
         Args:
@@ -29,7 +47,7 @@ async def create_user(body: UserModel, db: Session) -> User:
     :param body: Validate the data that is passed in.
     :type body: UserModel
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: The new user object.
     :rtype: User
     """
@@ -41,29 +59,38 @@ async def create_user(body: UserModel, db: Session) -> User:
         print(e)
     new_user = User(**body.dict(), avatar=avatar)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 
-async def update_token(user: User, token: str | None, db: Session) -> None:
+async def take_refresh_token(user: User, token: str, db: AsyncSession) -> bool:
     """
-    The update_token function updates the refresh token for a user.
+    The take_refresh_token function clears the refresh token stored for the user by logins from before
+    sessions moved to Redis, and tells whether it was the given token. Any other token of the user
+    was exchanged before and may have been stolen, so the stored one is cleared as well.
 
-    :param user: Get the user's id, which is used to find the user in the database
+    :param user: The user.
     :type user: User
-    :param token: Update the refresh token in the database
-    :type token: str | None
+    :param token: The refresh token sent with the request.
+    :type token: str
     :param db: The database session.
-    :type db: Session
-    :return: None
-    :rtype: None
+    :type db: AsyncSession
+    :return: True if the token was the stored one, it can not be used again.
+    :rtype: bool
     """
-    user.refresh_token = token
-    db.commit()
-
-
-async def confirmed_email(email: str, db: Session) -> None:
+    taken = await db.execute(update(User)
+                             .where(User.user_id == user.user_id, User.refresh_token == token)
+                             .values(refresh_token=None)
+                             .returning(User.user_id))
+    taken = taken.scalar_one_or_none() is not None
+    if not taken:
+        await db.execute(update(User).where(User.user_id == user.user_id).values(refresh_token=None))
+    await db.commit()
+    return taken
+
+
+async def confirmed_email(email: str, db: AsyncSession) -> None:
     """
     The confirmed_email function takes in an email and a database session,
     and sets the confirmed field of the user with that email to True.
@@ -71,16 +98,17 @@ async def confirmed_email(email: str, db: Session) -> None:
     :param email: Pass in the email of the user that is being confirmed
     :type email: str
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: None
     :rtype: None
     """
     user = await get_user_by_email(email, db)
     user.confirmed = True
-    db.commit()
+    await db.commit()
+    await user_cache.invalidate(user.user_id)
 
 
-async def update_avatar(email: str, url: str, db: Session) -> User:
+async def update_avatar(email: str, url: str, db: AsyncSession) -> User:
     """
     The update_avatar function updates the avatar of a user.
 
@@ -89,17 +117,18 @@ async def update_avatar(email: str, url: str, db: Session) -> User:
     :param url: Specify the type of data that is being passed into the function
     :type url: str
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: A user object
     :rtype: User
     """
     user = await get_user_by_email(email, db)
     user.avatar = url
-    db.commit()
+    await db.commit()
+    await user_cache.invalidate(user.user_id)
     return user
 
 
-async def update_user_password(email: str, password: str, db: Session) -> User:
+async def update_user_password(email: str, password: str, db: AsyncSession) -> User:
     """
     The update_user_password function updates a user's password in the database.
         Args:
@@ -111,11 +140,12 @@ async def update_user_password(email: str, password: str, db: Session) -> User:
     :param password: Pass the new password to the function
     :type password: str
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: The updated user
     :rtype: User
     """
     user = await get_user_by_email(email, db)
     user.password = password
-    db.commit()
+    await db.commit()
+    await user_cache.invalidate(user.user_id)
     return user
@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, status, UploadFile, File, BackgroundTasks, HTTPException, Request
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import cloudinary
 import cloudinary.uploader
 from my_db import get_db
@@ -34,20 +34,20 @@ async def read_users_me(current_user: User = Depends(auth_service.get_current_us
 
 @router.patch('/avatar', response_model=UserDb)
 async def update_avatar_user(file: UploadFile = File(), current_user: User = Depends(auth_service.get_current_user),
-                             db: Session = Depends(get_db)) -> User:
+                             db: AsyncSession = Depends(get_db)) -> User:
     """
     The update_avatar_user function updates the avatar of a user.
         Args:
             file (UploadFile): The image to be uploaded as an avatar.
             current_user (User): The user whose avatar is being updated.  This is passed in by the auth_service dependency, which uses JWT tokens to authenticate users and pass them into functions that require authentication.  See auth_service for more details on how this works.
-            db (Session): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
+            db (AsyncSession): A database session object used for querying and updating data in the database using SQLAlchemy's ORM methods.
 
     :param file: Upload the file to cloudinary.
     :type file: UploadFile
     :param current_user: Get the current user's email and username.
     :type current_user: User
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: A user object
     :rtype: User
     """
@@ -68,10 +68,11 @@ async def update_avatar_user(file: UploadFile = File(), current_user: User = Dep
 
 @router.patch('/update_password', response_model=UserDb)
 async def update_password_user(password, background_tasks: BackgroundTasks, request: Request, current_user: User = Depends(auth_service.get_current_user),
-                               db: Session = Depends(get_db)):
+                               db: AsyncSession = Depends(get_db)):
     """
     The update_password_user function updates the password of a user.
         The function takes in the new password, and returns the updated user object.
+        All tokens issued to the user before the change are revoked, the user has to log in again.
 
     :param password: Get the password from the request body.
     :type password: str
@@ -82,15 +83,17 @@ async def update_password_user(password, background_tasks: BackgroundTasks, requ
     :param current_user: Get the current user.
     :type current_user: User
     :param db: The database session.
-    :type db: Session
+    :type db: AsyncSession
     :return: The user object.
     :rtype: User
     """
-    password = auth_service.get_password_hash(password)
+    password = await auth_service.get_password_hash(password)
     user = await repository_users.update_user_password(current_user.email, password, db)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    await auth_service.revoke_sessions(user)
+    await auth_service.revoke_access_tokens(user)
     background_tasks.add_task(
         send_email_password, user.email, user.username, request.base_url)
     return user